@@ -27,6 +27,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',  # OpClass nos índices trigram (documentos 0012)
     'django_celery_beat',
     'rest_framework',
     'corsheaders',
@@ -49,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'documentos.metricas.MetricasRequisicaoMiddleware',
 ]
 
 ROOT_URLCONF = 'app.urls'
@@ -144,6 +146,19 @@ STATIC_ROOT = BASE_DIR / "staticfiles"   # destino do collectstatic
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# "documentos_xml": XML dos documentos, endereçados por SHA-256 (ver documentos.blobs_xml);
+# troque o BACKEND (ex.: S3) para tirar os arquivos do disco local.
+# DOCUMENTO_XML_DIR fica fora de MEDIA_ROOT e nunca deve ser servido pelo servidor web
+# (nginx, static() com DEBUG): o XML de todas as empresas só sai pelo download da API
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "documentos_xml": {
+        "BACKEND": config('DOCUMENTO_XML_STORAGE', default='django.core.files.storage.FileSystemStorage'),
+        "OPTIONS": {"location": config('DOCUMENTO_XML_DIR', default=str(BASE_DIR / "documentos_xml"))},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -162,9 +177,86 @@ CORS_ALLOWED_ORIGINS = [
 # CELERY_BROKER_URL = 'redis://localhost:6379/0'
 # CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_BROKER_URL = f"redis://{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', 6379)}/0"
-# CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/1")
+# Necessário para o chord que agrega o resumo das tasks por conta de e-mail
+CELERY_RESULT_BACKEND = os.getenv(
+    "CELERY_RESULT_BACKEND",
+    f"redis://{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', 6379)}/1",
+)
+CELERY_RESULT_EXPIRES = timedelta(hours=6)
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_WORKER_CONCURRENCY = config('CELERY_WORKER_CONCURRENCY', default=os.cpu_count(), cast=int)
 
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
+# Cache compartilhado entre processos (tokens do Microsoft Graph, etc.)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv(
+            "CACHE_URL",
+            f"redis://{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', 6379)}/2",
+        ),
+    }
+}
+
+# Leitura de e-mails (uma task Celery por conta)
+EMAIL_TASK_SOFT_TIME_LIMIT = config('EMAIL_TASK_SOFT_TIME_LIMIT', default=600, cast=int)  # segundos
+EMAIL_TASK_TIME_LIMIT = config('EMAIL_TASK_TIME_LIMIT', default=660, cast=int)
+EMAIL_TASK_MAX_RETRIES = config('EMAIL_TASK_MAX_RETRIES', default=3, cast=int)
+EMAIL_TASK_RETRY_BACKOFF = config('EMAIL_TASK_RETRY_BACKOFF', default=30, cast=int)  # segundos, dobra a cada tentativa
+IMAP_FETCH_BATCH = config('IMAP_FETCH_BATCH', default=50, cast=int)  # mensagens por UID FETCH
+IMAP_TIMEOUT = config('IMAP_TIMEOUT', default=60, cast=int)  # segundos por operação no socket IMAP
+GRAPH_DELTA_SYNC = config('GRAPH_DELTA_SYNC', default=True, cast=bool)  # delta query incremental no Office 365
+GRAPH_PAGE_SIZE = config('GRAPH_PAGE_SIZE', default=50, cast=int)
+GRAPH_CONNECT_TIMEOUT = config('GRAPH_CONNECT_TIMEOUT', default=10, cast=int)  # segundos
+GRAPH_READ_TIMEOUT = config('GRAPH_READ_TIMEOUT', default=60, cast=int)
+GRAPH_MAX_RETRIES = config('GRAPH_MAX_RETRIES', default=5, cast=int)  # tentativas em 429/503
+GRAPH_POOL_SIZE = config('GRAPH_POOL_SIZE', default=10, cast=int)  # conexões keep-alive por tenant
+
+# Motor de leitura: 'chord' (uma task Celery por conta) ou 'asyncio' (um processo, com um pool de
+# threads limitado coordenado por um event loop; ver leitor_async)
+EMAIL_INGEST_ENGINE = config('EMAIL_INGEST_ENGINE', default='chord')
+EMAIL_ASYNC_MAX_CONTAS = config('EMAIL_ASYNC_MAX_CONTAS', default=50, cast=int)  # threads (contas simultâneas) no processo
+EMAIL_ASYNC_MAX_POR_HOST = config('EMAIL_ASYNC_MAX_POR_HOST', default=5, cast=int)  # conexões IMAP por servidor
+EMAIL_ASYNC_MAX_POR_TENANT = config('EMAIL_ASYNC_MAX_POR_TENANT', default=4, cast=int)  # contas Office 365 por tenant
+
+# Fila de anexos (AnexoPendente): leitores só enfileiram e consumidores fazem parse/gravação
+EMAIL_INGEST_STAGING = config('EMAIL_INGEST_STAGING', default=False, cast=bool)
+STAGING_LOTE = config('STAGING_LOTE', default=200, cast=int)  # anexos por lote consumido
+STAGING_QUEUE = config('STAGING_QUEUE', default='celery')  # fila Celery dos consumidores
+CELERY_TASK_ROUTES = {
+    'documentos.tasks.tarefa_consumir_anexos_pendentes': {'queue': STAGING_QUEUE},
+}
+
+# Processos para o parse de XML em lote (reprocessamento, fila de anexos); 0 = núcleos da máquina
+XML_PARSE_WORKERS = config('XML_PARSE_WORKERS', default=0, cast=int)
+XML_PARSE_MIN_PARALELO = config('XML_PARSE_MIN_PARALELO', default=50, cast=int)  # abaixo disso, parse no próprio processo
+
+# Parser dos XML SIFEN: 'etree' (xml.etree) ou 'lxml' (XPath pré-compilado; ver benchmark_parser_xml)
+SIFEN_XML_BACKEND = config('SIFEN_XML_BACKEND', default='etree')
+
+# Anexos compactados (.zip / .xml.gz): expandidos em memória, com limites contra zip bomb
+ANEXO_COMPACTADO_MAX_ARQUIVOS = config('ANEXO_COMPACTADO_MAX_ARQUIVOS', default=1000, cast=int)  # XMLs por anexo
+ANEXO_COMPACTADO_MAX_BYTES = config('ANEXO_COMPACTADO_MAX_BYTES', default=100 * 1024 * 1024, cast=int)  # total descompactado por anexo
+
+# XML dos documentos gravado comprimido com zlib (1 = mais rápido, 9 = menor)
+DOCUMENTO_XML_ZLIB_NIVEL = config('DOCUMENTO_XML_ZLIB_NIVEL', default=6, cast=int)
+
+# Cache em memória (por processo) de Departamento, Cidade, TipoDocumento e Emissor
+REFERENCIAS_CACHE_TAMANHO = config('REFERENCIAS_CACHE_TAMANHO', default=5000, cast=int)  # itens por tabela
+REFERENCIAS_CACHE_TTL = config('REFERENCIAS_CACHE_TTL', default=3600, cast=int)  # segundos
+
+# Métricas Prometheus em /metrics. Com vários processos (workers Celery, gunicorn),
+# PROMETHEUS_MULTIPROC_DIR aponta para um diretório comum a todos, esvaziado a cada deploy
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # "Authorization: Bearer <token>" do Prometheus; vazio = só usuário staff
+PROMETHEUS_MULTIPROC_DIR = config('PROMETHEUS_MULTIPROC_DIR', default='')
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', PROMETHEUS_MULTIPROC_DIR)
+
+# Perfil (cProfile + contagem de SQL) com --profile nos comandos; PROFILE_INGESTAO liga na leitura de e-mails
+PROFILE_DIR = config('PROFILE_DIR', default=str(BASE_DIR / 'perfis'))  # .prof e resumo .txt por execução
+PROFILE_TOP = config('PROFILE_TOP', default=40, cast=int)  # funções no resumo (tempo acumulado)
+PROFILE_INGESTAO = config('PROFILE_INGESTAO', default=False, cast=bool)
@@ -2,10 +2,12 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
+from documentos.metricas import metricas_view
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metricas_view, name='metrics'),
     path('api/v1/', include('documentos.urls')),
     path('api/v1/', include('emissores.urls')),
     
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from documentos.models import Documento, TipoDocumento
+from documentos.models import (
+    AnexoPendente, AnexoProcessado, Documento, DocumentoItem, IngestRun, IngestRunAccount, TipoDocumento,
+)
 
 
 @admin.register(TipoDocumento)
@@ -9,9 +11,87 @@ class TipoDocumentoAdmin(admin.ModelAdmin):
     ordering = ('code',)
     list_filter = ('created_at', 'updated_at')
 
+class DocumentoItemInline(admin.TabularInline):
+    model = DocumentoItem
+    extra = 0
+    can_delete = False
+    fields = ('numero', 'codigo', 'descricao', 'unidade', 'quantidade', 'preco_unitario', 'desconto', 'taxa_iva', 'total')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 @admin.register(Documento)
 class DocumentoAdmin(admin.ModelAdmin):
     list_display = ('company__name', 'cdc', 'tipo_documento', 'est', 'pun_exp', 'num_doc', 'emissor', 'fecha_emision', 'monto_total', 'created_at', 'updated_at')
     search_fields = ('company__name', 'cdc', 'num_doc', 'emissor__nombre')
     ordering = ('-fecha_emision',)
     list_filter = ('company__name', 'tipo_documento', 'fecha_emision', 'emissor')
+    exclude = ('documento_xml_texto',)
+    readonly_fields = ('xml_sha256', 'xml_tamanho', 'documento_xml')
+    inlines = [DocumentoItemInline]
+
+@admin.register(AnexoProcessado)
+class AnexoProcessadoAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'filename', 'size_bytes', 'documento', 'created_at')
+    search_fields = ('sha256', 'filename', 'documento__cdc')
+    ordering = ('-created_at',)
+    raw_id_fields = ('documento',)
+
+@admin.register(AnexoPendente)
+class AnexoPendenteAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'account', 'subject', 'received_at', 'created_at')
+    search_fields = ('filename', 'subject', 'account__username')
+    ordering = ('created_at',)
+    exclude = ('payload',)
+
+class IngestRunAccountInline(admin.TabularInline):
+    model = IngestRunAccount
+    extra = 0
+    can_delete = False
+    fields = (
+        'account', 'started_at', 'finished_at', 'messages_found', 'messages_processed', 'messages_deleted',
+        'bytes_downloaded', 'documents_created', 'duplicates', 'queued', 'errors',
+        'connect_seconds', 'search_seconds', 'fetch_seconds', 'parse_seconds', 'db_seconds', 'error',
+    )
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(IngestRun)
+class IngestRunAdmin(admin.ModelAdmin):
+    """
+    Histórico das execuções da leitura de e-mails (somente leitura).
+    """
+    list_display = (
+        'started_at', 'engine', 'duration_seconds', 'accounts', 'accounts_failed', 'messages_found',
+        'documents_created', 'duplicates', 'errors', 'fetch_seconds', 'parse_seconds', 'db_seconds',
+    )
+    list_filter = ('engine', 'started_at')
+    ordering = ('-started_at',)
+    inlines = (IngestRunAccountInline,)
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(IngestRunAccount)
+class IngestRunAccountAdmin(admin.ModelAdmin):
+    list_display = (
+        'started_at', 'account', 'run', 'messages_found', 'documents_created', 'errors',
+        'connect_seconds', 'search_seconds', 'fetch_seconds', 'parse_seconds', 'db_seconds', 'error',
+    )
+    search_fields = ('account__username', 'error')
+    list_filter = ('started_at',)
+    ordering = ('-started_at',)
+    raw_id_fields = ('run', 'account')
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class DocumentosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'documentos'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from common.models import Cidade, Departamento
+        from documentos.cache_referencias import invalidar_referencia
+        from documentos.models import TipoDocumento
+        from emissores.models import Emissor
+
+        # Mantém o cache de referências coerente quando as tabelas mudam
+        for model in (Departamento, Cidade, TipoDocumento, Emissor):
+            post_save.connect(invalidar_referencia, sender=model, dispatch_uid=f"cache-{model._meta.label}-save")
+            post_delete.connect(invalidar_referencia, sender=model, dispatch_uid=f"cache-{model._meta.label}-delete")
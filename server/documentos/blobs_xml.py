@@ -0,0 +1,59 @@
+import hashlib
+import zlib
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from documentos.sifen import texto_xml
+
+# Storage (settings.STORAGES) com os XML dos documentos, endereçados pelo
+# SHA-256 do conteúdo: XMLs iguais ocupam um único arquivo.
+STORAGE_XML = 'documentos_xml'
+
+
+def descomprimir_xml(dados):
+    # BinaryField volta como memoryview no PostgreSQL e bytes no SQLite
+    return zlib.decompress(dados).decode('utf-8')
+
+def chave_xml(sha256):
+    # Dois níveis de diretório para não acumular milhões de arquivos em uma pasta
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}.xml.z"
+
+def sha256_da_chave(nome):
+    # Inverso de chave_xml: 'ab/cd/<sha>.xml.z' -> '<sha>' ('' se não for um XML do storage)
+    base = nome.rsplit('/', 1)[-1]
+    return base[:-len('.xml.z')] if base.endswith('.xml.z') else ''
+
+def guardar_xml(xml, sha256=None):
+    """
+    Grava o XML (comprimido com zlib) no storage, se ainda não existir, e
+    devolve (sha256, tamanho em bytes do XML sem compressão).
+
+    bytes/memoryview (o anexo como veio do e-mail) são gravados sem
+    decodificar: o SHA-256 é o mesmo do anexo (AnexoProcessado) e `sha256`,
+    se informado, evita calcular de novo. str (DE de um lote, linhas antigas)
+    é gravado em UTF-8, com o prólogo ajustado (ver texto_xml).
+
+    Chame fora da transação que grava o Documento: um rollback deixa o
+    arquivo sem documento (ver limpar_xml_orfaos), nunca o contrário.
+    """
+    if isinstance(xml, str):
+        dados = texto_xml(xml).encode('utf-8')
+        sha256 = None
+    else:
+        dados = bytes(xml)
+    sha256 = sha256 or hashlib.sha256(dados).hexdigest()
+    storage = storages[STORAGE_XML]
+    chave = chave_xml(sha256)
+    if not storage.exists(chave):
+        gravado = storage.save(chave, ContentFile(zlib.compress(dados, settings.DOCUMENTO_XML_ZLIB_NIVEL)))
+        if gravado != chave:
+            # Outro processo gravou o mesmo XML nesse meio-tempo: o conteúdo é o mesmo
+            storage.delete(gravado)
+    return sha256, len(dados)
+
+def ler_xml(sha256):
+    """
+    Bytes do XML como foram gravados (encoding original; ver encoding_declarado).
+    """
+    with storages[STORAGE_XML].open(chave_xml(sha256), 'rb') as arquivo:
+        return zlib.decompress(arquivo.read())
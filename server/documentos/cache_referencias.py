@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache as cache_compartilhado
+
+
+class CacheLRU:
+    """
+    Cache LRU em memória (por processo) com tamanho máximo e TTL, seguro para
+    threads. Conta acertos e falhas para acompanhar a eficácia.
+    """
+
+    def __init__(self, tamanho_max, ttl):
+        self.tamanho_max = tamanho_max
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Versão compartilhada (ver versao_compartilhada) com que os itens foram lidos
+        self.versao = None
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[1] > time.monotonic():
+                self._itens.move_to_end(chave)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._itens[chave]
+            self.misses += 1
+            return None
+
+    def set(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (valor, time.monotonic() + self.ttl)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.tamanho_max:
+                self._itens.popitem(last=False)
+
+    def delete(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def clear(self):
+        with self._lock:
+            self._itens.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tamanho': len(self._itens)}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def cache_do_modelo(model):
+    """
+    Cache de instâncias por `code` para uma tabela de referência
+    (Departamento, Cidade, TipoDocumento, Emissor).
+    """
+    with _caches_lock:
+        cache = _caches.get(model._meta.label)
+        if cache is None:
+            cache = CacheLRU(settings.REFERENCIAS_CACHE_TAMANHO, settings.REFERENCIAS_CACHE_TTL)
+            _caches[model._meta.label] = cache
+        return cache
+
+def _chave_versao(model):
+    return f"referencias-versao:{model._meta.label}"
+
+def versao_compartilhada(model):
+    """
+    Versão da tabela de referência no cache do Django (Redis, compartilhado
+    entre os workers); muda a cada invalidação. None se o cache estiver fora.
+    """
+    try:
+        return cache_compartilhado.get(_chave_versao(model), 0)
+    except Exception as e:
+        print(f"⚠️ Cache indisponível ao ler a versão de {model._meta.label}: {e}")
+        return None
+
+def buscar_em_cache(model, codes):
+    """
+    Separa os codes em ({code: instância} já em cache, [codes que faltam]).
+    Se outro processo invalidou a tabela desde a última leitura, o cache local
+    é descartado antes.
+    """
+    cache = cache_do_modelo(model)
+    versao = versao_compartilhada(model)
+    if versao is not None and versao != cache.versao:
+        cache.clear()
+        cache.versao = versao
+    encontrados = {}
+    faltantes = []
+    for code in codes:
+        obj = cache.get(code)
+        if obj is None:
+            faltantes.append(code)
+        else:
+            encontrados[code] = obj
+    return encontrados, faltantes
+
+def guardar_em_cache(model, objetos):
+    cache = cache_do_modelo(model)
+    for obj in objetos:
+        cache.set(obj.code, obj)
+
+def invalidar_modelo(model):
+    """
+    Invalida o cache da tabela em todos os processos, incrementando a versão
+    compartilhada. Chame depois de queryset.update()/delete(), que não
+    disparam sinais.
+    """
+    chave = _chave_versao(model)
+    try:
+        cache_compartilhado.add(chave, 0, None)
+        cache_compartilhado.incr(chave)
+    except Exception as e:
+        print(f"⚠️ Cache indisponível ao invalidar {model._meta.label}: {e}")
+    cache = _caches.get(model._meta.label)
+    if cache is not None:
+        cache.clear()
+
+def invalidar_referencia(sender, instance, **kwargs):
+    """
+    Receiver de post_save/post_delete: invalida a tabela alterada em todos os
+    processos (ver invalidar_modelo).
+    """
+    invalidar_modelo(sender)
+
+def limpar_caches():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
+
+def estatisticas_cache():
+    """
+    Acertos, falhas e tamanho de cada cache: {'common.Cidade': {...}, ...}.
+    """
+    with _caches_lock:
+        return {label: cache.estatisticas() for label, cache in _caches.items()}
+
+def imprimir_estatisticas_cache():
+    for label, est in sorted(estatisticas_cache().items()):
+        total = est['hits'] + est['misses']
+        taxa = (est['hits'] / total * 100) if total else 0.0
+        print(f"🧠 Cache {label}: {est['hits']} acerto(s), {est['misses']} falha(s) ({taxa:.0f}%); {est['tamanho']} item(ns).")
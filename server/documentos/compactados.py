@@ -0,0 +1,135 @@
+import gzip
+import io
+import posixpath
+import zipfile
+import zlib
+from django.conf import settings
+
+ZIP_MIME_TYPES = {"application/zip", "application/x-zip-compressed", "application/x-zip"}
+GZIP_MIME_TYPES = {"application/gzip", "application/x-gzip"}
+
+
+class LimiteCompactadoExcedido(ValueError):
+    """Arquivo compactado com XMLs demais ou grande demais depois de expandido."""
+
+
+def eh_compactado(filename, mime_type=None):
+    """
+    True para anexos .zip ou .gz (pelo nome ou pelo content-type). Um .gz que
+    não contém XML é descartado na expansão (ver _itens_gzip).
+    """
+    nome = (filename or '').lower()
+    mime_type = (mime_type or '').lower()
+    return (
+        nome.endswith(('.zip', '.gz'))
+        or mime_type in ZIP_MIME_TYPES
+        or mime_type in GZIP_MIME_TYPES
+    )
+
+def expandir_anexos(anexos, max_arquivos=None, max_bytes=None):
+    """
+    Substitui cada anexo compactado (.zip / .xml.gz) pelos XMLs de dentro dele,
+    lidos em memória (sem arquivos temporários). Cada XML vira um anexo próprio
+    ({'filename': 'pacote.zip/nota.xml', 'mime_type', 'payload_bytes'}), então
+    dedup, erros e EmailXmlError são por XML. Anexos não compactados passam
+    sem alteração.
+
+    Limites (padrão: settings.ANEXO_COMPACTADO_MAX_ARQUIVOS e
+    ANEXO_COMPACTADO_MAX_BYTES) valem por anexo compactado e são conferidos
+    durante a descompactação, sem confiar nos tamanhos declarados no ZIP. Um
+    compactado corrompido ou acima do limite vira um único anexo com
+    anexo['erro'], para ser registrado como erro (e a mensagem não ser apagada).
+    """
+    max_arquivos = max_arquivos or settings.ANEXO_COMPACTADO_MAX_ARQUIVOS
+    max_bytes = max_bytes or settings.ANEXO_COMPACTADO_MAX_BYTES
+
+    expandidos = []
+    for anexo in anexos:
+        if not eh_compactado(anexo['filename'], anexo.get('mime_type')):
+            expandidos.append(anexo)
+            continue
+        try:
+            expandidos.extend(_expandir(anexo, max_arquivos, max_bytes))
+        except (LimiteCompactadoExcedido, zipfile.BadZipFile, zipfile.LargeZipFile,
+                gzip.BadGzipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as e:
+            # RuntimeError/NotImplementedError: ZIP criptografado ou compressão não suportada
+            print(f"🗜️ {anexo['filename']}: não foi possível expandir ({e}).")
+            expandidos.append({**anexo, 'erro': f"Arquivo compactado inválido: {e}"})
+    return expandidos
+
+def _expandir(anexo, max_arquivos, max_bytes):
+    payload = anexo['payload_bytes'] or b""
+    pacote = anexo['filename'] or 'anexo'
+    if zipfile.is_zipfile(io.BytesIO(payload)):
+        itens = _itens_zip(payload, max_arquivos, max_bytes)
+    elif pacote.lower().endswith('.zip') or (anexo.get('mime_type') or '').lower() in ZIP_MIME_TYPES:
+        raise zipfile.BadZipFile("arquivo ZIP inválido")
+    else:
+        itens = _itens_gzip(pacote, payload, max_bytes)
+
+    return [
+        {
+            'filename': f"{pacote}/{nome}"[-255:],
+            'mime_type': 'application/xml',
+            'payload_bytes': conteudo,
+        }
+        for nome, conteudo in itens
+    ]
+
+def _itens_zip(payload, max_arquivos, max_bytes):
+    restante = max_bytes
+    quantidade = 0
+    with zipfile.ZipFile(io.BytesIO(payload)) as zf:
+        for info in zf.infolist():
+            nome = info.filename
+            base = posixpath.basename(nome)
+            # Só XMLs; ignora pastas, metadados do macOS e compactados aninhados
+            if info.is_dir() or nome.startswith('__MACOSX/') or not base.lower().endswith('.xml'):
+                continue
+            quantidade += 1
+            if quantidade > max_arquivos:
+                raise LimiteCompactadoExcedido(f"mais de {max_arquivos} XML(s) no arquivo")
+            with zf.open(info) as entrada:
+                conteudo = _ler_limitado(entrada, restante)
+            restante -= len(conteudo)
+            yield base, conteudo
+
+def _itens_gzip(pacote, payload, max_bytes):
+    """
+    Só .xml.gz (ou gzip cujo nome original, gravado no cabeçalho, termina em
+    .xml). Os demais (backup.tar.gz, relatorio.pdf.gz) são ignorados, como os
+    arquivos não-XML de um ZIP.
+    """
+    nome = posixpath.basename(pacote)
+    if nome.lower().endswith('.gz'):
+        nome = nome[:-3]
+    if not nome.lower().endswith('.xml'):
+        nome = posixpath.basename(_nome_original_gzip(payload))
+    if not nome.lower().endswith('.xml'):
+        print(f"🗜️ {pacote}: compactado sem XML, ignorado.")
+        return
+    with gzip.GzipFile(fileobj=io.BytesIO(payload)) as entrada:
+        conteudo = _ler_limitado(entrada, max_bytes)
+    yield nome, conteudo
+
+def _nome_original_gzip(payload):
+    # Campo FNAME do cabeçalho (RFC 1952), se presente; '' caso contrário
+    if payload[:2] != b"\x1f\x8b" or len(payload) < 10:
+        return ''
+    flags = payload[3]
+    pos = 10
+    if flags & 0x04:  # FEXTRA
+        pos += 2 + int.from_bytes(payload[pos:pos + 2], 'little')
+    if not flags & 0x08:  # FNAME
+        return ''
+    fim = payload.find(b"\x00", pos)
+    if fim < 0:
+        return ''
+    return payload[pos:fim].decode('latin-1')
+
+def _ler_limitado(entrada, limite):
+    # Lê no máximo limite + 1 bytes: o tamanho declarado no cabeçalho pode ser falso
+    conteudo = entrada.read(limite + 1)
+    if len(conteudo) > limite:
+        raise LimiteCompactadoExcedido(f"conteúdo descompactado acima de {limite} bytes")
+    return conteudo
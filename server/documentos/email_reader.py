@@ -1,12 +1,33 @@
 import base64
 import email
 import imaplib
-import os
+import re
 import requests
+import time
 from datetime import datetime, timedelta
-from documentos.util import processar_nfe_xml, save_xml_error_simple, parse_email_date, get_graph_token
+from django.conf import settings
+from documentos.cache_referencias import imprimir_estatisticas_cache
+from documentos.compactados import eh_compactado, expandir_anexos
+from documentos.execucoes import finalizar_execucao, iniciar_execucao, medir, novos_tempos, registrar_conta_execucao
+from documentos.graph import GRAPH_BATCH_MAX, GraphClient
+from documentos.imap import HEADER_FIELDS, compactar_uids, decodificar_parte, listar_partes_xml, parse_fetch_response
+from documentos.ingestao import (
+    ANEXO_DUPLICADO,
+    ANEXO_ENFILEIRADO,
+    ANEXO_ERRO,
+    ANEXO_OK,
+    enfileirar_anexos,
+    gravar_indice_anexos,
+    indice_anexos,
+    processar_anexos_lote,
+)
+from documentos.perfil import perfilar
+from documentos.util import parse_email_date
 from email import policy
-from emails.models import User
+from emails.models import ImapSyncState, User
+
+IMAP_FOLDER = "inbox"
+GRAPH_SELECT = "id,subject,from,receivedDateTime,hasAttachments"
 
 
 def ler_emails_com_anexos(max_emails=200):
@@ -15,28 +36,124 @@ def ler_emails_com_anexos(max_emails=200):
     (exclui hoje), processa anexos .xml e, em caso de erro no processamento de algum
     XML, salva o XML bruto em disco e registra no modelo EmailXmlError via helper
     save_xml_error_simple(...).
+
+    Processa as contas em sequência; a task Celery usa processar_conta_email
+    diretamente para disparar uma task por conta. A execução fica registrada em
+    IngestRun (uma IngestRunAccount por conta).
     """
     users = User.objects.filter(active=True)
+    resumos = []
+    execucao_id = iniciar_execucao('sequencial')
 
     for user in users:
-        host = user.host
-        port = int(user.port or 993)  # seu port é CharField
-        username = user.username
-
         try:
-            print(f"📥 Conectando com {username} em {host}:{port}")
-            if user.office365:
-                leitor_email_graph(user, max_emails=max_emails)
-            else:
-                leitor_email_box(user, max_emails=max_emails)
-
+            resumos.append(processar_conta_email(user, max_emails=max_emails, execucao_id=execucao_id))
         except Exception as e:
-            print(f"🚫 Erro ao conectar ou processar e-mails de {username}: {e}")
+            print(f"🚫 Erro ao conectar ou processar e-mails de {user.username}: {e}")
+            resumos.append(novo_resumo(user, erro=str(e)))
+
+    finalizar_execucao(execucao_id)
+    imprimir_resumo_execucao(resumos)
+    imprimir_estatisticas_cache()
+    return resumos
 
-def leitor_email_box(user, max_emails=200):
+def novo_resumo(user, erro=None):
+    """
+    Resumo (serializável em JSON) do processamento de uma conta, com o tempo
+    acumulado por etapa em 'tempos' (ver execucoes.ETAPAS).
     """
-    Função placeholder para evitar erro de importação circular.
+    return {
+        'conta_id': user.pk,
+        'conta': user.username,
+        'encontrados': 0,
+        'processados': 0,
+        'apagados': 0,
+        'duplicados': 0,
+        'enfileirados': 0,
+        'criados': 0,
+        'erros': 0,
+        'bytes': 0,
+        'duracao': 0.0,
+        'tempos': novos_tempos(),
+        'erro': erro,
+    }
+
+def processar_conta_email(user, max_emails=200, execucao_id=None, cancelar=None):
+    """
+    Processa a caixa de uma única conta (IMAP ou Microsoft Graph) e devolve o
+    resumo com contagens e duração. Erros de conexão/autenticação são propagados
+    para que o chamador decida sobre retry. `execucao_id` é a IngestRun em que a
+    leitura é registrada. Com PROFILE_INGESTAO, grava o perfil da conta (ver
+    perfil.perfilar).
+
+    `cancelar` (threading.Event) interrompe a leitura entre um lote e outro,
+    deixando a caixa e o estado da sincronização consistentes; o resumo volta
+    com o erro "Tempo limite excedido".
+    """
+    inicio = time.monotonic()
+    print(f"📥 Conectando com {user.username} em {user.host}:{user.port or 993}")
+    with perfilar(f"conta-{user.username}", ativo=settings.PROFILE_INGESTAO):
+        if user.office365:
+            resumo = leitor_email_graph(user, max_emails=max_emails, execucao_id=execucao_id, cancelar=cancelar)
+        else:
+            resumo = leitor_email_box(user, max_emails=max_emails, execucao_id=execucao_id, cancelar=cancelar)
+    resumo['duracao'] = round(time.monotonic() - inicio, 3)
+    return resumo
+
+def imprimir_resumo_execucao(resumos):
+    """
+    Imprime o resumo de uma execução com as contagens e a duração de cada conta.
+    """
+    resumos = [r for r in resumos if r]
+    for r in sorted(resumos, key=lambda r: r['duracao'], reverse=True):
+        status = f" ❌ {r['erro']}" if r.get('erro') else ""
+        tempos = r.get('tempos') or {}
+        etapas = ", ".join(f"{etapa} {segundos:.1f}s" for etapa, segundos in tempos.items())
+        print(
+            f"📊 [{r['conta']}] encontrados {r['encontrados']}; processados {r['processados']}; "
+            f"duplicados {r.get('duplicados', 0)}; enfileirados {r.get('enfileirados', 0)}; "
+            f"apagados {r['apagados']}; {r['duracao']:.1f}s ({etapas}){status}"
+        )
+
+    total_processados = sum(r['processados'] for r in resumos)
+    total_apagados = sum(r['apagados'] for r in resumos)
+    total_duplicados = sum(r.get('duplicados', 0) for r in resumos)
+    com_erro = sum(1 for r in resumos if r.get('erro'))
+    mais_lenta = max((r['duracao'] for r in resumos), default=0.0)
+    print(
+        f"📊 Execução: {len(resumos)} conta(s), {com_erro} com erro; processados {total_processados}; "
+        f"duplicados {total_duplicados}; apagados {total_apagados}; conta mais lenta {mais_lenta:.1f}s."
+    )
+
+def leitor_email_box(user, max_emails=200, execucao_id=None, cancelar=None):
     """
+    Lê a INBOX de uma conta IMAP, processa os anexos .xml e apaga os e-mails
+    processados com sucesso. Devolve o resumo da conta (ver novo_resumo).
+
+    A sincronização é incremental por UID: guarda em ImapSyncState o UIDVALIDITY
+    da pasta e o maior UID já processado, e só busca mensagens mais novas. A
+    varredura pela janela de 5 dias só acontece na primeira execução ou quando
+    o servidor troca o UIDVALIDITY.
+
+    A leitura (contagens e tempo de conexão, busca, download, parse e gravação)
+    é registrada em uma IngestRunAccount da execução `execucao_id`.
+    """
+    resumo = novo_resumo(user)
+    with registrar_conta_execucao(execucao_id, resumo):
+        return _ler_caixa_imap(user, max_emails, resumo, cancelar)
+
+def _interrompida(user, cancelar, resumo):
+    """
+    True se a leitura da conta foi cancelada (tempo limite do leitor
+    concorrente); marca o erro no resumo.
+    """
+    if cancelar is None or not cancelar.is_set():
+        return False
+    print(f"⏱️ [{user.username}] Leitura interrompida: tempo limite excedido.")
+    resumo['erro'] = "Tempo limite excedido"
+    return True
+
+def _ler_caixa_imap(user, max_emails, resumo, cancelar=None):
     host = user.host
     port = int(user.port or 993)  # seu port é CharField
     username = user.username
@@ -47,247 +164,483 @@ def leitor_email_box(user, max_emails=200):
     antes  = hoje.strftime("%d-%b-%Y")                        # BEFORE (exclui hoje)
     amanha = (hoje + timedelta(days=1)).strftime("%d-%b-%Y")
 
+    # Erros de conexão/login propagam para o chamador (a task Celery faz retry)
+    with medir(resumo, 'conexao'):
+        mail = imaplib.IMAP4_SSL(host, port, timeout=settings.IMAP_TIMEOUT)
     try:
-        print(f"📥 Conectando com {username} em {host}:{port}")
-        mail = imaplib.IMAP4_SSL(host, port)
-        mail.login(username, password)
-        mail.select("inbox")  # READ-WRITE
-
-        # Busca todos os e-mails no período
-        search_query = f'(SINCE "{inicio}" BEFORE "{amanha}")'
-        status, data = mail.search(None, search_query)
+        with medir(resumo, 'conexao'):
+            mail.login(username, password)
+            mail.select(IMAP_FOLDER)  # READ-WRITE
+
+        uidvalidity = _imap_uidvalidity(mail, IMAP_FOLDER)
+        estado, criado = ImapSyncState.objects.get_or_create(account=user, folder=IMAP_FOLDER)
+
+        # Com o estado já gravado, incremental mesmo com last_uid 0 (nada
+        # processado ainda): a janela de 5 dias é só para a primeira execução
+        if not criado and estado.uidvalidity == uidvalidity:
+            # Incremental: apenas UIDs acima do último processado
+            search_query = f"UID {estado.last_uid + 1}:*"
+            ultimo_uid = estado.last_uid
+        else:
+            if estado.uidvalidity is not None:
+                print(f"🔄 [{username}] UIDVALIDITY mudou ({estado.uidvalidity} -> {uidvalidity}); varredura completa.")
+            # Busca todos os e-mails no período
+            search_query = f'(SINCE "{inicio}" BEFORE "{amanha}")'
+            ultimo_uid = 0
+
+        with medir(resumo, 'busca'):
+            status, data = mail.uid("SEARCH", None, search_query)
         if status != "OK":
-            print(f"⚠️  [{username}] Falha na busca: {status}")
-            mail.logout()
-
-        ids = data[0].split()
-        print(f"🔍 [{username}] Encontrados {len(ids)} e-mails no período {inicio} .. {amanha} (inclui o hoje).")
-
-        emails_processados = 0
-        emails_apagados = 0
-
-        for num in ids[:max_emails]:
-            tudo_ok = True
-            encontrou_xml = False
-
-            try:
-                status, fetch_data = mail.fetch(num, "(RFC822)")
-                if status != "OK":
-                    print(f"⚠️  Falha ao buscar e-mail id {num.decode()}: {status}")
-                    tudo_ok = False
-                    continue
+            raise imaplib.IMAP4.error(f"[{username}] Falha na busca: {status}")
 
-                raw_email = fetch_data[0][1]
-                msg = email.message_from_bytes(raw_email, policy=policy.default)
+        # "UID n:*" sempre devolve ao menos o maior UID da pasta, mesmo se < n
+        uids = sorted(u for u in (int(x) for x in data[0].split()) if u > ultimo_uid)
+        resumo['encontrados'] = len(uids)
+        print(f"🔍 [{username}] Encontrados {len(uids)} e-mails novos ({search_query}).")
 
-                assunto = msg.get('subject', '(sem assunto)')
-                remetente = msg.get('from', '')
-                # tentar normalizar a data do header Date
-                date_hdr = msg.get('Date')
-                received_at = parse_email_date(date_hdr)
+        # O watermark só avança enquanto não houver falha de FETCH, para que a
+        # mensagem não lida seja buscada de novo na próxima execução.
+        watermark_bloqueado = False
 
-                for part in msg.iter_attachments():
-                    filename = part.get_filename()
-                    if not filename:
+        try:
+            # Um FETCH por lote de UIDs (e não por mensagem) e um único STORE
+            # com os UIDs processados com sucesso em cada lote.
+            for lote in _em_lotes(uids[:max_emails], settings.IMAP_FETCH_BATCH):
+                if _interrompida(user, cancelar, resumo):
+                    break
+                with medir(resumo, 'download'):
+                    mensagens = _buscar_lote_imap(mail, lote)
+                resumo['bytes'] += sum(len(a['payload_bytes'] or b"") for _, anexos in mensagens.values() for a in anexos)
+                mensagens = {uid: (headers, expandir_anexos(anexos)) for uid, (headers, anexos) in mensagens.items()}
+                contextos = {uid: _contexto_email(headers) for uid, (headers, _) in mensagens.items()}
+                por_mensagem = [(contextos[uid], anexos) for uid, (_, anexos) in mensagens.items()]
+                _processar_anexos(user, por_mensagem, resumo)
+                apagar = []
+                ultimo_uid_lote = ultimo_uid
+
+                for uid in lote:
+                    if uid not in mensagens:
+                        print(f"⚠️  Falha ao buscar e-mail UID {uid}.")
+                        watermark_bloqueado = True
                         continue
 
-                    if filename.lower().endswith(".xml"):
-                        encontrou_xml = True
-                        mime_type = part.get_content_type()  # ex.: application/xml
-                        payload_bytes = None
-                        size_bytes = None
-
-                        try:
-                            payload_bytes = part.get_payload(decode=True) or b""
-                            size_bytes = len(payload_bytes) if payload_bytes else 0
-
-                            # Decodifica como UTF-8 com replace (não quebra por caracteres inválidos)
-                            xml_content = payload_bytes.decode("utf-8", errors="replace")
-
-                            # Validação mínima para DE
-                            if "<DE Id=" in xml_content:
-                                # -> Chame seu parser/gravador aqui
-                                doc, created = processar_nfe_xml(xml_content, user)
-                                if created:
-                                    print(f"✅ [{username}] {assunto} -> Documento {doc.cdc} criado com sucesso.")
-                                else:
-                                    print(f"⚠️ [{username}] {assunto} -> Documento {doc.cdc} já existia.")
-                            else:
-                                print(f"⏩ {filename} ignorado: não é um DE válido.")
-
-                        except Exception as e:
-                            tudo_ok = False
-                            print(f"\n❌ Erro ao processar '{filename}' do e-mail: {assunto}")
-                            print(f"➡️  Erro: {e}")
-
-                            # 1) Salva o XML bruto em disco (bytes) para análise
-                            try:
-                                os.makedirs("xmls_erros", exist_ok=True)
-                                with open(os.path.join("xmls_erros", filename), "wb") as f:
-                                    if payload_bytes:
-                                        f.write(payload_bytes)
-                                print(f"📝 XML com erro salvo: xmls_erros/{filename}")
-                            except Exception as file_error:
-                                print(f"⚠️ Falha ao salvar XML com erro: {file_error}")
-
-                            # 2) Registra no banco via helper simples
-                            try:
-                                save_xml_error_simple(
-                                    account=user,
-                                    subject=assunto,
-                                    received_from=remetente,
-                                    received_at=received_at,
-                                    filename=filename,
-                                    mime_type=mime_type,
-                                    payload_bytes=payload_bytes,
-                                    xml_text=None,   # falhou decodificação/parse -> None
-                                    err=e,
-                                    size_bytes=size_bytes,
-                                )
-                            except Exception as db_error:
-                                print(f"⚠️ Falha ao registrar erro no banco: {db_error}")
-
-                # Se não encontrou nenhum XML, não apaga — apenas informa e segue
-                if not encontrou_xml:
-                    print(f"📎 [{username}] E-mail '{assunto}' sem anexos XML. Ignorado.")
-                    tudo_ok = False  # não apagar
-
-                # Decisão de apagar: somente se tudo_ok e houve XML
-                if tudo_ok and encontrou_xml:
-                    mail.store(num, '+FLAGS', '\\Deleted')
-                    emails_apagados += 1
+                    _, anexos = mensagens[uid]
+                    if _processar_mensagem_email(user, contextos[uid], anexos, resumo):
+                        apagar.append(uid)
+                    if not watermark_bloqueado:
+                        ultimo_uid_lote = uid
 
-                emails_processados += 1
+                if apagar:
+                    mail.uid("STORE", compactar_uids(apagar), "+FLAGS.SILENT", "(\\Deleted)")
+                    resumo['apagados'] += len(apagar)
+                ultimo_uid = ultimo_uid_lote
+        finally:
+            estado.uidvalidity = uidvalidity
+            estado.last_uid = ultimo_uid
+            estado.save(update_fields=['uidvalidity', 'last_uid', 'updated_at'])
 
-            except Exception as e:
-                print(f"🚫 Erro inesperado ao processar e-mail id {num.decode()}: {e}")
+        emails_processados = resumo['processados']
+        emails_apagados = resumo['apagados']
 
         # Remove definitivamente os marcados
         if emails_apagados > 0:
             mail.expunge()
 
         mail.close()
-        mail.logout()
         print(f"📊 [{username}] Processados {emails_processados} e-mails; apagados {emails_apagados}.")
 
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+    return resumo
+
+def _imap_uidvalidity(mail, folder):
+    """
+    UIDVALIDITY da pasta selecionada. Usa a resposta do SELECT e, se o servidor
+    não a enviou, consulta via STATUS.
+    """
+    _, data = mail.response("UIDVALIDITY")
+    if data and data[-1]:
+        return int(data[-1])
+
+    status, data = mail.status(folder, "(UIDVALIDITY)")
+    match = re.search(rb"UIDVALIDITY (\d+)", data[0] or b"") if status == "OK" else None
+    if not match:
+        raise imaplib.IMAP4.error(f"UIDVALIDITY não disponível para a pasta {folder}")
+    return int(match.group(1))
+
+def _processar_anexos(user, por_mensagem, resumo):
+    """
+    Enfileira (EMAIL_INGEST_STAGING) ou processa os anexos de um lote de
+    mensagens, somando o tempo de parse e de gravação no resumo da conta.
+    """
+    if settings.EMAIL_INGEST_STAGING:
+        # Só enfileira; parse e gravação ficam com os consumidores
+        with medir(resumo, 'gravacao'):
+            resumo['enfileirados'] += enfileirar_anexos(user, por_mensagem)
+        return
+
+    with medir(resumo, 'gravacao'):
+        indice = indice_anexos(anexo for _, anexos in por_mensagem for anexo in anexos)
+    processar_anexos_lote(user, por_mensagem, indice, resumo=resumo)
+    with medir(resumo, 'gravacao'):
+        gravar_indice_anexos(indice)
+
+def _em_lotes(itens, tamanho):
+    for i in range(0, len(itens), max(1, tamanho)):
+        yield itens[i:i + tamanho]
+
+def _contexto_email(headers):
+    """
+    Assunto, remetente e data de recebimento (para log e registro de erros).
+    """
+    try:
+        return {
+            'assunto': headers.get('subject', '(sem assunto)'),
+            'remetente': headers.get('from', ''),
+            # tentar normalizar a data do header Date
+            'received_at': parse_email_date(headers.get('Date')),
+        }
+    except Exception as e:
+        print(f"⚠️ Cabeçalhos inválidos: {e}")
+        return {'assunto': '(sem assunto)', 'remetente': '', 'received_at': None}
+
+def _processar_mensagem_email(user, contexto, anexos, resumo):
+    """
+    Decide o destino de uma mensagem cujos anexos já passaram por
+    _processar_anexos. Devolve True se a mensagem deve ser apagada (havia
+    XML e todos foram tratados sem erro). Anexos já processados antes (mesmo
+    hash) contam como duplicados.
+    """
+    username = user.username
+    tudo_ok = True
+    assunto = contexto['assunto']
+
+    try:
+        for anexo in anexos:
+            situacao = anexo.get('situacao')
+            if situacao == ANEXO_ERRO:
+                resumo['erros'] += 1
+                tudo_ok = False
+            elif situacao == ANEXO_DUPLICADO:
+                resumo['duplicados'] += 1
+
+        encontrou_xml = bool(anexos)
+
+        # Se não encontrou nenhum XML, não apaga — apenas informa e segue
+        if not encontrou_xml:
+            print(f"📎 [{username}] E-mail '{assunto}' sem anexos XML. Ignorado.")
+            tudo_ok = False  # não apagar
+
+        resumo['processados'] += 1
+
+        # Decisão de apagar: somente se tudo_ok e houve XML
+        return tudo_ok and encontrou_xml
+
     except Exception as e:
-        print(f"🚫 Erro ao conectar ou processar e-mails de {username}: {e}")
+        print(f"🚫 Erro inesperado ao processar e-mail '{assunto}': {e}")
+        return False
 
-def leitor_email_graph(user, max_emails=200):
+def _buscar_lote_imap(mail, uids):
+    """
+    Baixa cabeçalhos e partes XML de um lote de mensagens com poucos round trips:
+    um UID FETCH do BODYSTRUCTURE (junto com Subject/From/Date) para o lote todo
+    e um UID FETCH BODY.PEEK[<parte>] para cada combinação distinta de seções
+    (normalmente uma só, ex.: todas as mensagens com o XML na parte 2). PDFs e
+    imagens não são baixados. Mensagens cujo servidor não devolve BODYSTRUCTURE
+    caem para o FETCH completo (RFC822), também em lote.
+
+    Devolve {uid: (headers, anexos)} — anexos como dicts com filename,
+    mime_type e payload_bytes, ainda compactados (ver expandir_anexos). UIDs
+    ausentes no resultado falharam no FETCH.
+    """
+    status, fetch_data = mail.uid("FETCH", compactar_uids(uids), f"(UID BODYSTRUCTURE {HEADER_FIELDS})")
+    if status != "OK" or not fetch_data or fetch_data[0] is None:
+        print(f"⚠️  Falha ao buscar lote de e-mails {compactar_uids(uids)}: {status}")
+        return {}
+
+    estrutura = parse_fetch_response(fetch_data)
+    mensagens = {}
+    sem_estrutura = []
+    por_secoes = {}
+
+    for uid in uids:
+        dados = estrutura.get(uid)
+        if dados is None:
+            continue
+        if 'BODYSTRUCTURE' not in dados:
+            sem_estrutura.append(uid)
+            continue
+
+        headers = email.message_from_bytes(dados.get('BODY[HEADER]') or b"", policy=policy.default)
+        partes = listar_partes_xml(dados['BODYSTRUCTURE'])
+        mensagens[uid] = (headers, partes)
+        if partes:
+            secoes = tuple(parte['secao'] for parte in partes)
+            por_secoes.setdefault(secoes, []).append(uid)
+
+    for secoes, grupo in por_secoes.items():
+        itens = " ".join(f"BODY.PEEK[{secao}]" for secao in secoes)
+        status, fetch_data = mail.uid("FETCH", compactar_uids(grupo), f"(UID {itens})")
+        conteudo = parse_fetch_response(fetch_data) if status == "OK" and fetch_data else {}
+
+        for uid in grupo:
+            headers, partes = mensagens[uid]
+            dados = conteudo.get(uid)
+            if dados is None:
+                del mensagens[uid]
+                continue
+            anexos = [
+                {
+                    'filename': parte['filename'],
+                    'mime_type': parte['mime_type'],
+                    'payload_bytes': decodificar_parte(dados.get(f"BODY[{parte['secao']}]"), parte['encoding']),
+                }
+                for parte in partes
+            ]
+            mensagens[uid] = (headers, anexos)
+
+    if sem_estrutura:
+        mensagens.update(_buscar_lote_rfc822(mail, sem_estrutura))
+
+    return mensagens
+
+def _buscar_lote_rfc822(mail, uids):
+    """
+    Caminho antigo: baixa as mensagens inteiras e extrai os anexos .xml e os
+    compactados (.zip / .gz).
+    """
+    status, fetch_data = mail.uid("FETCH", compactar_uids(uids), "(UID RFC822)")
+    if status != "OK" or not fetch_data or fetch_data[0] is None:
+        return {}
+
+    mensagens = {}
+    for uid, dados in parse_fetch_response(fetch_data).items():
+        if not dados.get('RFC822'):
+            continue
+        msg = email.message_from_bytes(dados['RFC822'], policy=policy.default)
+        anexos = []
+        for part in msg.iter_attachments():
+            filename = part.get_filename()
+            if filename and (filename.lower().endswith(".xml") or eh_compactado(filename, part.get_content_type())):
+                anexos.append({
+                    'filename': filename,
+                    'mime_type': part.get_content_type(),  # ex.: application/xml
+                    'payload_bytes': part.get_payload(decode=True) or b"",
+                })
+        mensagens[uid] = (msg, anexos)
+    return mensagens
+
+def leitor_email_graph(user, max_emails=200, execucao_id=None, cancelar=None):
     """
     Versão Microsoft Graph da função leitor_email_box.
     Busca e-mails dos últimos 5 dias, processa anexos .xml e apaga os processados.
+    Devolve o resumo da conta (ver novo_resumo).
+
+    Com GRAPH_DELTA_SYNC ativo usa a delta query da Inbox: a primeira execução
+    parte da janela de 5 dias e as seguintes, do deltaLink salvo na conta,
+    trazem só as mensagens novas. As páginas (@odata.nextLink) são lidas até
+    somar `max_emails` mensagens; o restante continua do nextLink salvo na
+    próxima execução.
+
+    Como no IMAP, a leitura é registrada em uma IngestRunAccount da execução
+    `execucao_id`.
     """
+    resumo = novo_resumo(user)
+    with registrar_conta_execucao(execucao_id, resumo):
+        return _ler_caixa_graph(user, max_emails, resumo, cancelar)
+
+def _ler_caixa_graph(user, max_emails, resumo, cancelar=None):
     hoje = datetime.utcnow()
     inicio = (hoje - timedelta(days=5)).isoformat() + "Z"
     amanha = (hoje + timedelta(days=1)).isoformat() + "Z"
 
-    token = get_graph_token(user.office365_tenant_id, user.office365_client_id, user.office365_client_secret)
-    headers = {"Authorization": f"Bearer {token}"}
+    with medir(resumo, 'conexao'):
+        cliente = GraphClient.para_conta(user)
+        cliente.token()
 
     print(f"📥 Lendo e-mails de {user.username} via Microsoft Graph...")
 
-    # Busca e-mails recentes da Inbox
-    url = (
-        f"https://graph.microsoft.com/v1.0/users/{user.username}/mailFolders/inbox/messages"
-        f"?$filter=receivedDateTime ge {inicio} and receivedDateTime lt {amanha}"
-        f"&$top={max_emails}&$select=id,subject,from,receivedDateTime,hasAttachments"
-    )
-
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"⚠️ Erro ao buscar mensagens: {response.text}")
-        return
-
-    emails = response.json().get("value", [])
+    delta_link = None
+    with medir(resumo, 'busca'):
+        if settings.GRAPH_DELTA_SYNC:
+            emails, delta_link = _listar_mensagens_graph_delta(user, cliente, inicio, max_emails)
+        else:
+            # Busca e-mails recentes da Inbox
+            url = (
+                f"/users/{user.username}/mailFolders/inbox/messages"
+                f"?$filter=receivedDateTime ge {inicio} and receivedDateTime lt {amanha}"
+                f"&$top={max_emails}&$select={GRAPH_SELECT}"
+            )
+            emails = []
+            for pagina in cliente.paginas(url):
+                emails.extend(pagina.get("value", []))
+                if len(emails) >= max_emails:
+                    break
+            emails = emails[:max_emails]
+
+    resumo['encontrados'] = len(emails)
     print(f"🔍 [{user.username}] Encontrados {len(emails)} e-mails no período.")
 
     emails_processados = 0
     emails_apagados = 0
+    duplicados = 0
+    mover = []
+
+    # Anexos buscados via $batch: uma chamada para cada 20 mensagens
+    for lote in _em_lotes(emails, GRAPH_BATCH_MAX):
+        if _interrompida(user, cancelar, resumo):
+            # Mensagens restantes voltam na próxima execução (link anterior mantido)
+            delta_link = None
+            break
+        com_anexos = [msg for msg in lote if msg.get("hasAttachments")]
+        anexos_por_msg = {}
+        with medir(resumo, 'download'):
+            anexos_resp = cliente.batch([
+                {"id": str(i), "method": "GET", "url": f"/users/{user.username}/messages/{msg['id']}/attachments"}
+                for i, msg in enumerate(com_anexos)
+            ])
+            respostas = {msg["id"]: anexos_resp.get(str(i)) or {} for i, msg in enumerate(com_anexos)}
+            for msg_id, resp in respostas.items():
+                if resp.get("status") != 200:
+                    continue
+                try:
+                    anexos_por_msg[msg_id] = _anexos_xml_graph(resp)
+                except Exception as e:
+                    print(f"🚫 Erro ao decodificar anexos do e-mail {msg_id}: {e}")
+        resumo['bytes'] += sum(len(a['payload_bytes']) for anexos in anexos_por_msg.values() for a in anexos)
+        anexos_por_msg = {msg_id: expandir_anexos(anexos) for msg_id, anexos in anexos_por_msg.items()}
+        contextos = {msg["id"]: _contexto_graph(msg) for msg in lote}
+        por_mensagem = [(contextos[msg_id], anexos) for msg_id, anexos in anexos_por_msg.items()]
+        _processar_anexos(user, por_mensagem, resumo)
+
+        for msg in lote:
+            try:
+                assunto = contextos[msg["id"]]['assunto']
+                tudo_ok = True
 
-    for msg in emails:
-        try:
-            assunto = msg.get("subject", "(sem assunto)")
-            remetente = msg.get("from", {}).get("emailAddress", {}).get("address", "")
-            received_at = msg.get("receivedDateTime")
-            encontrou_xml = False
-            tudo_ok = True
-
-            if not msg.get("hasAttachments"):
-                print(f"📎 [{user.username}] '{assunto}' sem anexos XML. Ignorado.")
-                continue
-
-            msg_id = msg["id"]
-            attach_url = f"https://graph.microsoft.com/v1.0/users/{user.username}/messages/{msg_id}/attachments"
-            attach_resp = requests.get(attach_url, headers=headers)
-
-            if attach_resp.status_code != 200:
-                print(f"⚠️ Erro ao buscar anexos: {attach_resp.text}")
-                continue
-
-            attachments = attach_resp.json().get("value", [])
-            for att in attachments:
-                filename = att.get("name")
-                if not filename or not filename.lower().endswith(".xml"):
+                if not msg.get("hasAttachments"):
+                    print(f"📎 [{user.username}] '{assunto}' sem anexos XML. Ignorado.")
                     continue
 
-                encontrou_xml = True
-                mime_type = att.get("contentType", "application/xml")
-                payload_bytes = base64.b64decode(att.get("contentBytes", ""))
-                size_bytes = len(payload_bytes)
-                xml_content = payload_bytes.decode("utf-8", errors="replace")
+                msg_id = msg["id"]
+                if msg_id not in anexos_por_msg:
+                    if respostas.get(msg_id, {}).get("status") != 200:
+                        print(f"⚠️ Erro ao buscar anexos: {respostas.get(msg_id, {}).get('body')}")
+                    continue
 
-                try:
-                    if "<DE Id=" in xml_content:
-                        doc, created = processar_nfe_xml(xml_content, user)
-                        if created:
-                            print(f"✅ [{user.username}] {assunto} -> Documento {doc.cdc} criado com sucesso.")
-                        else:
-                            print(f"⚠️ [{user.username}] {assunto} -> Documento {doc.cdc} já existia.")
-                    else:
-                        print(f"⏩ {filename} ignorado: não é um DE válido.")
+                anexos = anexos_por_msg[msg_id]
+                encontrou_xml = bool(anexos)
+                for anexo in anexos:
+                    if anexo['situacao'] == ANEXO_DUPLICADO:
+                        duplicados += 1
+                    elif anexo['situacao'] == ANEXO_ERRO:
+                        resumo['erros'] += 1
+                        tudo_ok = False
+                    elif anexo['situacao'] not in (ANEXO_OK, ANEXO_ENFILEIRADO):
+                        # No Graph, XML que não é DE também impede a remoção
                         tudo_ok = False
 
-                except Exception as e:
-                    tudo_ok = False
-                    print(f"❌ Erro ao processar {filename}: {e}")
-                    try:
-                        os.makedirs("xmls_erros", exist_ok=True)
-                        with open(os.path.join("xmls_erros", filename), "wb") as f:
-                            f.write(payload_bytes)
-                        print(f"📝 XML com erro salvo: xmls_erros/{filename}")
-                    except Exception as fe:
-                        print(f"⚠️ Falha ao salvar XML com erro: {fe}")
-
-                    try:
-                        save_xml_error_simple(
-                            account=user,
-                            subject=assunto,
-                            received_from=remetente,
-                            received_at=received_at,
-                            filename=filename,
-                            mime_type=mime_type,
-                            payload_bytes=payload_bytes,
-                            xml_text=None,
-                            err=e,
-                            size_bytes=size_bytes,
-                        )
-                    except Exception as dbe:
-                        print(f"⚠️ Falha ao registrar erro no banco: {dbe}")
-
-            # Move para “Itens Excluídos” se processou com sucesso
-            if tudo_ok and encontrou_xml:
-                move_url = f"https://graph.microsoft.com/v1.0/users/{user.username}/messages/{msg_id}/move"
-                move_data = {"destinationId": "deleteditems"}
-                move_resp = requests.post(move_url, headers=headers, json=move_data)
-                if move_resp.status_code == 201:
-                    emails_apagados += 1
-                else:
-                    print(f"⚠️ Falha ao mover para lixeira: {move_resp.text}")
-
-            emails_processados += 1
+                # Move para “Itens Excluídos” se processou com sucesso (em lote, abaixo)
+                if tudo_ok and encontrou_xml:
+                    mover.append(msg_id)
 
-        except Exception as e:
-            print(f"🚫 Erro inesperado ao processar e-mail: {e}")
+                emails_processados += 1
+
+            except Exception as e:
+                print(f"🚫 Erro inesperado ao processar e-mail: {e}")
+
+    if mover:
+        movidos = cliente.batch([
+            {
+                "id": str(i),
+                "method": "POST",
+                "url": f"/users/{user.username}/messages/{msg_id}/move",
+                "body": {"destinationId": "deleteditems"},
+            }
+            for i, msg_id in enumerate(mover)
+        ])
+        for sub in movidos.values():
+            if sub.get("status") == 201:
+                emails_apagados += 1
+            else:
+                print(f"⚠️ Falha ao mover para lixeira: {sub.get('body')}")
 
     print(f"📊 [{user.username}] Processados {emails_processados}; apagados {emails_apagados}.")
+
+    # Só avança o estado da delta query (deltaLink, ou o nextLink onde a leitura
+    # parou no limite de mensagens) depois de processar tudo
+    if delta_link:
+        User.objects.filter(pk=user.pk).update(office365_delta_link=delta_link)
+        user.office365_delta_link = delta_link
+
+    resumo['processados'] = emails_processados
+    resumo['apagados'] = emails_apagados
+    resumo['duplicados'] = duplicados
+    return resumo
+
+def _contexto_graph(msg):
+    return {
+        'assunto': msg.get("subject", "(sem assunto)"),
+        'remetente': (msg.get("from") or {}).get("emailAddress", {}).get("address", ""),
+        'received_at': msg.get("receivedDateTime"),
+    }
+
+def _anexos_xml_graph(resposta):
+    """
+    Anexos .xml e compactados .zip / .gz (decodificados do base64, ainda sem
+    expandir) da resposta de /messages/{id}/attachments.
+    """
+    anexos = []
+    for att in (resposta.get("body") or {}).get("value", []):
+        filename = att.get("name")
+        content_type = att.get("contentType")
+        if not filename or not (filename.lower().endswith(".xml") or eh_compactado(filename, content_type)):
+            continue
+        anexos.append({
+            'filename': filename,
+            'mime_type': content_type or "application/xml",
+            'payload_bytes': base64.b64decode(att.get("contentBytes", "")),
+        })
+    return anexos
+
+def _listar_mensagens_graph_delta(user, cliente, inicio, max_emails):
+    """
+    Lista as mensagens novas da Inbox via delta query. Sem deltaLink salvo (ou
+    se o Graph o rejeitar por expiração), começa uma nova sincronização a partir
+    de `inicio`. Devolve (mensagens, link a salvar na conta): o deltaLink da
+    última página ou, se a leitura parou em `max_emails`, o nextLink da página
+    seguinte, de onde a próxima execução continua.
+    """
+    prefer = {"Prefer": f"odata.maxpagesize={max(1, min(settings.GRAPH_PAGE_SIZE, max_emails))}"}
+    url_inicial = (
+        f"/users/{user.username}/mailFolders/inbox/messages/delta"
+        f"?$filter=receivedDateTime ge {inicio}&$select={GRAPH_SELECT}"
+    )
+    url = user.office365_delta_link or url_inicial
+
+    try:
+        return _coletar_delta(cliente, url, prefer, max_emails)
+    except requests.HTTPError as e:
+        # 410 Gone / syncStateNotFound: o estado da delta expirou
+        status = e.response.status_code if e.response is not None else None
+        if not user.office365_delta_link or status not in (400, 404, 410):
+            raise
+        print(f"🔄 [{user.username}] deltaLink inválido ({status}); reiniciando a sincronização.")
+        return _coletar_delta(cliente, url_inicial, prefer, max_emails)
+
+def _coletar_delta(cliente, url, prefer, max_emails):
+    mensagens = []
+    for pagina in cliente.paginas(url, headers=prefer):
+        # Itens removidos/movidos vêm marcados com @removed
+        mensagens.extend(m for m in pagina.get("value", []) if "@removed" not in m)
+        if pagina.get("@odata.deltaLink"):
+            return mensagens, pagina["@odata.deltaLink"]
+        if len(mensagens) >= max_emails and pagina.get("@odata.nextLink"):
+            # Páginas são processadas inteiras; o resto da rodada fica para a próxima execução
+            print(f"⏭️ Limite de {max_emails} e-mails; o restante fica para a próxima execução.")
+            return mensagens, pagina["@odata.nextLink"]
+    return mensagens, None
@@ -0,0 +1,119 @@
+import time
+from contextlib import contextmanager
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from documentos.metricas import observar_etapa, registrar_conta
+from documentos.models import IngestRun, IngestRunAccount
+
+# Etapas cronometradas em resumo['tempos'] -> campos de IngestMetricas
+ETAPAS = {
+    'conexao': 'connect_seconds',
+    'busca': 'search_seconds',
+    'download': 'fetch_seconds',
+    'parse': 'parse_seconds',
+    'gravacao': 'db_seconds',
+}
+
+# Contagens do resumo da conta (ver email_reader.novo_resumo) -> campos
+CONTADORES = {
+    'encontrados': 'messages_found',
+    'processados': 'messages_processed',
+    'apagados': 'messages_deleted',
+    'bytes': 'bytes_downloaded',
+    'criados': 'documents_created',
+    'duplicados': 'duplicates',
+    'enfileirados': 'queued',
+    'erros': 'errors',
+}
+
+
+def novos_tempos():
+    return {etapa: 0.0 for etapa in ETAPAS}
+
+@contextmanager
+def medir(resumo, etapa):
+    """
+    Soma em resumo['tempos'][etapa] o tempo gasto dentro do bloco (e o observa
+    no histograma do Prometheus). Sem resumo (None), não mede nada.
+    """
+    if resumo is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        decorrido = time.perf_counter() - inicio
+        tempos = resumo.setdefault('tempos', novos_tempos())
+        tempos[etapa] = tempos.get(etapa, 0.0) + decorrido
+        observar_etapa(resumo, etapa, decorrido)
+
+def iniciar_execucao(engine):
+    """
+    Cria a IngestRun de uma leitura de e-mails e devolve o id (None se não foi
+    possível gravar: o registro nunca interrompe a leitura).
+    """
+    try:
+        return IngestRun.objects.create(engine=engine).pk
+    except Exception as e:
+        print(f"⚠️ Falha ao registrar execução da leitura: {e}")
+        return None
+
+@contextmanager
+def registrar_conta_execucao(execucao_id, resumo):
+    """
+    Envolve a leitura de uma conta e, ao sair (com ou sem exceção), grava a
+    IngestRunAccount com as contagens e os tempos do resumo. Sem execução
+    (leitura avulsa, ex.: testar_email), cria uma IngestRun só para a conta.
+    """
+    inicio = timezone.now()
+    try:
+        yield resumo
+    except Exception as e:
+        resumo['erro'] = resumo.get('erro') or str(e)
+        raise
+    finally:
+        registrar_conta(resumo)
+        try:
+            avulsa = execucao_id is None
+            if avulsa:
+                execucao_id = IngestRun.objects.create(engine='avulsa', started_at=inicio).pk
+            IngestRunAccount.objects.create(
+                run_id=execucao_id,
+                account_id=resumo['conta_id'],
+                started_at=inicio,
+                finished_at=timezone.now(),
+                error=resumo.get('erro') or '',
+                **_campos_do_resumo(resumo),
+            )
+            if avulsa:
+                finalizar_execucao(execucao_id)
+        except Exception as e:
+            print(f"⚠️ [{resumo.get('conta')}] Falha ao registrar a leitura da conta: {e}")
+
+def finalizar_execucao(execucao_id):
+    """
+    Fecha a IngestRun: soma as contagens e tempos das contas e grava o fim.
+    """
+    if execucao_id is None:
+        return
+    try:
+        # accounts_failed: contas com alguma tentativa com erro
+        campos = list(CONTADORES.values()) + list(ETAPAS.values())
+        totais = IngestRunAccount.objects.filter(run_id=execucao_id).aggregate(
+            accounts=Count('account', distinct=True),
+            accounts_failed=Count('account', distinct=True, filter=~Q(error='')),
+            **{campo: Sum(campo) for campo in campos},
+        )
+        IngestRun.objects.filter(pk=execucao_id).update(
+            finished_at=timezone.now(),
+            **{campo: valor or 0 for campo, valor in totais.items()},
+        )
+    except Exception as e:
+        print(f"⚠️ Falha ao finalizar o registro da execução {execucao_id}: {e}")
+
+def _campos_do_resumo(resumo):
+    campos = {campo: resumo.get(chave) or 0 for chave, campo in CONTADORES.items()}
+    tempos = resumo.get('tempos') or {}
+    campos.update({campo: round(tempos.get(etapa, 0.0), 6) for etapa, campo in ETAPAS.items()})
+    return campos
@@ -1,4 +1,3 @@
-import xml.etree.ElementTree as ET
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm, mm # Import mm for easier conversion
@@ -14,6 +13,7 @@ from PIL import Image # pip install Pillow
 import base64
 import qrcode # pip install qrcode
 import re # For regex operations like cdcprinc.match(/.{1,4}/g)
+from documentos.sifen import fromstring, localizar, localizar_todos
 from functools import partial # Importar partial para passar argumentos adicionais
 
 # Django Rest Framework imports
@@ -301,8 +301,9 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
     """
     Gera o PDF para um documento de Fatura Eletrônica.
     """
-    NS = {'sifen': 'http://ekuatia.set.gov.py/sifen/xsd'}
-    xml_root = ET.fromstring(xml_content)
+    xml_root = fromstring(xml_content)
+    # Buscas relativas ao DE; com o backend lxml, XPath compilado (sifen.localizar)
+    de = localizar(xml_root, "ns:DE")
 
     buffer = BytesIO()
     # Definindo as margens para dar espaço aos elementos fixos do cabeçalho
@@ -381,53 +382,53 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
     data_extracted = {}
 
     # Emisor
-    data_extracted['dDesActEco'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:gActEco/sifen:dDesActEco", NS))
-    data_extracted['dEmailE'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dEmailE", NS))
-    data_extracted['dTelEmi'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dTelEmi", NS))
-    data_extracted['dDirEmi'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dDirEmi", NS))
-    data_extracted['dDesDepEmi'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dDesDepEmi", NS))
-    data_extracted['dDesDisEmi'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dDesDisEmi", NS))
+    data_extracted['dDesActEco'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:gActEco/ns:dDesActEco"))
+    data_extracted['dEmailE'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dEmailE"))
+    data_extracted['dTelEmi'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dTelEmi"))
+    data_extracted['dDirEmi'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dDirEmi"))
+    data_extracted['dDesDepEmi'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dDesDepEmi"))
+    data_extracted['dDesDisEmi'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dDesDisEmi"))
 
     # Segundo Cuadro (Timbrado)
-    data_extracted['dNumTim'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dNumTim", NS))
-    data_extracted['dFeIniT'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dFeIniT", NS))
-    data_extracted['dRucEm'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dRucEm", NS))
-    data_extracted['dDVEmi'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gEmis/sifen:dDVEmi", NS))
-    data_extracted['dFeEmiDE'] = formatar_data(get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:dFeEmiDE", NS)))
-    data_extracted['dDesTiDE'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dDesTiDE", NS)).replace("&#xF3;", "ó")
-    data_extracted['dEst'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dEst", NS))
-    data_extracted['dPunExp'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dPunExp", NS))
-    data_extracted['dNumDoc'] = get_xml_text(xml_root.find("sifen:DE/sifen:gTimb/sifen:dNumDoc", NS))
+    data_extracted['dNumTim'] = get_xml_text(localizar(de, "ns:gTimb/ns:dNumTim"))
+    data_extracted['dFeIniT'] = get_xml_text(localizar(de, "ns:gTimb/ns:dFeIniT"))
+    data_extracted['dRucEm'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dRucEm"))
+    data_extracted['dDVEmi'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gEmis/ns:dDVEmi"))
+    data_extracted['dFeEmiDE'] = formatar_data(get_xml_text(localizar(de, "ns:gDatGralOpe/ns:dFeEmiDE")))
+    data_extracted['dDesTiDE'] = get_xml_text(localizar(de, "ns:gTimb/ns:dDesTiDE")).replace("&#xF3;", "ó")
+    data_extracted['dEst'] = get_xml_text(localizar(de, "ns:gTimb/ns:dEst"))
+    data_extracted['dPunExp'] = get_xml_text(localizar(de, "ns:gTimb/ns:dPunExp"))
+    data_extracted['dNumDoc'] = get_xml_text(localizar(de, "ns:gTimb/ns:dNumDoc"))
 
     # Tercer Cuadro (Receptor)
-    iNatRec = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:iNatRec", NS))
-    data_extracted['dNomRec'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dNomRec", NS))
-    data_extracted['dNomFanRec'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dNomFanRec", NS))
-    data_extracted['dCodCliente'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dCodCliente", NS))
-    data_extracted['dDirRec'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dDirRec", NS))
-    dRucRec = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dRucRec", NS))
-    dDVRec = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dDVRec", NS))
-    dNumIDRec = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dNumIDRec", NS))
-    data_extracted['dTelRec'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dTelRec", NS))
-    data_extracted['dDesCiuRec'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gDatRec/sifen:dDesCiuRec", NS))
-    data_extracted['dDesTipTra'] = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gOpeCom/sifen:dDesTipTra", NS))
+    iNatRec = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:iNatRec"))
+    data_extracted['dNomRec'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dNomRec"))
+    data_extracted['dNomFanRec'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dNomFanRec"))
+    data_extracted['dCodCliente'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dCodCliente"))
+    data_extracted['dDirRec'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dDirRec"))
+    dRucRec = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dRucRec"))
+    dDVRec = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dDVRec"))
+    dNumIDRec = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dNumIDRec"))
+    data_extracted['dTelRec'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dTelRec"))
+    data_extracted['dDesCiuRec'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gDatRec/ns:dDesCiuRec"))
+    data_extracted['dDesTipTra'] = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gOpeCom/ns:dDesTipTra"))
 
     data_extracted['numero_documento'] = f"{dRucRec}-{dDVRec}" if dRucRec and dDVRec else dNumIDRec
 
     # Condição de Venda
-    iCondOpe = get_xml_text(xml_root.find("sifen:DE/sifen:gDtipDE/sifen:gCamCond/sifen:iCondOpe", NS))
+    iCondOpe = get_xml_text(localizar(de, "ns:gDtipDE/ns:gCamCond/ns:iCondOpe"))
     data_extracted['Contado'] = 'X' if iCondOpe == "1" else ''
     data_extracted['Credito'] = 'X' if iCondOpe != "1" else ''
     
-    plazo_node = xml_root.find("sifen:gCamFuFD/sifen:dInfAdic", NS)
+    plazo_node = localizar(xml_root, "ns:gCamFuFD/ns:dInfAdic")
     plazo_text = get_xml_text(plazo_node)
     data_extracted['plazo'] = plazo_text.split('|')[3] if plazo_text and len(plazo_text.split('|')) > 3 else ''
     if iCondOpe == "2": # Credito
-        plazo_cred_node = xml_root.find("sifen:DE/sifen:gDtipDE/sifen:gCamCond/sifen:gPagCred/sifen:dPlazoCre", NS)
+        plazo_cred_node = localizar(de, "ns:gDtipDE/ns:gCamCond/ns:gPagCred/ns:dPlazoCre")
         data_extracted['plazo'] = get_xml_text(plazo_cred_node)
 
     # Moeda
-    codigo_moneda = get_xml_text(xml_root.find("sifen:DE/sifen:gDatGralOpe/sifen:gOpeCom/sifen:cMoneOpe", NS))
+    codigo_moneda = get_xml_text(localizar(de, "ns:gDatGralOpe/ns:gOpeCom/ns:cMoneOpe"))
     data_extracted['Simbolo'] = 'Gs'
     data_extracted['CantidadDeDecimales'] = 0
     data_extracted['DescripcionMoneda'] = 'GUARANI '
@@ -437,13 +438,13 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
         data_extracted['DescripcionMoneda'] = 'DOLAR US'
 
     # CDC e QR Code
-    cdc_princ = get_xml_attr(xml_root.find("sifen:DE", NS), 'Id')
+    cdc_princ = get_xml_attr(de, 'Id')
     data_extracted['cdc'] = " ".join(re.findall(r'.{1,4}', cdc_princ)) if cdc_princ else ''
-    dCarQR = get_xml_text(xml_root.find("sifen:gCamFuFD/sifen:dCarQR", NS))
+    dCarQR = get_xml_text(localizar(xml_root, "ns:gCamFuFD/ns:dCarQR"))
     data_extracted['qr_code_base64'] = gerar_qrcode_base64(dCarQR) if dCarQR else None
 
     # Informações Adicionais (Zona, Vendedor, OC)
-    dInfAdic = get_xml_text(xml_root.find("sifen:gCamFuFD/sifen:dInfAdic", NS))
+    dInfAdic = get_xml_text(localizar(xml_root, "ns:gCamFuFD/ns:dInfAdic"))
     data_extracted['zona'] = dInfAdic.split('|')[0] if dInfAdic and len(dInfAdic.split('|')) > 0 else ''
     data_extracted['vendedor'] = dInfAdic.split('|')[1] if dInfAdic and len(dInfAdic.split('|')) > 1 else ''
     data_extracted['oc'] = dInfAdic.split('|')[2] if dInfAdic and len(dInfAdic.split('|')) > 2 else ''
@@ -466,17 +467,17 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
     ]
     table_data = [table_headers]
 
-    items = xml_root.findall("sifen:DE/sifen:gDtipDE/sifen:gCamItem", NS)
+    items = localizar_todos(de, "ns:gDtipDE/ns:gCamItem")
 
     for item in items:
-        cod_node = item.find("sifen:dCodInt", NS)
-        desc_node = item.find("sifen:dDesProSer", NS)
-        unit_node = item.find("sifen:dDesUniMed", NS)
-        qty_node = item.find("sifen:dCantProSer", NS)
-        price_node = item.find("sifen:gValorItem/sifen:dPUniProSer", NS)
-        discount_node = item.find("sifen:gValorItem/sifen:gValorRestaItem/sifen:dDescItem", NS)
-        iva_rate_node = item.find("sifen:gCamIVA/sifen:dTasaIVA", NS)
-        total_item_value_node = item.find("sifen:gValorItem/sifen:dTotBruOpeItem", NS)
+        cod_node = localizar(item, "ns:dCodInt")
+        desc_node = localizar(item, "ns:dDesProSer")
+        unit_node = localizar(item, "ns:dDesUniMed")
+        qty_node = localizar(item, "ns:dCantProSer")
+        price_node = localizar(item, "ns:gValorItem/ns:dPUniProSer")
+        discount_node = localizar(item, "ns:gValorItem/ns:gValorRestaItem/ns:dDescItem")
+        iva_rate_node = localizar(item, "ns:gCamIVA/ns:dTasaIVA")
+        total_item_value_node = localizar(item, "ns:gValorItem/ns:dTotBruOpeItem")
 
         cod = get_xml_text(cod_node)
         desc = get_xml_text(desc_node)
@@ -494,12 +495,12 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
 
         if iva_rate == "10":
             # A JS code adds dBasGravIVA + dLiqIVAItem. Let's replicate this if available.
-            dBasGravIVA = get_float_value(item.find("sifen:gCamIVA/sifen:dBasGravIVA", NS))
-            dLiqIVAItem = get_float_value(item.find("sifen:gCamIVA/sifen:dLiqIVAItem", NS))
+            dBasGravIVA = get_float_value(localizar(item, "ns:gCamIVA/ns:dBasGravIVA"))
+            dLiqIVAItem = get_float_value(localizar(item, "ns:gCamIVA/ns:dLiqIVAItem"))
             valor_10 = formatar_valor(dBasGravIVA + dLiqIVAItem, moeda=codigo_moneda, decimal_places=data_extracted['CantidadDeDecimales'])
         elif iva_rate == "5":
-            dBasGravIVA = get_float_value(item.find("sifen:gCamIVA/sifen:dBasGravIVA", NS))
-            dLiqIVAItem = get_float_value(item.find("sifen:gCamIVA/sifen:dLiqIVAItem", NS))
+            dBasGravIVA = get_float_value(localizar(item, "ns:gCamIVA/ns:dBasGravIVA"))
+            dLiqIVAItem = get_float_value(localizar(item, "ns:gCamIVA/ns:dLiqIVAItem"))
             valor_5 = formatar_valor(dBasGravIVA + dLiqIVAItem, moeda=codigo_moneda, decimal_places=data_extracted['CantidadDeDecimales'])
         else: # PropIVA = 0 for Exenta, or no IVA rate
             exentas = formatar_valor(total_item_val, moeda=codigo_moneda, decimal_places=data_extracted['CantidadDeDecimales'])
@@ -538,16 +539,16 @@ def generate_factura_pdf(xml_content, cod_empresa, desc_empresa, ruta_logo):
 
     # --- Totais ---
     # O código JS desenha retângulos para os totais. Usaremos uma Tabela para melhor alinhamento.
-    total_subexe_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dSubExe", NS)
-    total_sub5_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dSub5", NS)
-    total_sub10_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dSub10", NS)
-
-    total_operation_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dTotOpe", NS)
-    total_guaranies_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dTotGralOpe", NS)
-    total_discount_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dTotDesc", NS)
-    total_iva_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dTotIVA", NS)
-    iva_5_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dIVA5", NS)
-    iva_10_node = xml_root.find("sifen:DE/sifen:gTotSub/sifen:dIVA10", NS)
+    total_subexe_node = localizar(de, "ns:gTotSub/ns:dSubExe")
+    total_sub5_node = localizar(de, "ns:gTotSub/ns:dSub5")
+    total_sub10_node = localizar(de, "ns:gTotSub/ns:dSub10")
+
+    total_operation_node = localizar(de, "ns:gTotSub/ns:dTotOpe")
+    total_guaranies_node = localizar(de, "ns:gTotSub/ns:dTotGralOpe")
+    total_discount_node = localizar(de, "ns:gTotSub/ns:dTotDesc")
+    total_iva_node = localizar(de, "ns:gTotSub/ns:dTotIVA")
+    iva_5_node = localizar(de, "ns:gTotSub/ns:dIVA5")
+    iva_10_node = localizar(de, "ns:gTotSub/ns:dIVA10")
 
     # Subtotal
     subtotal_data = [
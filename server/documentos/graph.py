@@ -0,0 +1,198 @@
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+GRAPH_BATCH_MAX = 20  # limite de sub-requisições por $batch
+THROTTLE_STATUS = (429, 503)
+TOKEN_MARGEM = 300  # segundos: renova o token antes de expirar
+
+_sessoes = {}
+_sessoes_lock = threading.Lock()
+
+
+def _sessao(chave):
+    """
+    Sessão HTTP (keep-alive) compartilhada por tenant dentro do processo,
+    evitando novo handshake TLS a cada chamada.
+    """
+    with _sessoes_lock:
+        sessao = _sessoes.get(chave)
+        if sessao is None:
+            sessao = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=settings.GRAPH_POOL_SIZE)
+            sessao.mount("https://", adapter)
+            _sessoes[chave] = sessao
+        return sessao
+
+def _timeout():
+    return (settings.GRAPH_CONNECT_TIMEOUT, settings.GRAPH_READ_TIMEOUT)
+
+def _retry_after(headers, padrao):
+    try:
+        return max(1, int((headers or {}).get("Retry-After", padrao)))
+    except (TypeError, ValueError):
+        return padrao
+
+def _cache_get(chave):
+    try:
+        return cache.get(chave)
+    except Exception as e:
+        print(f"⚠️ Cache indisponível ao ler token do Graph: {e}")
+        return None
+
+def _cache_set(chave, valor, timeout):
+    try:
+        cache.set(chave, valor, timeout)
+    except Exception as e:
+        print(f"⚠️ Cache indisponível ao gravar token do Graph: {e}")
+
+def obter_token_graph(tenant_id, client_id, client_secret, renovar=False):
+    """
+    Token de acesso do Microsoft Graph (client credentials), guardado no cache
+    do Django (Redis, compartilhado entre os workers Celery) até pouco antes de
+    expirar. `renovar=True` ignora o cache (ex.: depois de um 401).
+    """
+    chave = f"graph-token:{tenant_id}:{client_id}"
+    if not renovar:
+        token = _cache_get(chave)
+        if token:
+            return token
+
+    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    data = {
+        "client_id": client_id,
+        "scope": GRAPH_SCOPE,
+        "client_secret": client_secret,
+        "grant_type": "client_credentials",
+    }
+    response = _sessao(f"login:{tenant_id}").post(url, data=data, timeout=_timeout())
+    response.raise_for_status()
+    dados = response.json()
+
+    token = dados["access_token"]
+    expira_em = int(dados.get("expires_in", 3599))
+    _cache_set(chave, token, max(60, expira_em - TOKEN_MARGEM))
+    return token
+
+
+class GraphClient:
+    """
+    Cliente do Microsoft Graph para uma conta: token em cache, sessão keep-alive
+    por tenant, timeouts explícitos e backoff em 429/503 respeitando Retry-After.
+    """
+
+    def __init__(self, tenant_id, client_id, client_secret):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.sessao = _sessao(f"graph:{tenant_id}")
+
+    @classmethod
+    def para_conta(cls, user):
+        return cls(user.office365_tenant_id, user.office365_client_id, user.office365_client_secret)
+
+    def token(self, renovar=False):
+        return obter_token_graph(self.tenant_id, self.client_id, self.client_secret, renovar=renovar)
+
+    def request(self, method, url, headers=None, **kwargs):
+        """
+        Executa a requisição (url absoluta ou relativa a /v1.0). Em 429/503
+        aguarda o Retry-After (ou backoff exponencial) e tenta de novo até
+        GRAPH_MAX_RETRIES vezes; em 401 renova o token uma vez.
+        """
+        if url.startswith("/"):
+            url = f"{GRAPH_URL}{url}"
+        token_renovado = False
+        renovar = False
+        tentativa = 0
+
+        while True:
+            cabecalhos = {"Authorization": f"Bearer {self.token(renovar=renovar)}", **(headers or {})}
+            renovar = False
+            response = self.sessao.request(method, url, headers=cabecalhos, timeout=_timeout(), **kwargs)
+
+            if response.status_code == 401 and not token_renovado:
+                token_renovado = renovar = True
+                continue
+
+            if response.status_code in THROTTLE_STATUS and tentativa < settings.GRAPH_MAX_RETRIES:
+                espera = _retry_after(response.headers, padrao=2 ** tentativa)
+                tentativa += 1
+                print(f"⏳ Graph respondeu {response.status_code}; aguardando {espera}s (tentativa {tentativa}).")
+                time.sleep(espera)
+                continue
+
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def paginas(self, url, headers=None):
+        """
+        Percorre uma coleção seguindo @odata.nextLink e devolve cada página
+        (JSON). A última página de uma delta query traz @odata.deltaLink.
+        """
+        while url:
+            response = self.get(url, headers=headers)
+            if response.status_code != 200:
+                print(f"⚠️ Erro ao buscar mensagens: {response.text}")
+                response.raise_for_status()
+            pagina = response.json()
+            yield pagina
+            url = pagina.get("@odata.nextLink")
+
+    def batch(self, requisicoes):
+        """
+        Executa requisições via JSON $batch, em lotes de até 20.
+
+        `requisicoes` é uma lista de dicts {'id', 'method', 'url'[, 'body']} com a
+        url relativa a /v1.0 (ex.: '/users/x/messages/y/attachments'). Sub-requisições
+        respondidas com 429/503 são reenviadas após o maior Retry-After da rodada,
+        até GRAPH_MAX_RETRIES vezes. Devolve {id: {'status', 'headers', 'body'}}.
+        """
+        pendentes = list(requisicoes)
+        respostas = {}
+        tentativa = 0
+
+        while pendentes:
+            reenviar = []
+            espera = 0
+
+            for i in range(0, len(pendentes), GRAPH_BATCH_MAX):
+                lote = pendentes[i:i + GRAPH_BATCH_MAX]
+                por_id = {req['id']: req for req in lote}
+                corpo = {"requests": [_sub_requisicao(req) for req in lote]}
+
+                # Throttling do $batch inteiro já é tratado em request()
+                response = self.post("/$batch", json=corpo)
+                response.raise_for_status()
+
+                for sub in response.json().get("responses", []):
+                    if sub.get("status") in THROTTLE_STATUS and tentativa < settings.GRAPH_MAX_RETRIES:
+                        reenviar.append(por_id[sub["id"]])
+                        espera = max(espera, _retry_after(sub.get("headers"), padrao=2 ** tentativa))
+                    else:
+                        respostas[sub["id"]] = sub
+
+            if reenviar:
+                tentativa += 1
+                print(f"⏳ Graph limitou {len(reenviar)} requisição(ões); aguardando {espera}s (tentativa {tentativa}).")
+                time.sleep(espera)
+            pendentes = reenviar
+
+        return respostas
+
+def _sub_requisicao(req):
+    sub = {"id": req["id"], "method": req["method"], "url": req["url"]}
+    if req.get("body") is not None:
+        sub["body"] = req["body"]
+        sub["headers"] = {"Content-Type": "application/json"}
+    return sub
@@ -0,0 +1,238 @@
+import base64
+import binascii
+import quopri
+import re
+from email.header import decode_header, make_header
+from urllib.parse import unquote
+from documentos.compactados import eh_compactado
+
+XML_MIME_TYPES = {"application/xml", "text/xml"}
+
+# Cabeçalhos necessários para registrar erros (assunto, remetente e data)
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]"
+
+_TOKEN_RE = re.compile(
+    rb'\s*(?:'
+    rb'(?P<abre>\()|(?P<fecha>\))'
+    rb'|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb'|(?P<atom>[^\s()"\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?)'
+    rb')'
+)
+
+def _tokens(data):
+    """
+    Transforma a resposta do imaplib (lista de bytes e tuplas cabeçalho/literal)
+    em tokens: '(' , ')', strings e literais.
+    """
+    for parte in data:
+        if parte is None:
+            continue
+        if isinstance(parte, tuple):
+            cabecalho, literal = parte
+            cabecalho = re.sub(rb'\{\d+\}\s*$', b'', cabecalho)
+            yield from _tokens_linha(cabecalho)
+            yield ('literal', literal)
+        else:
+            yield from _tokens_linha(parte)
+
+def _tokens_linha(linha):
+    pos = 0
+    while pos < len(linha):
+        m = _TOKEN_RE.match(linha, pos)
+        if not m or m.end() == pos:
+            break
+        pos = m.end()
+        if m.group('abre'):
+            yield ('(', None)
+        elif m.group('fecha'):
+            yield (')', None)
+        elif m.group('quoted') is not None:
+            valor = re.sub(rb'\\(.)', rb'\1', m.group('quoted'))
+            yield ('string', valor.decode('utf-8', errors='replace'))
+        elif m.group('atom'):
+            atom = m.group('atom').decode('utf-8', errors='replace')
+            yield ('nil', None) if atom.upper() == 'NIL' else ('string', atom)
+
+def _montar_listas(tokens):
+    """
+    Monta listas aninhadas a partir dos tokens. NIL vira None e literais
+    permanecem em bytes.
+    """
+    pilha = [[]]
+    for tipo, valor in tokens:
+        if tipo == '(':
+            pilha.append([])
+        elif tipo == ')':
+            if len(pilha) > 1:
+                fechada = pilha.pop()
+                pilha[-1].append(fechada)
+        else:
+            pilha[-1].append(valor)
+    return pilha[0]
+
+def parse_fetch_response(data):
+    """
+    Interpreta a resposta de um (UID) FETCH e devolve {uid: {item: valor}}.
+    Se o item UID não veio na resposta, a chave é o número de sequência.
+    As seções BODY[...] são normalizadas para 'BODY[<seção>]' em maiúsculas.
+    """
+    valores = _montar_listas(_tokens(data))
+    mensagens = {}
+    i = 0
+    while i < len(valores) - 1:
+        seq, itens = valores[i], valores[i + 1]
+        if not isinstance(itens, list):
+            i += 1
+            continue
+        campos = {}
+        for chave, valor in zip(itens[::2], itens[1::2]):
+            if isinstance(chave, str):
+                campos[_normalizar_chave(chave)] = valor
+        try:
+            ident = int(campos.get('UID') or seq)
+        except (TypeError, ValueError):
+            ident = seq
+        mensagens.setdefault(ident, {}).update(campos)
+        i += 2
+    return mensagens
+
+def _normalizar_chave(chave):
+    chave = re.sub(r'<\d+>$', '', chave.upper())
+    if chave.startswith('BODY[HEADER'):
+        return 'BODY[HEADER]'
+    return chave
+
+def _texto(valor):
+    """Literais chegam em bytes; os demais campos já são str (ou None)."""
+    if isinstance(valor, bytes):
+        return valor.decode('utf-8', errors='replace')
+    return valor if isinstance(valor, str) else None
+
+def _params(lista):
+    """Converte a lista de parâmetros ("NAME" "valor" ...) em dict."""
+    if not isinstance(lista, list):
+        return {}
+    return {
+        _texto(k).lower(): _texto(v)
+        for k, v in zip(lista[::2], lista[1::2])
+        if _texto(k)
+    }
+
+def decodificar_filename(params):
+    """
+    Nome do arquivo a partir dos parâmetros de Content-Disposition/Content-Type,
+    tratando RFC 2231 (filename*, filename*0...) e RFC 2047 (=?utf-8?...?=).
+    """
+    for nome in ('filename', 'name'):
+        if params.get(f'{nome}*') or params.get(f'{nome}*0*') or params.get(f'{nome}*0'):
+            partes = []
+            n = 0
+            while True:
+                valor = params.get(f'{nome}*{n}*') or params.get(f'{nome}*{n}')
+                if valor is None:
+                    break
+                partes.append(valor)
+                n += 1
+            bruto = params.get(f'{nome}*') or ''.join(partes)
+            # charset'idioma'valor-com-%XX
+            charset, _, resto = bruto.partition("'")
+            if resto:
+                _, _, bruto = resto.partition("'")
+            try:
+                return unquote(bruto, encoding=charset or 'utf-8', errors='replace')
+            except LookupError:
+                return unquote(bruto)
+        valor = params.get(nome)
+        if valor:
+            try:
+                return str(make_header(decode_header(valor)))
+            except Exception:
+                return valor
+    return None
+
+def listar_partes_xml(bodystructure, prefixo=''):
+    """
+    Percorre o BODYSTRUCTURE e devolve as partes que são anexos XML (nome
+    terminado em .xml ou tipo application/xml / text/xml) ou compactados
+    (.zip / .gz, expandidos depois por expandir_anexos), como dicts com
+    'secao', 'filename', 'mime_type', 'encoding' e 'size'. Assim como
+    Message.iter_attachments, não desce em mensagens encaminhadas (message/rfc822).
+    """
+    if not isinstance(bodystructure, list) or not bodystructure:
+        return []
+
+    # Multipart: filhos (listas) seguidos do subtipo e dados de extensão
+    if isinstance(bodystructure[0], list):
+        partes = []
+        for n, filho in enumerate(bodystructure, 1):
+            if not isinstance(filho, list):
+                break
+            partes.extend(listar_partes_xml(filho, f"{prefixo}{n}."))
+        return partes
+
+    secao = prefixo.rstrip('.') or '1'
+    campos = [_texto(v) for v in bodystructure[:7]] + [None] * 7
+    tipo = (campos[0] or '').lower()
+    subtipo = (campos[1] or '').lower()
+    mime_type = f"{tipo}/{subtipo}"
+    params = _params(bodystructure[2] if len(bodystructure) > 2 else None)
+    encoding = (campos[5] or '7bit').lower()
+    try:
+        size = int(bodystructure[6])
+    except (IndexError, TypeError, ValueError):
+        size = None
+
+    # Posição da disposition depende do tipo (text/* e message/rfc822 têm campos extras)
+    if tipo == 'text':
+        idx_disp = 9
+    elif mime_type == 'message/rfc822':
+        idx_disp = 11
+    else:
+        idx_disp = 8
+    disposition = bodystructure[idx_disp] if len(bodystructure) > idx_disp else None
+    if isinstance(disposition, list) and len(disposition) > 1:
+        params = {**params, **_params(disposition[1])}
+
+    filename = decodificar_filename(params)
+    eh_xml = (filename and filename.lower().endswith('.xml')) or mime_type in XML_MIME_TYPES
+    if not eh_xml and not eh_compactado(filename, mime_type):
+        return []
+
+    return [{
+        'secao': secao,
+        'filename': filename or f"parte-{secao}.xml",
+        'mime_type': mime_type,
+        'encoding': encoding,
+        'size': size,
+    }]
+
+def compactar_uids(uids):
+    """
+    Monta o conjunto de mensagens IMAP compacto a partir de UIDs:
+    [1, 2, 3, 5, 7, 8] -> "1:3,5,7:8".
+    """
+    faixas = []
+    for uid in sorted(set(int(u) for u in uids)):
+        if faixas and uid == faixas[-1][1] + 1:
+            faixas[-1][1] = uid
+        else:
+            faixas.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in faixas)
+
+def decodificar_parte(payload, encoding):
+    """Decodifica o conteúdo bruto de uma parte conforme o Content-Transfer-Encoding."""
+    if payload is None:
+        return b""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        try:
+            return base64.b64decode(payload)
+        except binascii.Error:
+            # Padding incorreto: completa com '=' e tenta de novo
+            limpo = re.sub(rb'[^A-Za-z0-9+/]', b'', payload)
+            return base64.b64decode(limpo + b'=' * (-len(limpo) % 4))
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload)
+    return payload
@@ -0,0 +1,298 @@
+import os
+from django.conf import settings
+from django.db import transaction
+from documentos.execucoes import medir
+from documentos.metricas import ANEXOS_PROCESSADOS
+from documentos.models import AnexoPendente
+from documentos.parse_paralelo import extrair_conteudos, numero_workers
+from documentos.util import (
+    anexos_ja_processados,
+    gravar_documentos,
+    registrar_anexos_processados,
+    save_xml_error_simple,
+    sha256_anexo,
+)
+
+# Resultado do processamento de um anexo XML
+ANEXO_OK = "ok"
+ANEXO_DUPLICADO = "duplicado"
+ANEXO_IGNORADO = "ignorado"
+ANEXO_ERRO = "erro"
+ANEXO_ENFILEIRADO = "enfileirado"  # gravado em AnexoPendente (EMAIL_INGEST_STAGING)
+
+
+def indice_anexos(anexos):
+    """
+    Calcula o SHA-256 de cada anexo (guardado em anexo['sha256']) e consulta
+    de uma vez quais já foram processados. Devolve o índice do lote:
+    {'conhecidos': set de hashes, 'novos': registros a gravar}.
+    """
+    anexos = list(anexos)
+    for anexo in anexos:
+        anexo['sha256'] = sha256_anexo(anexo['payload_bytes'])
+    return {
+        'conhecidos': anexos_ja_processados(anexo['sha256'] for anexo in anexos),
+        'novos': [],
+    }
+
+def gravar_indice_anexos(indice):
+    try:
+        registrar_anexos_processados(indice['novos'])
+    except Exception as e:
+        print(f"⚠️ Falha ao registrar hashes de anexos processados: {e}")
+    indice['novos'] = []
+
+def processar_anexos_lote(user, mensagens, indice, workers=1, resumo=None):
+    """
+    Processa os anexos XML de um lote de mensagens. `mensagens` é uma lista de
+    (contexto, anexos), com o contexto de cada mensagem (assunto, remetente e
+    received_at). Cada XML é extraído individualmente (um rLoteDE gera vários
+    documentos), mas todos os documentos do lote são gravados com uma única
+    chamada a gravar_documentos. Cada anexo
+    recebe anexo['situacao']: ANEXO_OK, ANEXO_DUPLICADO (hash já presente no
+    índice; nem faz o parse), ANEXO_IGNORADO (não é um DE) ou ANEXO_ERRO.
+
+    Com `workers` > 1 o parse roda em processos separados (parse_paralelo).
+    Com `resumo` (resumo da conta), soma os documentos criados e o tempo de
+    parse e de gravação.
+    """
+    username = user.username
+    candidatos = []
+    for contexto, anexos in mensagens:
+        for anexo in anexos:
+            anexo['situacao'] = _preparar_anexo_xml(user, contexto, anexo, indice)
+            if anexo['situacao'] is None:
+                candidatos.append((contexto, anexo))
+
+    if candidatos:
+        ANEXOS_PROCESSADOS.labels(conta=username).inc(len(candidatos))
+    extraidos = []
+    with medir(resumo, 'parse'):
+        resultados = extrair_conteudos(
+            [(i, anexo.pop('xml')) for i, (_, anexo) in enumerate(candidatos)],
+            workers=workers,
+        )
+    for (contexto, anexo), (_, documentos, erro) in zip(candidatos, resultados):
+        if erro:
+            anexo['situacao'] = ANEXO_ERRO
+            _registrar_erro_anexo(user, contexto, anexo, erro['mensagem'], stacktrace=erro['traceback'])
+        else:
+            if len(documentos) == 1 and not isinstance(documentos[0]['documento_xml'], str):
+                # DE único: o XML do documento é o próprio anexo, já com o SHA-256 calculado
+                documentos[0]['xml_sha256'] = anexo.get('sha256')
+            anexo['documentos'] = documentos
+            extraidos.append((contexto, anexo))
+
+    if not extraidos:
+        return
+
+    try:
+        with medir(resumo, 'gravacao'):
+            documentos, novos = gravar_documentos(
+                [dados for _, anexo in extraidos for dados in anexo['documentos']],
+                user.company,
+            )
+    except Exception as e:
+        # Isola o documento problemático gravando um a um
+        print(f"⚠️ [{username}] Falha na gravação em lote ({e}); gravando documento a documento.")
+        documentos, novos = {}, set()
+        for contexto, anexo in extraidos:
+            try:
+                with medir(resumo, 'gravacao'):
+                    docs, criados = gravar_documentos(anexo['documentos'], user.company)
+                documentos.update(docs)
+                novos |= criados
+            except Exception as erro:
+                anexo['situacao'] = ANEXO_ERRO
+                _registrar_erro_anexo(user, contexto, anexo, erro)
+
+    for contexto, anexo in extraidos:
+        if anexo['situacao'] == ANEXO_ERRO:
+            continue
+        docs = [documentos[dados['cdc']] for dados in anexo.pop('documentos')]
+        for doc in docs:
+            if doc.cdc in novos:
+                novos.discard(doc.cdc)
+                if resumo is not None:
+                    resumo['criados'] += 1
+                print(f"✅ [{username}] {contexto['assunto']} -> Documento {doc.cdc} criado com sucesso.")
+            else:
+                print(f"⚠️ [{username}] {contexto['assunto']} -> Documento {doc.cdc} já existia.")
+
+        sha256 = anexo.get('sha256')
+        if indice is not None and sha256:
+            indice['conhecidos'].add(sha256)
+            indice['novos'].append({
+                'sha256': sha256,
+                'documento': docs[0],  # lote (rLoteDE): o primeiro DE do arquivo
+                'filename': anexo['filename'],
+                'size_bytes': len(anexo['payload_bytes'] or b""),
+            })
+        anexo['situacao'] = ANEXO_OK
+
+def _preparar_anexo_xml(user, contexto, anexo, indice):
+    """
+    Confere o índice de hashes e separa o payload para o parse (anexo['xml']).
+    Devolve a situação final do anexo, ou None se ele ainda precisa de parse e
+    gravação.
+    """
+    filename = anexo['filename']
+    if anexo.get('erro'):
+        # Compactado que não pôde ser expandido (ver expandir_anexos)
+        _registrar_erro_anexo(user, contexto, anexo, anexo['erro'])
+        return ANEXO_ERRO
+
+    if indice is not None and anexo.get('sha256') in indice['conhecidos']:
+        print(f"♻️ [{user.username}] {filename} já processado anteriormente. Ignorado.")
+        return ANEXO_DUPLICADO
+
+    # Validação mínima para DE, direto nos bytes: o parser recebe o payload sem
+    # decodificar (respeita o encoding do prólogo), e esses mesmos bytes vão para o storage
+    payload = anexo['payload_bytes'] or b""
+    if b"<DE Id=" not in payload:
+        print(f"⏩ {filename} ignorado: não é um DE válido.")
+        return ANEXO_IGNORADO
+
+    anexo['xml'] = payload
+    return None
+
+def _registrar_erro_anexo(user, contexto, anexo, erro, stacktrace=None):
+    """
+    Salva o XML bruto em disco e registra o erro em EmailXmlError.
+    """
+    filename = anexo['filename']
+    payload_bytes = anexo['payload_bytes']
+    print(f"\n❌ Erro ao processar '{filename}' do e-mail: {contexto['assunto']}")
+    print(f"➡️  Erro: {erro}")
+
+    # 1) Salva o XML bruto em disco (bytes) para análise
+    try:
+        # XMLs de dentro de compactados vêm como 'pacote.zip/nota.xml'
+        nome_arquivo = filename.replace("/", "_").replace("\\", "_")
+        os.makedirs("xmls_erros", exist_ok=True)
+        with open(os.path.join("xmls_erros", nome_arquivo), "wb") as f:
+            if payload_bytes:
+                f.write(payload_bytes)
+        print(f"📝 XML com erro salvo: xmls_erros/{nome_arquivo}")
+    except Exception as file_error:
+        print(f"⚠️ Falha ao salvar XML com erro: {file_error}")
+
+    # 2) Registra no banco via helper simples
+    try:
+        save_xml_error_simple(
+            account=user,
+            subject=contexto['assunto'],
+            received_from=contexto['remetente'],
+            received_at=contexto['received_at'],
+            filename=filename,
+            mime_type=anexo['mime_type'],
+            payload_bytes=payload_bytes,
+            xml_text=None,   # falhou decodificação/parse -> None
+            err=erro,
+            size_bytes=len(payload_bytes) if payload_bytes else 0,
+            stacktrace=stacktrace,
+        )
+    except Exception as db_error:
+        print(f"⚠️ Falha ao registrar erro no banco: {db_error}")
+
+def enfileirar_anexos(user, mensagens):
+    """
+    Grava os anexos XML de um lote de mensagens na fila AnexoPendente, em uma
+    única transação, sem fazer o parse. XMLs que não são DE nem entram na fila
+    (ANEXO_IGNORADO), compactados inválidos são registrados como ANEXO_ERRO e
+    os demais ficam como ANEXO_ENFILEIRADO. Só depois do commit o leitor pode
+    apagar/mover as mensagens. Devolve a quantidade de anexos enfileirados.
+    """
+    pendentes = []
+    for contexto, anexos in mensagens:
+        for anexo in anexos:
+            payload = anexo['payload_bytes'] or b""
+            if anexo.get('erro'):
+                _registrar_erro_anexo(user, contexto, anexo, anexo['erro'])
+                anexo['situacao'] = ANEXO_ERRO
+                continue
+            if b"<DE Id=" not in payload:
+                print(f"⏩ {anexo['filename']} ignorado: não é um DE válido.")
+                anexo['situacao'] = ANEXO_IGNORADO
+                continue
+            anexo['situacao'] = ANEXO_ENFILEIRADO
+            pendentes.append(AnexoPendente(
+                account=user,
+                subject=contexto['assunto'] or '',
+                received_from=contexto['remetente'] or '',
+                received_at=contexto['received_at'],
+                filename=(anexo['filename'] or '')[:255],
+                mime_type=(anexo['mime_type'] or '')[:100],
+                payload=payload,
+            ))
+
+    if pendentes:
+        with transaction.atomic():
+            AnexoPendente.objects.bulk_create(pendentes)
+    return len(pendentes)
+
+def consumir_anexos_pendentes(tamanho_lote=None, max_lotes=None, workers=None):
+    """
+    Consome a fila AnexoPendente em lotes até esvaziá-la (ou até `max_lotes`).
+    Cada lote é reservado com SELECT ... FOR UPDATE SKIP LOCKED, então vários
+    consumidores podem rodar em paralelo sem pegar as mesmas linhas; se o
+    processo cair no meio, o rollback devolve o lote para a fila. O parse de
+    cada lote usa `workers` processos (padrão: XML_PARSE_WORKERS). Devolve o
+    resumo {'lotes', 'anexos', 'ok', 'duplicados', 'ignorados', 'erros'}.
+    """
+    tamanho_lote = tamanho_lote or settings.STAGING_LOTE
+    workers = numero_workers(workers)
+    resumo = {'lotes': 0, 'anexos': 0, 'ok': 0, 'duplicados': 0, 'ignorados': 0, 'erros': 0}
+
+    while max_lotes is None or resumo['lotes'] < max_lotes:
+        with transaction.atomic():
+            pendentes = list(
+                AnexoPendente.objects.select_for_update(skip_locked=True, of=('self',))
+                .select_related('account__company')
+                .order_by('id')[:tamanho_lote]
+            )
+            if not pendentes:
+                break
+
+            # Agrupa por conta: a empresa do documento vem da conta de e-mail
+            por_conta = {}
+            for pendente in pendentes:
+                contexto = {
+                    'assunto': pendente.subject,
+                    'remetente': pendente.received_from,
+                    'received_at': pendente.received_at,
+                }
+                anexo = {
+                    'filename': pendente.filename,
+                    'mime_type': pendente.mime_type,
+                    'payload_bytes': bytes(pendente.payload),
+                }
+                conta = por_conta.setdefault(pendente.account_id, (pendente.account, []))
+                conta[1].append((contexto, [anexo]))
+
+            for user, mensagens in por_conta.values():
+                indice = indice_anexos(anexo for _, anexos in mensagens for anexo in anexos)
+                processar_anexos_lote(user, mensagens, indice, workers=workers)
+                gravar_indice_anexos(indice)
+                for _, anexos in mensagens:
+                    situacao = anexos[0]['situacao']
+                    chave = {
+                        ANEXO_OK: 'ok',
+                        ANEXO_DUPLICADO: 'duplicados',
+                        ANEXO_IGNORADO: 'ignorados',
+                    }.get(situacao, 'erros')
+                    resumo[chave] += 1
+
+            # Erros já ficam registrados em EmailXmlError e xmls_erros/
+            AnexoPendente.objects.filter(pk__in=[p.pk for p in pendentes]).delete()
+
+        resumo['lotes'] += 1
+        resumo['anexos'] += len(pendentes)
+
+    if resumo['anexos']:
+        print(
+            f"📦 Fila de anexos: {resumo['anexos']} anexo(s) em {resumo['lotes']} lote(s); "
+            f"ok {resumo['ok']}; duplicados {resumo['duplicados']}; ignorados {resumo['ignorados']}; "
+            f"erros {resumo['erros']}."
+        )
+    return resumo
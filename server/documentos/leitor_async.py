@@ -0,0 +1,128 @@
+"""
+Leitura concorrente das contas de e-mail em um único processo
+(EMAIL_INGEST_ENGINE='asyncio').
+
+Não é I/O assíncrono: imaplib, requests (Microsoft Graph) e o ORM do Django
+são bloqueantes, e trocá-los por clientes assíncronos (aioimaplib, httpx) e
+pelo ORM assíncrono mudaria todo o leitor. Cada conta continua sendo lida em
+uma thread, mas de um pool limitado (EMAIL_ASYNC_MAX_CONTAS), e o event loop
+asyncio só coordena: limites por host IMAP e por tenant do Office 365, retry
+com backoff e o tempo limite (cancelamento cooperativo entre lotes).
+"""
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection
+from emails.models import User
+from .cache_referencias import imprimir_estatisticas_cache
+from .email_reader import imprimir_resumo_execucao, novo_resumo, processar_conta_email
+from .execucoes import finalizar_execucao, iniciar_execucao
+
+
+def ler_emails_concorrente(max_emails=200, contas=None):
+    """
+    Lê todas as contas ativas em um único processo, em paralelo. Mesmo
+    comportamento de ler_emails_com_anexos (select, search, fetch, parser,
+    flag/move), mas o tempo total passa a ser o da conta mais lenta.
+
+    imaplib, requests e o ORM são bloqueantes: cada conta é lida em uma thread
+    de um pool limitado, e um event loop asyncio só coordena os limites, o
+    retry com backoff e o tempo limite. Limites (settings):
+    - EMAIL_ASYNC_MAX_CONTAS: threads do pool (contas lidas ao mesmo tempo)
+    - EMAIL_ASYNC_MAX_POR_HOST: contas simultâneas por servidor IMAP
+    - EMAIL_ASYNC_MAX_POR_TENANT: contas simultâneas por tenant do Office 365
+    """
+    users = User.objects.filter(active=True)
+    if contas is not None:
+        users = users.filter(pk__in=contas)
+    users = list(users)
+    if not users:
+        print("📭 Nenhuma conta de e-mail ativa.")
+        return []
+
+    execucao_id = iniciar_execucao('asyncio')
+    resumos = asyncio.run(_ler_contas(users, max_emails, execucao_id))
+    finalizar_execucao(execucao_id)
+    imprimir_resumo_execucao(resumos)
+    imprimir_estatisticas_cache()
+    return resumos
+
+async def _ler_contas(users, max_emails, execucao_id=None):
+    executor = ThreadPoolExecutor(
+        max_workers=settings.EMAIL_ASYNC_MAX_CONTAS,
+        thread_name_prefix="leitor-email",
+    )
+    por_host = defaultdict(lambda: asyncio.Semaphore(settings.EMAIL_ASYNC_MAX_POR_HOST))
+    por_tenant = defaultdict(lambda: asyncio.Semaphore(settings.EMAIL_ASYNC_MAX_POR_TENANT))
+
+    try:
+        tarefas = []
+        for user in users:
+            if user.office365:
+                limite = por_tenant[user.office365_tenant_id or user.pk]
+            else:
+                limite = por_host[(user.host or '').lower()]
+            tarefas.append(_ler_conta(executor, limite, user, max_emails, execucao_id))
+        return await asyncio.gather(*tarefas)
+    finally:
+        # Todas as threads já terminaram: _ler_conta sempre espera a sua
+        executor.shutdown(wait=True)
+
+async def _ler_conta(executor, limite, user, max_emails, execucao_id=None):
+    """
+    Processa uma conta respeitando o limite do host/tenant. Falhas são
+    re-tentadas com backoff exponencial (como a task Celery); o intervalo é
+    aguardado no loop, sem ocupar thread nem vaga do host.
+
+    Estourado EMAIL_TASK_SOFT_TIME_LIMIT, a leitura é cancelada e para depois
+    do lote em andamento (cada operação de rede tem timeout: IMAP_TIMEOUT e
+    GRAPH_READ_TIMEOUT). Uma thread não pode ser interrompida de fora, então a
+    vaga do host/tenant só é liberada quando ela termina de fato: a conexão
+    IMAP/Graph continua contando no limite até ser fechada.
+    """
+    loop = asyncio.get_running_loop()
+    inicio = time.monotonic()
+
+    for tentativa in range(settings.EMAIL_TASK_MAX_RETRIES + 1):
+        cancelar = threading.Event()
+        erro = None
+        async with limite:
+            futuro = loop.run_in_executor(
+                executor, _processar_conta_thread, user, max_emails, execucao_id, cancelar,
+            )
+            _, pendentes = await asyncio.wait({futuro}, timeout=settings.EMAIL_TASK_SOFT_TIME_LIMIT)
+            if pendentes:
+                print(f"⏱️ [{user.username}] Tempo limite excedido; interrompendo depois do lote em andamento.")
+                cancelar.set()
+            try:
+                resumo = await futuro
+            except Exception as e:
+                erro = e
+
+        if erro is None:
+            break
+        if cancelar.is_set():
+            # Falhou depois do tempo limite: sem nova tentativa
+            print(f"🚫 Erro ao conectar ou processar e-mails de {user.username}: {erro}")
+            resumo = novo_resumo(user, erro="Tempo limite excedido")
+            break
+        if tentativa < settings.EMAIL_TASK_MAX_RETRIES:
+            espera = settings.EMAIL_TASK_RETRY_BACKOFF * (2 ** tentativa)
+            print(f"🔁 [{user.username}] Erro: {erro}. Nova tentativa em {espera}s.")
+            await asyncio.sleep(espera)
+        else:
+            print(f"🚫 Erro ao conectar ou processar e-mails de {user.username}: {erro}")
+            resumo = novo_resumo(user, erro=str(erro))
+
+    resumo['duracao'] = round(time.monotonic() - inicio, 3)
+    return resumo
+
+def _processar_conta_thread(user, max_emails, execucao_id, cancelar):
+    try:
+        return processar_conta_email(user, max_emails=max_emails, execucao_id=execucao_id, cancelar=cancelar)
+    finally:
+        # Cada thread do pool abre sua própria conexão com o banco
+        connection.close()
@@ -0,0 +1,293 @@
+import io
+import json
+import time
+from contextlib import redirect_stdout
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from common.models import Cidade, Departamento
+from companies.models import Company
+from documentos.models import Documento, TipoDocumento
+from documentos.views import DocumentoListView
+from emissores.models import Emissor
+
+# Tudo o que o benchmark cria é marcado com este prefixo (cdc, código do emissor,
+# nome da empresa), para continuar a carga depois e para o --clean
+PREFIXO = "BENCH"
+
+# Tipos SIFEN (iTiDE), criados só se a tabela estiver vazia
+TIPOS_SIFEN = [
+    (1, "Factura electrónica"),
+    (4, "Autofactura electrónica"),
+    (5, "Nota de crédito electrónica"),
+    (6, "Nota de débito electrónica"),
+    (7, "Nota de remisión electrónica"),
+]
+
+# Linhas sintéticas geradas no próprio PostgreSQL (generate_series), com os
+# emissores concentrados (power(random(), 3)) como nos dados reais.
+# Os documentos não têm XML: use um banco de teste, não o de produção.
+SQL_CARGA = """
+INSERT INTO {tabela} (
+    company_id, cdc, tipo_documento_id, est, pun_exp, num_doc, numero_completo,
+    emissor_id, fecha_emision, monto_total, timbrado, receptor_ruc, receptor_nome,
+    moneda, condicion_venta, total_iva, iva_5, iva_10, itens_extraidos, campos_extraidos,
+    xml_sha256, xml_tamanho, documento_xml_zlib, documento_xml_texto, created_at, updated_at
+)
+SELECT
+    company_id, cdc, tipo_documento_id, est, pun_exp, num_doc, est || '-' || pun_exp || '-' || num_doc,
+    emissor_id, fecha_emision, monto_total, timbrado, receptor_ruc, receptor_nome,
+    moneda, condicion_venta, round(monto_total / 11, 2), 0, round(monto_total / 11, 2), TRUE, TRUE,
+    '', 0, NULL, '', now(), now()
+FROM (
+    SELECT
+        (%(empresas)s::bigint[])[1 + floor(random() * cardinality(%(empresas)s::bigint[]))::int] AS company_id,
+        %(prefixo)s || lpad(g::text, 43, '0') AS cdc,
+        (%(tipos)s::bigint[])[1 + floor(random() * cardinality(%(tipos)s::bigint[]))::int] AS tipo_documento_id,
+        '001' AS est,
+        lpad((1 + floor(random() * 5))::text, 3, '0') AS pun_exp,
+        lpad(floor(random() * 9999999)::text, 7, '0') AS num_doc,
+        (%(emissores)s::bigint[])[1 + floor(power(random(), 3) * cardinality(%(emissores)s::bigint[]))::int] AS emissor_id,
+        now() - random() * make_interval(days => %(dias)s) AS fecha_emision,
+        round((1000 + random() * 10000000)::numeric, 2) AS monto_total,
+        (12000000 + floor(random() * 500))::text AS timbrado,
+        (80000000 + floor(random() * 50000))::text || '-' || floor(random() * 10)::text AS receptor_ruc,
+        (ARRAY['Comercial', 'Distribuidora', 'Ferretería', 'Agro', 'Importadora', 'Servicios'])[1 + floor(random() * 6)::int]
+            || ' ' || (ARRAY['Paraguay', 'del Este', 'Asunción', 'Central', 'Norte', 'San Lorenzo'])[1 + floor(random() * 6)::int]
+            || ' S.A. ' || floor(random() * 50000)::text AS receptor_nome,
+        CASE WHEN random() < 0.9 THEN 'PYG' ELSE 'USD' END AS moneda,
+        CASE WHEN random() < 0.7 THEN 1 ELSE 2 END AS condicion_venta
+    FROM generate_series(%(inicio)s, %(fim)s) AS g
+) AS linhas
+ON CONFLICT (cdc) DO NOTHING
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Carrega N documentos sintéticos (PostgreSQL) e mostra o EXPLAIN ANALYZE da listagem "
+        "(DocumentoListView) para cada combinação de filtros. Rode em um banco de teste."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=1_000_000,
+            help="Total de documentos sintéticos no banco; só insere os que faltam (padrão: 1000000, 0 = não carrega)"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100_000,
+            help="Documentos por INSERT na carga (padrão: 100000)"
+        )
+        parser.add_argument(
+            "--companies", type=int, default=20,
+            help="Empresas sintéticas entre as quais os documentos são distribuídos (padrão: 20)"
+        )
+        parser.add_argument(
+            "--emissores", type=int, default=5000,
+            help="Emissores sintéticos (padrão: 5000)"
+        )
+        parser.add_argument(
+            "--days", type=int, default=3 * 365,
+            help="Período coberto pela fecha_emision dos documentos, em dias (padrão: 1095)"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3,
+            help="Execuções de cada consulta; vale a mais rápida (padrão: 3)"
+        )
+        parser.add_argument(
+            "--show-plan", action="store_true",
+            help="Mostra o plano completo (EXPLAIN ANALYZE, BUFFERS) de cada consulta"
+        )
+        parser.add_argument(
+            "--clean", action="store_true",
+            help="Apaga os documentos, emissores e empresas criados pelo benchmark e sai"
+        )
+
+    def handle(self, *args, **opts):
+        if connection.vendor != "postgresql":
+            raise CommandError("O benchmark usa EXPLAIN ANALYZE do PostgreSQL.")
+
+        if opts["clean"]:
+            self._limpar()
+            return
+
+        empresas = self._empresas(max(1, opts["companies"]))
+        tipos = self._tipos()
+        emissores = self._emissores(max(1, opts["emissores"]))
+        if opts["rows"]:
+            self._carregar(opts, empresas, tipos, emissores)
+
+        self._consultas(opts, empresas, tipos, emissores)
+
+    def _empresas(self, quantidade):
+        return [
+            Company.objects.get_or_create(name=f"{PREFIXO} {numero}")[0].pk
+            for numero in range(1, quantidade + 1)
+        ]
+
+    def _tipos(self):
+        if not TipoDocumento.objects.exists():
+            TipoDocumento.objects.bulk_create([TipoDocumento(code=code, name=name) for code, name in TIPOS_SIFEN])
+        return list(TipoDocumento.objects.order_by("code").values_list("pk", "code"))
+
+    def _emissores(self, quantidade):
+        departamento, _ = Departamento.objects.get_or_create(code=PREFIXO, defaults={"name": PREFIXO})
+        cidade, _ = Cidade.objects.get_or_create(
+            code=PREFIXO, defaults={"name": PREFIXO, "departamento": departamento}
+        )
+        Emissor.objects.bulk_create(
+            [
+                Emissor(code=f"{PREFIXO}{numero:07d}", nome=f"Emisor {PREFIXO} {numero}", cidade=cidade)
+                for numero in range(1, quantidade + 1)
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        # Em ordem: com a carga concentrada, os primeiros emissores são os que têm mais documentos
+        return list(
+            Emissor.objects.filter(code__startswith=PREFIXO).order_by("code").values_list("pk", flat=True)[:quantidade]
+        )
+
+    def _carregar(self, opts, empresas, tipos, emissores):
+        total = opts["rows"]
+        batch_size = max(1, opts["batch_size"])
+        existentes = Documento.objects.filter(cdc__startswith=PREFIXO).count()
+        if existentes >= total:
+            self.stdout.write(f"📦 {existentes} documento(s) sintético(s) já carregado(s).")
+            return
+
+        self.stdout.write(f"📦 Carregando {total - existentes} documento(s) sintético(s) (já existem {existentes})…")
+        sql = SQL_CARGA.format(tabela=connection.ops.quote_name(Documento._meta.db_table))
+        params = {
+            "empresas": empresas,
+            "tipos": [pk for pk, _code in tipos],
+            "emissores": emissores,
+            "prefixo": PREFIXO,
+            "dias": max(1, opts["days"]),
+        }
+        inicio = time.monotonic()
+        for primeiro in range(existentes + 1, total + 1, batch_size):
+            ultimo = min(primeiro + batch_size - 1, total)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, {**params, "inicio": primeiro, "fim": ultimo})
+            self.stdout.write(f"   💾 {ultimo}/{total}, {time.monotonic() - inicio:.1f}s")
+
+        # Estatísticas atualizadas para o planner antes das consultas
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {connection.ops.quote_name(Documento._meta.db_table)}")
+        self.stdout.write(self.style.SUCCESS(f"✅ Carga concluída em {time.monotonic() - inicio:.1f}s."))
+
+    def _casos(self, empresas, tipos, emissores):
+        """
+        Combinações de filtros da listagem, como query params da DocumentoListView.
+        """
+        hoje = timezone.now()
+        periodo = {
+            "start_date": (hoje - timedelta(days=30)).isoformat(),
+            "end_date": hoje.isoformat(),
+        }
+        empresa = {"company": str(empresas[0])}
+        emissor = {"emissor": str(emissores[0])}
+        tipo = {"tipo_documento": str(tipos[0][1])}
+        return [
+            ("empresa", empresa),
+            ("3 empresas", {"company": ",".join(str(pk) for pk in empresas[:3])}),
+            ("empresa + período (30 dias)", {**empresa, **periodo}),
+            ("empresa + emissor", {**empresa, **emissor}),
+            ("empresa + tipo", {**empresa, **tipo}),
+            ("empresa + período + tipo", {**empresa, **periodo, **tipo}),
+            ("empresa + período + emissor + tipo", {**empresa, **periodo, **emissor, **tipo}),
+            ("empresa + num_doc (icontains)", {**empresa, "num_doc": "1234"}),
+            ("empresa + receptor_nome (icontains)", {**empresa, "receptor_nome": "ferre"}),
+            ("empresa + numero", {**empresa, "numero": "001-001-0001234"}),
+            ("empresa + receptor_ruc", {**empresa, "receptor_ruc": "80012345-1"}),
+        ]
+
+    def _consultas(self, opts, empresas, tipos, emissores):
+        limite = settings.REST_FRAMEWORK.get("PAGE_SIZE") or 100
+        repeticoes = max(1, opts["repeat"])
+        fabrica = RequestFactory()
+        self.stdout.write(
+            f"🔎 EXPLAIN ANALYZE da listagem (primeira página de {limite} e count), melhor de {repeticoes}:"
+        )
+
+        for nome, params in self._casos(empresas, tipos, emissores):
+            view = DocumentoListView()
+            view.request = fabrica.get("/documentos/", params)
+            # A view faz print dos filtros de empresa; aqui só atrapalha a saída
+            with redirect_stdout(io.StringIO()):
+                queryset = view.get_queryset()
+
+            sql, sql_params = queryset[:limite].query.sql_with_params()
+            pagina = self._explicar(sql, sql_params, repeticoes, opts["show_plan"])
+            sql, sql_params = queryset.order_by().values("pk").query.sql_with_params()
+            contagem = self._explicar(
+                f"SELECT COUNT(*) FROM ({sql}) AS subquery", sql_params, repeticoes, opts["show_plan"]
+            )
+
+            aviso = " ⚠️ Seq Scan" if "Seq Scan" in pagina["nos"] | contagem["nos"] else ""
+            indices = ", ".join(sorted(pagina["indices"] | contagem["indices"])) or "-"
+            self.stdout.write(
+                f"   {nome:<38} página {pagina['execucao']:9.2f} ms | count {contagem['execucao']:9.2f} ms "
+                f"({contagem['linhas']} linha(s)) | índices: {indices}{aviso}"
+            )
+            if opts["show_plan"]:
+                for titulo, resultado in (("página", pagina), ("count", contagem)):
+                    self.stdout.write(f"\n      [{titulo}]\n{resultado['texto']}\n")
+
+    def _explicar(self, sql, params, repeticoes, com_texto):
+        """
+        Roda o EXPLAIN ANALYZE `repeticoes` vezes e devolve o tempo da mais
+        rápida (ms), as linhas do nó raiz, os tipos de nó e os índices usados
+        (e, com `com_texto`, o plano em texto de mais uma execução).
+        """
+        melhor = None
+        with connection.cursor() as cursor:
+            for _ in range(repeticoes):
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+                plano = cursor.fetchone()[0]
+                if isinstance(plano, str):
+                    plano = json.loads(plano)
+                plano = plano[0]
+                if melhor is None or plano["Execution Time"] < melhor["Execution Time"]:
+                    melhor = plano
+
+            texto = ""
+            if com_texto:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params)
+                texto = "\n".join(f"      {linha}" for (linha,) in cursor.fetchall())
+
+        nos, indices = set(), set()
+        pendentes = [melhor["Plan"]]
+        while pendentes:
+            no = pendentes.pop()
+            nos.add(no["Node Type"])
+            if "Index Name" in no:
+                indices.add(no["Index Name"])
+            pendentes.extend(no.get("Plans", []))
+
+        return {
+            "execucao": melhor["Execution Time"],
+            "linhas": melhor["Plan"]["Actual Rows"],
+            "nos": nos,
+            "indices": indices,
+            "texto": texto,
+        }
+
+    def _limpar(self):
+        tabela = connection.ops.quote_name(Documento._meta.db_table)
+        # DELETE direto: o delete() do ORM carregaria milhões de objetos para o cascade
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {tabela} WHERE cdc LIKE %s", [f"{PREFIXO}%"])
+            documentos = cursor.rowcount
+        _, emissores = Emissor.objects.filter(code__startswith=PREFIXO).delete()
+        _, empresas = Company.objects.filter(name__startswith=f"{PREFIXO} ").delete()
+        Departamento.objects.filter(code=PREFIXO).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"🧹 {documentos} documento(s) sintético(s), {emissores.get('emissores.Emissor', 0)} emissor(es) e "
+            f"{empresas.get('companies.Company', 0)} empresa(s) de benchmark apagados."
+        ))
@@ -0,0 +1,84 @@
+import os
+import glob
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from documentos.models import Documento
+from documentos.sifen import BACKENDS, extrair_dados_nfe
+
+
+class Command(BaseCommand):
+    help = "Compara a velocidade (docs/s) dos parsers de XML SIFEN: xml.etree x lxml"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dir", default="",
+            help="Diretório com XMLs a usar (padrão: XMLs gravados em Documento)"
+        )
+        parser.add_argument(
+            "--pattern", default="*.xml",
+            help="Glob pattern dos arquivos em --dir (padrão: *.xml)"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=1000,
+            help="Quantidade máxima de XMLs (padrão: 1000)"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3,
+            help="Rodadas por backend; vale a mais rápida (padrão: 3)"
+        )
+
+    def handle(self, *args, **opts):
+        xmls = self._carregar(opts)
+        if not xmls:
+            raise CommandError("Nenhum XML encontrado para o benchmark.")
+        self.stdout.write(f"📄 {len(xmls)} XML(s), {opts['repeat']} rodada(s) por backend.")
+
+        # Só entram no benchmark os XMLs que o parser atual aceita
+        validos = []
+        for xml in xmls:
+            try:
+                validos.append((xml, extrair_dados_nfe(xml, "etree")))
+            except Exception:
+                pass
+        if len(validos) < len(xmls):
+            self.stdout.write(self.style.WARNING(f"⚠️ {len(xmls) - len(validos)} XML(s) inválido(s) ignorado(s)."))
+        if not validos:
+            raise CommandError("Nenhum XML válido para o benchmark.")
+
+        divergentes = sum(1 for xml, dados in validos if extrair_dados_nfe(xml, "lxml") != dados)
+        if divergentes:
+            self.stdout.write(self.style.ERROR(f"❌ {divergentes} XML(s) com resultado diferente entre os backends."))
+
+        tempos = {}
+        for backend in BACKENDS:
+            melhor = None
+            for _ in range(max(opts["repeat"], 1)):
+                inicio = time.perf_counter()
+                for xml, _dados in validos:
+                    extrair_dados_nfe(xml, backend)
+                decorrido = time.perf_counter() - inicio
+                melhor = decorrido if melhor is None else min(melhor, decorrido)
+            tempos[backend] = melhor
+            self.stdout.write(
+                f"⏱️ {backend:<6} {melhor:.3f}s  ({len(validos) / melhor:,.0f} docs/s, "
+                f"{melhor / len(validos) * 1e6:,.0f} µs/doc)"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ lxml/etree: {tempos['etree'] / tempos['lxml']:.2f}x "
+            f"(backend em uso: SIFEN_XML_BACKEND={settings.SIFEN_XML_BACKEND})"
+        ))
+
+    def _carregar(self, opts):
+        limit = opts["limit"]
+        if opts["dir"]:
+            files = sorted(glob.glob(os.path.join(settings.BASE_DIR, opts["dir"], opts["pattern"])))[:limit]
+            xmls = []
+            for path in files:
+                with open(path, "rb") as f:
+                    xmls.append(f.read())
+            return xmls
+        documentos = Documento.objects.order_by("-id").only("xml_sha256", "documento_xml_zlib", "documento_xml_texto")[:limit]
+        return [documento.documento_xml for documento in documentos]
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from documentos.ingestao import consumir_anexos_pendentes
+from documentos.parse_paralelo import numero_workers
+
+
+class Command(BaseCommand):
+    help = "Consome a fila de anexos pendentes (AnexoPendente) com parse em vários processos"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=0,
+            help="Processos para o parse dos XMLs (padrão: XML_PARSE_WORKERS)"
+        )
+        parser.add_argument(
+            "--lote", type=int, default=0,
+            help="Anexos por lote (padrão: STAGING_LOTE)"
+        )
+        parser.add_argument(
+            "--max-lotes", type=int, default=0,
+            help="Para depois de N lotes (0 = até esvaziar a fila)"
+        )
+
+    def handle(self, *args, **opts):
+        workers = numero_workers(opts["workers"])
+        self.stdout.write(f"📦 Consumindo a fila de anexos com {workers} processo(s) de parse…")
+        resumo = consumir_anexos_pendentes(
+            tamanho_lote=opts["lote"] or None,
+            max_lotes=opts["max_lotes"] or None,
+            workers=workers,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {resumo['anexos']} anexo(s): ok {resumo['ok']}; duplicados {resumo['duplicados']}; "
+            f"ignorados {resumo['ignorados']}; erros {resumo['erros']}."
+        ))
@@ -0,0 +1,79 @@
+import time
+from datetime import timedelta
+from django.core.files.storage import storages
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from documentos.blobs_xml import STORAGE_XML, sha256_da_chave
+from documentos.models import Documento
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove do storage documentos_xml os arquivos que nenhum Documento referencia. O XML é gravado "
+        "antes da transação do documento (gravar_documentos); se ela sofre rollback, o arquivo fica sem "
+        "dono. Arquivos recentes são preservados, pois podem pertencer a uma gravação em andamento."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--idade-minima", type=float, default=24,
+            help="Só remove arquivos com mais de N horas (padrão: 24)"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Só lista os arquivos órfãos, sem remover"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Pausa em segundos entre os diretórios, para aliviar o banco e o storage (padrão: 0)"
+        )
+
+    def handle(self, *args, **opts):
+        storage = storages[STORAGE_XML]
+        limite = timezone.now() - timedelta(hours=opts["idade_minima"])
+        verificados = 0
+        orfaos = 0
+        inicio = time.monotonic()
+
+        for diretorio, chaves in self._diretorios(storage):
+            # Uma consulta por diretório (índice documento_xml_sha256_idx)
+            por_sha = {sha256_da_chave(chave): chave for chave in chaves}
+            por_sha.pop('', None)
+            referenciados = set(
+                Documento.objects.filter(xml_sha256__in=list(por_sha)).values_list("xml_sha256", flat=True)
+            )
+            verificados += len(por_sha)
+            for sha256, chave in por_sha.items():
+                if sha256 in referenciados or not self._antigo(storage, chave, limite):
+                    continue
+                orfaos += 1
+                if opts["dry_run"]:
+                    self.stdout.write(f"   🗑️ {chave}")
+                else:
+                    storage.delete(chave)
+            if opts["sleep"]:
+                time.sleep(opts["sleep"])
+
+        acao = "encontrado(s)" if opts["dry_run"] else "removido(s)"
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {verificados} arquivo(s) verificado(s); {orfaos} órfão(s) {acao} em {time.monotonic() - inicio:.1f}s."
+        ))
+
+    def _diretorios(self, storage):
+        # Estrutura de chave_xml: ab/cd/<sha256>.xml.z
+        primeiros, _ = storage.listdir("")
+        for primeiro in sorted(primeiros):
+            segundos, _ = storage.listdir(primeiro)
+            for segundo in sorted(segundos):
+                diretorio = f"{primeiro}/{segundo}"
+                _, arquivos = storage.listdir(diretorio)
+                if arquivos:
+                    yield diretorio, [f"{diretorio}/{nome}" for nome in arquivos]
+
+    def _antigo(self, storage, chave, limite):
+        try:
+            return storage.get_modified_time(chave) < limite
+        except (NotImplementedError, OSError):
+            # Sem data de modificação não há como saber se a gravação terminou
+            return False
@@ -0,0 +1,87 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documentos.blobs_xml import descomprimir_xml, guardar_xml
+from documentos.models import Documento
+
+
+class Command(BaseCommand):
+    help = (
+        "Move o XML das linhas antigas de Documento (colunas documento_xml_texto / documento_xml_zlib) "
+        "para o storage documentos_xml, em lotes. Pode ser interrompido e executado de novo: continua "
+        "das linhas que faltam."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Documentos migrados por transação (padrão: 500)"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=0,
+            help="Máximo de documentos a migrar nesta execução (0 = todos)"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Pausa em segundos entre os lotes, para aliviar o banco (padrão: 0)"
+        )
+
+    def handle(self, *args, **opts):
+        batch_size = max(1, opts["batch_size"])
+        limit = opts["limit"]
+        pendentes = Documento.objects.filter(xml_sha256="")
+        total = pendentes.count()
+        if limit:
+            total = min(total, limit)
+        self.stdout.write(f"📦 {total} documento(s) a migrar para o storage, em lotes de {batch_size}.")
+
+        migrados = 0
+        bytes_xml = 0
+        digests = set()
+        ultimo_id = 0
+        inicio = time.monotonic()
+        while not limit or migrados < limit:
+            tamanho = batch_size if not limit else min(batch_size, limit - migrados)
+            # Paginação pela PK: cada lote é uma consulta curta pelo índice
+            lote = list(
+                pendentes.filter(pk__gt=ultimo_id)
+                .order_by("pk")
+                .values_list("pk", "documento_xml_zlib", "documento_xml_texto")[:tamanho]
+            )
+            if not lote:
+                break
+
+            documentos = []
+            for pk, zlib_xml, texto in lote:
+                documento = Documento(pk=pk, documento_xml_zlib=None, documento_xml_texto='')
+                documento.xml_sha256, documento.xml_tamanho = guardar_xml(
+                    descomprimir_xml(zlib_xml) if zlib_xml is not None else texto
+                )
+                documentos.append(documento)
+                bytes_xml += documento.xml_tamanho
+                digests.add(documento.xml_sha256)
+
+            # Os arquivos já estão no storage; bulk_update não mexe em updated_at
+            with transaction.atomic():
+                Documento.objects.bulk_update(
+                    documentos, ["xml_sha256", "xml_tamanho", "documento_xml_zlib", "documento_xml_texto"]
+                )
+
+            migrados += len(lote)
+            ultimo_id = lote[-1][0]
+            self.stdout.write(f"   💾 {migrados}/{total} (até id {ultimo_id}), {time.monotonic() - inicio:.1f}s")
+            if opts["sleep"]:
+                time.sleep(opts["sleep"])
+
+        if not migrados:
+            self.stdout.write(self.style.SUCCESS("✅ Nenhum documento pendente."))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {migrados} documento(s) migrado(s) ({bytes_xml / 1024 / 1024:.1f} MB de XML) "
+            f"para {len(digests)} arquivo(s) distinto(s)."
+        ))
+        self.stdout.write(
+            "ℹ️ O espaço liberado só volta ao sistema depois de um VACUUM FULL (ou pg_repack) em documentos_documento."
+        )
@@ -0,0 +1,93 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from documentos.models import Documento
+from documentos.parse_paralelo import extrair_conteudos, numero_workers
+from documentos.util import CAMPOS_CABECALHO
+
+
+class Command(BaseCommand):
+    help = (
+        "Preenche as colunas do cabeçalho (receptor, moeda, IVA, condição, timbrado, número completo) "
+        "dos documentos gravados antes delas, relendo o XML com o parse em paralelo. Cada documento "
+        "lido é marcado (campos_extraidos); os com erro no XML ficam marcados como erro e só são "
+        "relidos com --repetir-erros. Pode ser interrompido e executado de novo."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Documentos por lote (parse + gravação) (padrão: 500)"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=0,
+            help="Máximo de documentos a processar nesta execução (0 = todos)"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=0,
+            help="Processos para o parse dos XMLs (padrão: XML_PARSE_WORKERS)"
+        )
+        parser.add_argument(
+            "--repetir-erros", action="store_true",
+            help="Relê também os documentos cujo XML deu erro em uma execução anterior"
+        )
+
+    def handle(self, *args, **opts):
+        batch_size = max(1, opts["batch_size"])
+        limit = opts["limit"]
+        workers = numero_workers(opts["workers"])
+        # Não basta numero_completo vazio: um XML sem dEst/dPunExp continuaria pendente para sempre
+        filtro = Q(campos_extraidos=False)
+        if opts["repetir_erros"]:
+            filtro |= Q(campos_extraidos__isnull=True)
+        pendentes = Documento.objects.filter(filtro).only(
+            "id", "cdc", "xml_sha256", "documento_xml_zlib", "documento_xml_texto"
+        )
+        total = pendentes.count()
+        if limit:
+            total = min(total, limit)
+        self.stdout.write(f"🧾 {total} documento(s) a preencher, com {workers} processo(s) de parse…")
+
+        processados = 0
+        falhas = 0
+        ultimo_id = 0
+        inicio = time.monotonic()
+        while not limit or processados < limit:
+            tamanho = batch_size if not limit else min(batch_size, limit - processados)
+            documentos = list(pendentes.filter(pk__gt=ultimo_id).order_by("pk")[:tamanho])
+            if not documentos:
+                break
+
+            por_pk = {documento.pk: documento for documento in documentos}
+            resultados = extrair_conteudos(
+                [(documento.pk, documento.documento_xml) for documento in documentos],
+                workers=workers,
+            )
+            atualizados = []
+            com_erro = []
+            for pk, dados, erro in resultados:
+                documento = por_pk[pk]
+                if erro:
+                    falhas += 1
+                    com_erro.append(pk)
+                    self.stdout.write(self.style.ERROR(f"   ❌ {documento.cdc}: {erro['mensagem']}"))
+                    continue
+                for campo in CAMPOS_CABECALHO:
+                    setattr(documento, campo, dados[0][campo])
+                documento.campos_extraidos = True
+                atualizados.append(documento)
+
+            # bulk_update/update não mexem em updated_at (auto_now só vale no save)
+            with transaction.atomic():
+                Documento.objects.bulk_update(atualizados, [*CAMPOS_CABECALHO, "campos_extraidos"])
+                Documento.objects.filter(pk__in=com_erro).update(campos_extraidos=None)
+
+            processados += len(documentos)
+            ultimo_id = documentos[-1].pk
+            self.stdout.write(f"   💾 {processados}/{total} (até id {ultimo_id}), {time.monotonic() - inicio:.1f}s")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {processados - falhas} documento(s) preenchido(s); {falhas} com erro."
+        ))
@@ -0,0 +1,96 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from documentos.models import Documento
+from documentos.parse_paralelo import extrair_conteudos, numero_workers
+from documentos.util import gravar_itens
+
+
+class Command(BaseCommand):
+    help = (
+        "Preenche DocumentoItem dos documentos gravados antes da extração de itens, relendo o XML "
+        "com o parse em paralelo. Cada documento lido é marcado (itens_extraidos), inclusive os sem "
+        "itens no XML; os com erro no XML ficam marcados como erro e só são relidos com --repetir-erros. "
+        "Pode ser interrompido e executado de novo."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Documentos por lote (parse + gravação) (padrão: 500)"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=0,
+            help="Máximo de documentos a processar nesta execução (0 = todos)"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=0,
+            help="Processos para o parse dos XMLs (padrão: XML_PARSE_WORKERS)"
+        )
+        parser.add_argument(
+            "--repetir-erros", action="store_true",
+            help="Relê também os documentos cujo XML deu erro em uma execução anterior"
+        )
+
+    def handle(self, *args, **opts):
+        batch_size = max(1, opts["batch_size"])
+        limit = opts["limit"]
+        workers = numero_workers(opts["workers"])
+        filtro = Q(itens_extraidos=False)
+        if opts["repetir_erros"]:
+            filtro |= Q(itens_extraidos__isnull=True)
+        pendentes = Documento.objects.filter(filtro).only(
+            "id", "cdc", "xml_sha256", "documento_xml_zlib", "documento_xml_texto"
+        )
+        self.stdout.write(f"🧾 Preenchendo itens de documentos pendentes, com {workers} processo(s) de parse…")
+
+        processados = 0
+        itens_gravados = 0
+        sem_itens = 0
+        falhas = 0
+        ultimo_id = 0
+        inicio = time.monotonic()
+        while not limit or processados < limit:
+            tamanho = batch_size if not limit else min(batch_size, limit - processados)
+            # Paginação pela PK: cada lote é uma consulta curta pelo índice
+            documentos = list(pendentes.filter(pk__gt=ultimo_id).order_by("pk")[:tamanho])
+            if not documentos:
+                break
+
+            por_pk = {documento.pk: documento for documento in documentos}
+            resultados = extrair_conteudos(
+                [(documento.pk, documento.documento_xml) for documento in documentos],
+                workers=workers,
+            )
+            lote = []
+            com_erro = []
+            for pk, dados, erro in resultados:
+                if erro:
+                    falhas += 1
+                    com_erro.append(pk)
+                    self.stdout.write(self.style.ERROR(f"   ❌ {por_pk[pk].cdc}: {erro['mensagem']}"))
+                    continue
+                itens = dados[0].get("itens") or []
+                if not itens:
+                    sem_itens += 1
+                lote.append((por_pk[pk], itens))
+
+            # Itens e marcação na mesma transação; update() não mexe em updated_at
+            with transaction.atomic():
+                itens_gravados += gravar_itens(lote)
+                Documento.objects.filter(pk__in=[documento.pk for documento, _ in lote]).update(itens_extraidos=True)
+                Documento.objects.filter(pk__in=com_erro).update(itens_extraidos=None)
+
+            processados += len(documentos)
+            ultimo_id = documentos[-1].pk
+            self.stdout.write(
+                f"   💾 {processados} documento(s), {itens_gravados} item(ns) (até id {ultimo_id}), "
+                f"{time.monotonic() - inicio:.1f}s"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {processados} documento(s) lido(s): {itens_gravados} item(ns) gravado(s); "
+            f"{sem_itens} sem itens no XML; {falhas} com erro."
+        ))
@@ -1,21 +1,35 @@
-from django.core.management.base import BaseCommand
-from documentos.util import processar_nfe_xml
+from django.core.management.base import BaseCommand, CommandError
+from companies.models import Company
+from documentos.perfil import perfilar
+from documentos.util import processar_arquivo_nfe
 
 class Command(BaseCommand):
-    help = 'Processa um arquivo XML de nota fiscal paraguaia'
+    help = 'Processa um arquivo XML de nota fiscal paraguaia (um DE ou um lote rLoteDE)'
 
     def add_arguments(self, parser):
         parser.add_argument('xml_path', type=str, help='Caminho do arquivo XML')
+        parser.add_argument('--company', type=int, required=True, help='ID da empresa (Company) dona dos documentos')
+        parser.add_argument('--batch-size', type=int, default=500, help='Documentos gravados por lote (padrão: 500)')
+        parser.add_argument('--profile', action='store_true', help='Grava perfil cProfile e contagem de SQL em PROFILE_DIR')
 
     def handle(self, *args, **kwargs):
         xml_path = kwargs['xml_path']
         try:
-            with open(xml_path, 'r', encoding='utf-8') as f:
-                xml = f.read()
-                doc, created = processar_nfe_xml(xml)
-                if created:
-                    self.stdout.write(self.style.SUCCESS(f"Documento {doc.cdc} criado com sucesso!"))
-                else:
-                    self.stdout.write(self.style.WARNING(f"Documento {doc.cdc} já existia."))
+            company = Company.objects.get(pk=kwargs['company'])
+        except Company.DoesNotExist:
+            raise CommandError(f"Empresa {kwargs['company']} não encontrada.")
+
+        try:
+            # Leitura em streaming: o arquivo não é carregado inteiro na memória
+            with perfilar('processa_xml', ativo=kwargs['profile']):
+                resumo = processar_arquivo_nfe(xml_path, company, tamanho_lote=max(1, kwargs['batch_size']))
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"Erro ao processar XML: {e}"))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{resumo['documentos']} documento(s) processado(s): {resumo['criados']} criado(s), "
+            f"{resumo['documentos'] - resumo['criados']} já existia(m)."
+        ))
+        if resumo['erros']:
+            self.stdout.write(self.style.WARNING(f"{resumo['erros']} DE com erro."))
@@ -5,8 +5,11 @@ import traceback
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-# ajuste o import para onde sua função realmente está
-from documentos.util import processar_nfe_xml  # EXEMPLO
+from companies.models import Company
+from documentos.cache_referencias import imprimir_estatisticas_cache
+from documentos.parse_paralelo import extrair_arquivos, numero_workers
+from documentos.perfil import perfilar
+from documentos.util import gravar_documentos
 
 class Command(BaseCommand):
     help = "Reprocessa XMLs com erro salvos em xmls_erros/"
@@ -36,8 +39,28 @@ class Command(BaseCommand):
             "--show-snippet", type=int, default=300,
             help="Tamanho do snippet de XML ao logar erro (padrão: 300)"
         )
+        parser.add_argument(
+            "--company", type=int, required=True,
+            help="ID da empresa (Company) dona dos documentos reprocessados"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="XMLs gravados por lote no banco (padrão: 500)"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=0,
+            help="Processos para o parse dos XMLs (padrão: XML_PARSE_WORKERS)"
+        )
+        parser.add_argument(
+            "--profile", action="store_true",
+            help="Grava perfil cProfile e contagem de SQL em PROFILE_DIR (use --workers 1 para incluir o parse)"
+        )
 
     def handle(self, *args, **opts):
+        with perfilar("reprocess_xml_erros", ativo=opts["profile"]):
+            self._reprocessar(opts)
+
+    def _reprocessar(self, opts):
         base_dir = settings.BASE_DIR
         src_dir = os.path.join(base_dir, opts["dir"])
         pattern = os.path.join(src_dir, opts["pattern"])
@@ -57,61 +80,93 @@ class Command(BaseCommand):
         if opts["move_fail"]:
             os.makedirs(fail_dir, exist_ok=True)
 
-        total = len(files)
-        ok_count = 0
-        fail_count = 0
-
-        self.stdout.write(f"🔁 Reprocessando {total} arquivo(s) de {src_dir}…\n")
+        try:
+            company = Company.objects.get(pk=opts["company"])
+        except Company.DoesNotExist:
+            raise CommandError(f"Empresa {opts['company']} não encontrada.")
 
-        for i, path in enumerate(files, 1):
-            fname = os.path.basename(path)
-            self.stdout.write(f"[{i}/{total}] 📄 {fname}")
+        total = len(files)
+        self.ok_count = 0
+        self.fail_count = 0
+
+        workers = numero_workers(opts["workers"])
+        self.stdout.write(f"🔁 Reprocessando {total} arquivo(s) de {src_dir} com {workers} processo(s) de parse…\n")
+
+        # Parse em paralelo (processos); gravação no banco em lotes (gravar_documentos)
+        batch_size = max(1, opts["batch_size"])
+        for inicio in range(0, total, batch_size):
+            lote = []
+            resultados = extrair_arquivos(files[inicio:inicio + batch_size], workers=workers)
+            for i, (path, documentos, erro) in enumerate(resultados, inicio + 1):
+                self.stdout.write(f"[{i}/{total}] 📄 {os.path.basename(path)}")
+
+                if erro:
+                    self._falha(path, erro["mensagem"], self._snippet(path, opts), opts, fail_dir, erro["traceback"])
+                elif documentos is None:
+                    # checa assinatura rápida (ajuste conforme sua regra)
+                    self.stdout.write(self.style.WARNING(f"   ⏩ ignorado: não parece um DE válido."))
+                    self._sucesso(path, opts, ok_dir)
+                else:
+                    lote.append((path, documentos))
 
-            try:
-                # tenta ler como UTF-8; se seus XMLs tiverem encoding variado,
-                # podemos melhorar para detectar encoding depois
-                with open(path, "r", encoding="utf-8", errors="replace") as f:
-                    xml_content = f.read()
+            self._gravar_lote(lote, company, opts, ok_dir, fail_dir)
 
-                # checa assinatura rápida (ajuste conforme sua regra)
-                if "<DE Id=" not in xml_content:
-                    self.stdout.write(self.style.WARNING(f"   ⏩ ignorado: não parece um DE válido."))
-                    if opts["move_ok"]:
-                        os.replace(path, os.path.join(ok_dir, fname))
-                    ok_count += 1
-                    continue
+        self.stdout.write("\n📊 Resultado:")
+        self.stdout.write(self.style.SUCCESS(f"   OK   : {self.ok_count}"))
+        self.stdout.write(self.style.ERROR(  f"   FAIL : {self.fail_count}"))
+        self.stdout.write(f"   TOTAL: {total}")
+        imprimir_estatisticas_cache()
 
-                doc, created = processar_nfe_xml(xml_content)
+    def _gravar_lote(self, lote, company, opts, ok_dir, fail_dir):
+        if not lote:
+            return
+        try:
+            _, novos = gravar_documentos([dados for _, documentos in lote for dados in documentos], company)
+        except Exception as e:
+            if len(lote) == 1:
+                path, documentos = lote[0]
+                self._falha(path, e, self._snippet(path, opts), opts, fail_dir)
+                return
+            # Isola o XML problemático gravando um a um
+            self.stdout.write(self.style.WARNING(f"   ⚠️ Falha na gravação em lote ({e}); gravando um a um."))
+            for item in lote:
+                self._gravar_lote([item], company, opts, ok_dir, fail_dir)
+            return
 
-                if created:
-                    self.stdout.write(self.style.SUCCESS(f"   ✅ Documento {getattr(doc, 'cdc', '(sem cdc)')} criado."))
+        self.stdout.write(f"   💾 Lote gravado: {len(lote)} XML(s), {len(novos)} documento(s) novo(s).")
+        for path, documentos in lote:
+            for dados in documentos:
+                cdc = dados["cdc"]
+                if cdc in novos:
+                    novos.discard(cdc)
+                    self.stdout.write(self.style.SUCCESS(f"   ✅ Documento {cdc} criado."))
                 else:
-                    self.stdout.write(self.style.NOTICE(f"   ⚠️ Documento {getattr(doc, 'cdc', '(sem cdc)')} já existia."))
-
-                if opts["move_ok"]:
-                    os.replace(path, os.path.join(ok_dir, fname))
-                ok_count += 1
-
-            except Exception as e:
-                fail_count += 1
-                self.stdout.write(self.style.ERROR(f"   ❌ Erro: {e}"))
-                # trecho do XML para ajudar a debugar
-                snippet_len = opts["show_snippet"]
-                try:
-                    snippet = xml_content[:snippet_len] if "xml_content" in locals() else "(sem conteúdo lido)"
-                except Exception:
-                    snippet = "(falha ao gerar snippet)"
-                self.stdout.write(f"   📄 Snippet:\n{snippet}\n")
-                self.stdout.write(self.style.WARNING("   🔎 Traceback:"))
-                self.stdout.write(traceback.format_exc())
-
-                if opts["move_fail"]:
-                    try:
-                        os.replace(path, os.path.join(fail_dir, fname))
-                    except Exception as move_err:
-                        self.stdout.write(self.style.WARNING(f"   ⚠️ Falha ao mover para fail: {move_err}"))
+                    self.stdout.write(self.style.NOTICE(f"   ⚠️ Documento {cdc} já existia."))
+            self._sucesso(path, opts, ok_dir)
 
-        self.stdout.write("\n📊 Resultado:")
-        self.stdout.write(self.style.SUCCESS(f"   OK   : {ok_count}"))
-        self.stdout.write(self.style.ERROR(  f"   FAIL : {fail_count}"))
-        self.stdout.write(f"   TOTAL: {total}")
+    def _sucesso(self, path, opts, ok_dir):
+        if opts["move_ok"]:
+            os.replace(path, os.path.join(ok_dir, os.path.basename(path)))
+        self.ok_count += 1
+
+    def _snippet(self, path, opts):
+        # trecho do XML para ajudar a debugar
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                return f.read(opts["show_snippet"])
+        except Exception:
+            return None
+
+    def _falha(self, path, e, xml_content, opts, fail_dir, tb=None):
+        self.fail_count += 1
+        self.stdout.write(self.style.ERROR(f"   ❌ Erro em {os.path.basename(path)}: {e}"))
+        snippet = xml_content[:opts["show_snippet"]] if xml_content is not None else "(sem conteúdo lido)"
+        self.stdout.write(f"   📄 Snippet:\n{snippet}\n")
+        self.stdout.write(self.style.WARNING("   🔎 Traceback:"))
+        self.stdout.write(tb or traceback.format_exc())
+
+        if opts["move_fail"]:
+            try:
+                os.replace(path, os.path.join(fail_dir, os.path.basename(path)))
+            except Exception as move_err:
+                self.stdout.write(self.style.WARNING(f"   ⚠️ Falha ao mover para fail: {move_err}"))
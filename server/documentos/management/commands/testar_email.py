@@ -1,4 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
+from documentos.imap import HEADER_FIELDS, listar_partes_xml, parse_fetch_response
+from documentos.perfil import perfilar
 from emails.models import User
 import imaplib
 import email
@@ -11,8 +13,13 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("username", type=str, help="Username da conta de e-mail cadastrada no sistema")
         parser.add_argument("--max", type=int, default=20, help="Máximo de e-mails a inspecionar (padrão 20)")
+        parser.add_argument("--profile", action="store_true", help="Grava perfil cProfile e contagem de SQL em PROFILE_DIR")
 
     def handle(self, *args, **options):
+        with perfilar("testar_email", ativo=options["profile"]):
+            self._testar(options)
+
+    def _testar(self, options):
         username = options["username"]
         max_emails = options["max"]
 
@@ -42,22 +49,18 @@ class Command(BaseCommand):
 
             nf_count = 0
             for num in ids[-max_emails:]:  # pega os mais recentes
-                status, fetch_data = mail.fetch(num, "(RFC822)")
+                # Só a estrutura e os cabeçalhos: não baixa os anexos
+                status, fetch_data = mail.fetch(num, f"(BODYSTRUCTURE {HEADER_FIELDS})")
                 if status != "OK":
                     continue
 
-                raw_email = fetch_data[0][1]
-                msg = email.message_from_bytes(raw_email, policy=policy.default)
+                dados = parse_fetch_response(fetch_data).get(int(num)) or {}
+                msg = email.message_from_bytes(dados.get("BODY[HEADER]") or b"", policy=policy.default)
 
                 assunto = msg.get("subject", "(sem assunto)")
                 remetente = msg.get("from", "")
 
-                encontrou_xml = False
-                for part in msg.iter_attachments():
-                    filename = part.get_filename()
-                    if filename and filename.lower().endswith(".xml"):
-                        encontrou_xml = True
-                        break
+                encontrou_xml = bool(listar_partes_xml(dados.get("BODYSTRUCTURE")))
 
                 if encontrou_xml:
                     nf_count += 1
@@ -0,0 +1,100 @@
+import hmac
+import time
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+# Com settings.PROMETHEUS_MULTIPROC_DIR (mesmo diretório para o Django e os
+# workers Celery), cada processo grava seus valores em arquivos .db nesse
+# diretório e o /metrics soma todos eles.
+
+MENSAGENS_BAIXADAS = Counter(
+    'ingestao_mensagens_baixadas', 'Mensagens de e-mail lidas e processadas', ['conta'],
+)
+ANEXOS_PROCESSADOS = Counter(
+    'ingestao_anexos_processados', 'Anexos XML enviados ao parse', ['conta'],
+)
+DOCUMENTOS_CRIADOS = Counter(
+    'ingestao_documentos_criados', 'Documentos novos gravados', ['conta'],
+)
+BYTES_BAIXADOS = Counter(
+    'ingestao_bytes_baixados', 'Bytes de anexos baixados (antes de descompactar)', ['conta'],
+)
+ETAPA_SEGUNDOS = Histogram(
+    'ingestao_etapa_segundos', 'Duração de cada etapa da leitura (parse, gravacao, download...)',
+    ['conta', 'etapa'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+REQUISICAO_SEGUNDOS = Histogram(
+    'api_requisicao_segundos', 'Latência das views da API medidas (ver VIEWS_MEDIDAS)',
+    ['view', 'metodo', 'status'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+# url_name das views com latência medida pelo MetricasRequisicaoMiddleware
+VIEWS_MEDIDAS = {
+    'documento-list',
+    'documento-download-excel',
+    'documento-download-xml',
+    'documento-download-pdf',
+}
+
+
+def observar_etapa(resumo, etapa, segundos):
+    ETAPA_SEGUNDOS.labels(conta=resumo.get('conta') or '', etapa=etapa).observe(segundos)
+
+def registrar_conta(resumo):
+    """
+    Soma nos contadores as contagens do resumo de uma conta, ao fim da leitura.
+    """
+    conta = resumo.get('conta') or ''
+    MENSAGENS_BAIXADAS.labels(conta=conta).inc(resumo.get('processados') or 0)
+    DOCUMENTOS_CRIADOS.labels(conta=conta).inc(resumo.get('criados') or 0)
+    BYTES_BAIXADOS.labels(conta=conta).inc(resumo.get('bytes') or 0)
+
+def metricas_view(request):
+    """
+    Métricas no formato texto do Prometheus. As séries trazem o e-mail de cada
+    conta (label conta), então nunca são públicas: exige o cabeçalho
+    "Authorization: Bearer <METRICS_TOKEN>" ou um usuário staff logado (admin).
+    Sem METRICS_TOKEN, só o staff tem acesso.
+    """
+    if not _autorizado(request):
+        return HttpResponseForbidden()
+
+    if settings.PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+def _autorizado(request):
+    token = settings.METRICS_TOKEN
+    enviado = request.headers.get('Authorization', '').encode()
+    if token and hmac.compare_digest(enviado, f"Bearer {token}".encode()):
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_authenticated and user.is_staff)
+
+
+class MetricasRequisicaoMiddleware:
+    """
+    Mede a latência das views listadas em VIEWS_MEDIDAS (listagem, exportação
+    Excel e downloads de PDF/XML), por view, método e status.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inicio = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name in VIEWS_MEDIDAS:
+            REQUISICAO_SEGUNDOS.labels(
+                view=match.url_name, metodo=request.method, status=response.status_code,
+            ).observe(time.perf_counter() - inicio)
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0005_anexoprocessado'),
+        ('emails', '0007_user_office365_delta_link'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnexoPendente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.TextField(blank=True)),
+                ('received_from', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(blank=True, null=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('mime_type', models.CharField(blank=True, max_length=100)),
+                ('payload', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='anexos_pendentes', to='emails.user')),
+            ],
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:35
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0006_anexopendente'),
+        ('emails', '0007_user_office365_delta_link'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('messages_found', models.PositiveIntegerField(default=0)),
+                ('messages_processed', models.PositiveIntegerField(default=0)),
+                ('messages_deleted', models.PositiveIntegerField(default=0)),
+                ('bytes_downloaded', models.BigIntegerField(default=0)),
+                ('documents_created', models.PositiveIntegerField(default=0)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+                ('queued', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('connect_seconds', models.FloatField(default=0)),
+                ('search_seconds', models.FloatField(default=0)),
+                ('fetch_seconds', models.FloatField(default=0)),
+                ('parse_seconds', models.FloatField(default=0)),
+                ('db_seconds', models.FloatField(default=0)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('engine', models.CharField(blank=True, max_length=20)),
+                ('accounts', models.PositiveIntegerField(default=0)),
+                ('accounts_failed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('-started_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='IngestRunAccount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('messages_found', models.PositiveIntegerField(default=0)),
+                ('messages_processed', models.PositiveIntegerField(default=0)),
+                ('messages_deleted', models.PositiveIntegerField(default=0)),
+                ('bytes_downloaded', models.BigIntegerField(default=0)),
+                ('documents_created', models.PositiveIntegerField(default=0)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+                ('queued', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('connect_seconds', models.FloatField(default=0)),
+                ('search_seconds', models.FloatField(default=0)),
+                ('fetch_seconds', models.FloatField(default=0)),
+                ('parse_seconds', models.FloatField(default=0)),
+                ('db_seconds', models.FloatField(default=0)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('account', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ingest_runs', to='emails.user')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='account_runs', to='documentos.ingestrun')),
+            ],
+            options={
+                'ordering': ('started_at',),
+            },
+        ),
+    ]
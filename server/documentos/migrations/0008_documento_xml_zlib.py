@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0007_ingestrun'),
+    ]
+
+    # O XML atual continua na coluna de texto (renomeada); a migração para o
+    # storage documentos_xml é feita em lotes pelo comando migrar_documentos_xml.
+    operations = [
+        migrations.RenameField(
+            model_name='documento',
+            old_name='documento_xml',
+            new_name='documento_xml_texto',
+        ),
+        migrations.AlterField(
+            model_name='documento',
+            name='documento_xml_texto',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='documento',
+            name='documento_xml_zlib',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+    ]
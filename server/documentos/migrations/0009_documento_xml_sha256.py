@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0008_documento_xml_zlib'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documento',
+            name='xml_sha256',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='documento',
+            name='xml_tamanho',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0009_documento_xml_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentoItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numero', models.PositiveSmallIntegerField()),
+                ('codigo', models.CharField(blank=True, default='', max_length=50)),
+                ('descricao', models.TextField(blank=True, default='')),
+                ('unidade', models.CharField(blank=True, default='', max_length=20)),
+                ('quantidade', models.DecimalField(decimal_places=8, max_digits=18, null=True)),
+                ('preco_unitario', models.DecimalField(decimal_places=8, max_digits=23, null=True)),
+                ('desconto', models.DecimalField(decimal_places=8, default=0, max_digits=23)),
+                ('taxa_iva', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('total', models.DecimalField(decimal_places=8, max_digits=23, null=True)),
+                ('documento', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='itens', to='documentos.documento')),
+            ],
+            options={
+                'ordering': ['documento', 'numero'],
+                'indexes': [models.Index(fields=['codigo'], name='documentoitem_codigo_idx')],
+                'constraints': [models.UniqueConstraint(fields=('documento', 'numero'), name='documentoitem_documento_numero_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:50
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY não roda dentro de transação; em compensação não
+    # bloqueia a gravação de documentos enquanto os índices são criados
+    atomic = False
+
+    dependencies = [
+        ('companies', '0001_initial'),
+        ('documentos', '0011_documento_campos_cabecalho'),
+        ('emissores', '0002_rename_name_emissor_nome_emissor_nome_fantasia'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name='documento',
+            index=models.Index(fields=['company', '-fecha_emision'], name='documento_company_fecha_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='documento',
+            index=models.Index(fields=['company', 'tipo_documento', '-fecha_emision'], name='documento_company_tipo_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='documento',
+            index=models.Index(fields=['emissor', '-fecha_emision'], name='documento_emissor_fecha_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='documento',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('num_doc'), name='gin_trgm_ops'), name='documento_num_doc_trgm'),
+        ),
+        AddIndexConcurrently(
+            model_name='documento',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('receptor_nome'), name='gin_trgm_ops'), name='documento_receptor_nome_trgm'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:20
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY não roda dentro de transação (ver 0012)
+    atomic = False
+
+    dependencies = [
+        ('documentos', '0012_documento_indices_listagem'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='documento',
+            index=models.Index(fields=['xml_sha256'], name='documento_xml_sha256_idx'),
+        ),
+    ]
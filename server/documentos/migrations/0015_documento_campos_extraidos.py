@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documentos', '0014_documento_itens_extraidos'),
+    ]
+
+    operations = [
+        # Linhas existentes ficam pendentes (False); as novas já entram com o cabeçalho (True)
+        migrations.AddField(
+            model_name='documento',
+            name='campos_extraidos',
+            field=models.BooleanField(default=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='documento',
+            name='campos_extraidos',
+            field=models.BooleanField(default=True, null=True),
+        ),
+    ]
@@ -1,5 +1,10 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
+from django.db.models.functions import Upper
+from django.utils import timezone
 from companies.models import Company
+from documentos.blobs_xml import descomprimir_xml, ler_xml
+from documentos.sifen import texto_xml
 from emissores.models import Emissor
 
 class TipoDocumento(models.Model):
@@ -27,9 +32,189 @@ class Documento(models.Model):
     emissor = models.ForeignKey(Emissor, on_delete=models.CASCADE)
     fecha_emision = models.DateTimeField() #dFeEmiDE
     monto_total = models.DecimalField(max_digits=15, decimal_places=2) #dTotOpe
-    documento_xml = models.TextField() # Todo o arquivo XML
+    numero_completo = models.CharField(max_length=40, blank=True, default='', db_index=True) # dEst-dPunExp-dNumDoc
+    timbrado = models.CharField(max_length=20, blank=True, default='', db_index=True) #dNumTim
+    receptor_ruc = models.CharField(max_length=20, blank=True, default='', db_index=True) #dRucRec (ou dNumIDRec)
+    receptor_nome = models.CharField(max_length=255, blank=True, default='') #dNomRec
+    moneda = models.CharField(max_length=3, blank=True, default='') #cMoneOpe
+    condicion_venta = models.PositiveSmallIntegerField(null=True, blank=True) #iCondOpe (1 contado, 2 crédito)
+    total_iva = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True) #dTotIVA
+    iva_5 = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True) #dIVA5
+    iva_10 = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True) #dIVA10
+    # Itens já extraídos do XML (linhas antigas: False até preencher_itens_documentos; None = XML com erro)
+    itens_extraidos = models.BooleanField(null=True, default=True)
+    # Colunas do cabeçalho já extraídas (linhas antigas: False até preencher_campos_documentos; None = XML com erro)
+    campos_extraidos = models.BooleanField(null=True, default=True)
+    xml_sha256 = models.CharField(max_length=64, blank=True, default='') # Chave do XML no storage documentos_xml
+    xml_tamanho = models.PositiveIntegerField(default=0) # Bytes do XML sem compressão
+    # Colunas antigas do XML, só para linhas ainda não migradas (ver migrar_documentos_xml)
+    documento_xml_zlib = models.BinaryField(null=True, blank=True, editable=False)
+    documento_xml_texto = models.TextField(blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Índices dos filtros da DocumentoListView, que sempre ordena por -fecha_emision
+        # (ver benchmark_consultas_documentos)
+        indexes = [
+            models.Index(fields=['company', '-fecha_emision'], name='documento_company_fecha_idx'),
+            models.Index(fields=['company', 'tipo_documento', '-fecha_emision'], name='documento_company_tipo_idx'),
+            models.Index(fields=['emissor', '-fecha_emision'], name='documento_emissor_fecha_idx'),
+            # icontains vira UPPER(coluna::text) LIKE UPPER('%...%'): trigrama sobre a mesma expressão
+            GinIndex(OpClass(Upper('num_doc'), name='gin_trgm_ops'), name='documento_num_doc_trgm'),
+            GinIndex(OpClass(Upper('receptor_nome'), name='gin_trgm_ops'), name='documento_receptor_nome_trgm'),
+            # Arquivos do storage sem documento (ver limpar_xml_orfaos)
+            models.Index(fields=['xml_sha256'], name='documento_xml_sha256_idx'),
+        ]
+
     def __str__(self):
         return f"{self.tipo_documento.name} - {self.est}-{self.pun_exp}-{self.num_doc}"
+
+    @property
+    def documento_xml(self):
+        """
+        XML completo do documento como texto (prólogo em UTF-8, ver texto_xml),
+        lido do storage documentos_xml pelo SHA-256. Linhas ainda não migradas
+        são lidas das colunas antigas.
+        """
+        if self.xml_sha256:
+            return texto_xml(ler_xml(self.xml_sha256))
+        if self.documento_xml_zlib is not None:
+            return texto_xml(descomprimir_xml(self.documento_xml_zlib))
+        return texto_xml(self.documento_xml_texto)
+
+    @property
+    def documento_xml_bytes(self):
+        """
+        Bytes do XML como recebidos (encoding original, declarado no prólogo),
+        para o download. O XML é gravado no storage por guardar_xml, antes do
+        Documento (ver gravar_documentos).
+        """
+        if self.xml_sha256:
+            return ler_xml(self.xml_sha256)
+        return self.documento_xml.encode('utf-8')
+
+class DocumentoItem(models.Model):
+    """
+    Item (gCamItem) de um documento, extraído na gravação para que relatórios
+    por produto sejam consultas SQL, sem reler o XML.
+    """
+    documento = models.ForeignKey(Documento, on_delete=models.CASCADE, related_name='itens')
+    numero = models.PositiveSmallIntegerField() # Ordem do item no XML (1, 2, ...)
+    codigo = models.CharField(max_length=50, blank=True, default='') #dCodInt
+    descricao = models.TextField(blank=True, default='') #dDesProSer
+    unidade = models.CharField(max_length=20, blank=True, default='') #dDesUniMed
+    quantidade = models.DecimalField(max_digits=18, decimal_places=8, null=True) #dCantProSer
+    preco_unitario = models.DecimalField(max_digits=23, decimal_places=8, null=True) #dPUniProSer
+    desconto = models.DecimalField(max_digits=23, decimal_places=8, default=0) #dDescItem
+    taxa_iva = models.PositiveSmallIntegerField(null=True, blank=True) #dTasaIVA (0, 5, 10)
+    total = models.DecimalField(max_digits=23, decimal_places=8, null=True) #dTotOpeItem (ou dTotBruOpeItem)
+
+    class Meta:
+        ordering = ['documento', 'numero']
+        constraints = [
+            models.UniqueConstraint(fields=['documento', 'numero'], name='documentoitem_documento_numero_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['codigo'], name='documentoitem_codigo_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.documento_id} #{self.numero} {self.codigo} {self.descricao}"
+
+class AnexoProcessado(models.Model):
+    """
+    Hash SHA-256 de um anexo XML já processado com sucesso. O leitor de e-mails
+    consulta esta tabela antes de fazer o parse, para ignorar reenvios, cópias
+    e encaminhamentos do mesmo arquivo.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    documento = models.ForeignKey(Documento, on_delete=models.SET_NULL, null=True, blank=True, related_name='anexos')
+    filename = models.CharField(max_length=255, blank=True, default='')
+    size_bytes = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}… ({self.filename})"
+
+class AnexoPendente(models.Model):
+    """
+    Fila (staging) de anexos XML já baixados pelos leitores de e-mail e ainda
+    não processados. Os leitores só gravam aqui; o parse e a gravação dos
+    documentos ficam com os consumidores (ingestao.consumir_anexos_pendentes),
+    que removem as linhas ao terminar.
+    """
+    account = models.ForeignKey('emails.User', on_delete=models.CASCADE, related_name='anexos_pendentes')
+    subject = models.TextField(blank=True)
+    received_from = models.TextField(blank=True)
+    received_at = models.DateTimeField(null=True, blank=True)
+    filename = models.CharField(max_length=255)
+    mime_type = models.CharField(max_length=100, blank=True)
+    payload = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.account_id})"
+
+class IngestMetricas(models.Model):
+    """
+    Contagens e tempo acumulado por etapa de uma leitura de e-mails (campos
+    comuns a IngestRun e IngestRunAccount).
+    """
+    messages_found = models.PositiveIntegerField(default=0)
+    messages_processed = models.PositiveIntegerField(default=0)
+    messages_deleted = models.PositiveIntegerField(default=0)
+    bytes_downloaded = models.BigIntegerField(default=0)  # anexos XML/compactados baixados
+    documents_created = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    queued = models.PositiveIntegerField(default=0)  # anexos enviados para AnexoPendente
+    errors = models.PositiveIntegerField(default=0)  # anexos com erro (EmailXmlError)
+
+    # Tempo acumulado (segundos) em cada etapa
+    connect_seconds = models.FloatField(default=0)
+    search_seconds = models.FloatField(default=0)
+    fetch_seconds = models.FloatField(default=0)
+    parse_seconds = models.FloatField(default=0)
+    db_seconds = models.FloatField(default=0)
+
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def duration_seconds(self):
+        if self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+class IngestRun(IngestMetricas):
+    """
+    Uma execução da leitura de e-mails (todas as contas ativas). Os totais são
+    a soma das linhas IngestRunAccount, calculada ao finalizar a execução.
+    """
+    engine = models.CharField(max_length=20, blank=True)  # sequencial, chord, asyncio ou avulsa
+    accounts = models.PositiveIntegerField(default=0)
+    accounts_failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('-started_at',)
+
+    def __str__(self):
+        return f"{self.engine} {self.started_at:%Y-%m-%d %H:%M:%S}"
+
+class IngestRunAccount(IngestMetricas):
+    """
+    Leitura de uma conta de e-mail dentro de uma IngestRun (uma linha por
+    tentativa, gravada por leitor_email_box / leitor_email_graph).
+    """
+    run = models.ForeignKey(IngestRun, on_delete=models.CASCADE, related_name='account_runs')
+    account = models.ForeignKey('emails.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='ingest_runs')
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('started_at',)
+
+    def __str__(self):
+        return f"{self.account} ({self.run_id})"
@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from documentos.sifen import backend_padrao, extrair_documentos_nfe
+
+
+def numero_workers(workers=None):
+    """
+    Quantidade de processos de parse: o valor pedido, ou XML_PARSE_WORKERS.
+    Processos daemon (ex.: worker prefork do Celery) não podem ter filhos,
+    então nesses casos o parse roda no próprio processo (1).
+    """
+    workers = workers or settings.XML_PARSE_WORKERS or os.cpu_count() or 1
+    if multiprocessing.current_process().daemon:
+        return 1
+    return max(1, workers)
+
+def extrair_conteudos(itens, workers=None, backend=None):
+    """
+    Faz o parse (extrair_documentos_nfe) de vários XMLs em um
+    ProcessPoolExecutor. `itens` é uma lista de (chave, xml), com o xml em str
+    ou nos bytes do anexo, sem decodificar; devolve, na mesma ordem, tuplas
+    (chave, documentos, erro), com a lista de dados de cada DE do XML (mais de
+    um em um rLoteDE) — ou documentos None e erro
+    {'mensagem', 'traceback'} se algum DE daquele XML falhou. Um XML com erro
+    não derruba o pool.
+    """
+    backend = backend or backend_padrao()
+    # memoryview não pode ser enviado a outro processo
+    itens = [(chave, xml.tobytes() if isinstance(xml, memoryview) else xml, backend) for chave, xml in itens]
+    return _executar(_extrair_conteudo, itens, workers)
+
+def extrair_arquivos(caminhos, workers=None, backend=None):
+    """
+    Como extrair_conteudos, mas cada processo lê o arquivo do disco (evita
+    enviar o conteúdo pelo pipe). As chaves são os próprios caminhos. Arquivos
+    que não são DE voltam com documentos e erro None.
+    """
+    backend = backend or backend_padrao()
+    return _executar(_extrair_arquivo, [(caminho, caminho, backend) for caminho in caminhos], workers)
+
+def _executar(funcao, itens, workers):
+    itens = list(itens)
+    workers = min(numero_workers(workers), len(itens) or 1)
+    # Poucos XMLs: subir o pool custa mais que o próprio parse
+    if workers == 1 or len(itens) < settings.XML_PARSE_MIN_PARALELO:
+        return [funcao(item) for item in itens]
+
+    # Pedaços maiores reduzem o custo de IPC por XML
+    chunksize = max(1, len(itens) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(funcao, itens, chunksize=chunksize))
+
+def _extrair_conteudo(item):
+    # O backend vai junto: o processo filho pode não ter o Django configurado
+    chave, xml, backend = item
+    try:
+        return _extrair_documentos(chave, xml, backend)
+    except Exception as e:
+        return chave, None, _erro(e)
+
+def _extrair_arquivo(item):
+    chave, caminho, backend = item
+    try:
+        # Bytes: o parser usa o encoding declarado no prólogo
+        with open(caminho, "rb") as f:
+            xml = f.read()
+        if b"<DE Id=" not in xml:
+            return chave, None, None
+        return _extrair_documentos(chave, xml, backend)
+    except Exception as e:
+        return chave, None, _erro(e)
+
+def _extrair_documentos(chave, xml, backend):
+    documentos, erros = extrair_documentos_nfe(xml, backend)
+    if erros:
+        # O XML é tratado por inteiro: um DE com erro invalida o arquivo
+        mensagem = "; ".join(f"DE {posicao}: {e}" for posicao, e in erros)
+        return chave, None, {'mensagem': mensagem, 'traceback': _traceback(erros[0][1])}
+    return chave, documentos, None
+
+def _traceback(e):
+    return "".join(traceback.format_exception(type(e), e, e.__traceback__))
+
+def _erro(e):
+    return {'mensagem': str(e), 'traceback': traceback.format_exc()}
@@ -0,0 +1,79 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from django.conf import settings
+from django.db import connections
+
+_local = threading.local()
+
+
+@contextmanager
+def perfilar(nome, ativo=True, diretorio=None, top=None):
+    """
+    Roda o bloco sob o cProfile e grava em `diretorio` (padrão:
+    settings.PROFILE_DIR) o dump <nome>-<data>-<pid>.prof (para snakeviz /
+    pstats) e um resumo .txt com as `top` funções por tempo acumulado, além do
+    número e do tempo total das queries SQL executadas no bloco.
+
+    Com ativo=False (ou já dentro de outro perfilar na mesma thread) só executa
+    o bloco. O cProfile e a contagem de SQL valem para a thread atual.
+    """
+    if not ativo or getattr(_local, 'ativo', False):
+        yield
+        return
+
+    diretorio = diretorio or settings.PROFILE_DIR
+    top = top or settings.PROFILE_TOP
+    sql = {'queries': 0, 'segundos': 0.0}
+
+    def contar_sql(execute, sql_texto, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql_texto, params, many, context)
+        finally:
+            sql['queries'] += 1
+            sql['segundos'] += time.perf_counter() - inicio
+
+    profiler = cProfile.Profile()
+    inicio = time.perf_counter()
+    _local.ativo = True
+    try:
+        with ExitStack() as pilha:
+            for conexao in connections.all():
+                pilha.enter_context(conexao.execute_wrapper(contar_sql))
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+    finally:
+        _local.ativo = False
+        _gravar_perfil(profiler, nome, diretorio, top, time.perf_counter() - inicio, sql)
+
+def _gravar_perfil(profiler, nome, diretorio, top, duracao, sql):
+    try:
+        os.makedirs(diretorio, exist_ok=True)
+        arquivo = re.sub(r'[^\w.@-]', '_', nome)
+        base = os.path.join(diretorio, f"{arquivo}-{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}")
+        profiler.dump_stats(f"{base}.prof")
+
+        texto = io.StringIO()
+        texto.write(
+            f"{nome}: {duracao:.3f}s; {sql['queries']} query(s) SQL em {sql['segundos']:.3f}s\n\n"
+        )
+        pstats.Stats(profiler, stream=texto).sort_stats('cumulative').print_stats(top)
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write(texto.getvalue())
+
+        print(
+            f"🔬 [{nome}] {duracao:.2f}s; {sql['queries']} query(s) SQL em {sql['segundos']:.2f}s. "
+            f"Perfil em {base}.prof (top {top} em {base}.txt)"
+        )
+    except Exception as e:
+        print(f"⚠️ [{nome}] Falha ao gravar o perfil: {e}")
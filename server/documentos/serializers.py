@@ -1,6 +1,6 @@
 from babel.numbers import format_currency
 from common.models import Cidade, Departamento
-from documentos.models import Documento, TipoDocumento
+from documentos.models import Documento, IngestRun, IngestRunAccount, TipoDocumento
 from emissores.models import Emissor
 from rest_framework import serializers
 
@@ -36,12 +36,38 @@ class DocumentoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Documento
         fields = [
-            'cdc', 'tipo_documento', 'est', 'pun_exp', 'num_doc',
-            'emissor', 'fecha_emision', 'monto_total',
+            'cdc', 'tipo_documento', 'est', 'pun_exp', 'num_doc', 'numero_completo', 'timbrado',
+            'emissor', 'receptor_ruc', 'receptor_nome', 'fecha_emision', 'moneda', 'condicion_venta',
+            'monto_total', 'total_iva', 'iva_5', 'iva_10',
             'created_at', 'updated_at', 'monto_total_formatado'
         ]
 
     def get_monto_total_formatado(self, obj):
         if obj.monto_total is None:
             return ""
-        return format_currency(obj.monto_total, 'PYG', locale='es_PY')        
+        return format_currency(obj.monto_total, 'PYG', locale='es_PY')
+
+INGEST_METRICAS_FIELDS = [
+    'started_at', 'finished_at', 'duration_seconds',
+    'messages_found', 'messages_processed', 'messages_deleted', 'bytes_downloaded',
+    'documents_created', 'duplicates', 'queued', 'errors',
+    'connect_seconds', 'search_seconds', 'fetch_seconds', 'parse_seconds', 'db_seconds',
+]
+
+class IngestRunAccountSerializer(serializers.ModelSerializer):
+    account = serializers.CharField(source='account.username', default=None)
+
+    class Meta:
+        model = IngestRunAccount
+        fields = ['id', 'account'] + INGEST_METRICAS_FIELDS + ['error']
+
+class IngestRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestRun
+        fields = ['id', 'engine', 'accounts', 'accounts_failed'] + INGEST_METRICAS_FIELDS
+
+class IngestRunDetailSerializer(IngestRunSerializer):
+    account_runs = IngestRunAccountSerializer(many=True, read_only=True)
+
+    class Meta(IngestRunSerializer.Meta):
+        fields = IngestRunSerializer.Meta.fields + ['account_runs']
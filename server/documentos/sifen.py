@@ -0,0 +1,439 @@
+# Leitura dos XML de documentos eletrônicos (SIFEN). Sem dependência do Django,
+# para poder rodar em processos filhos (ver parse_paralelo).
+import codecs
+import io
+import re
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from lxml import etree
+
+NS = {'ns': 'http://ekuatia.set.gov.py/sifen/xsd'}
+BACKENDS = ('etree', 'lxml')
+
+# Exceções de XML malformado dos dois backends
+XMLParseError = (ET.ParseError, etree.XMLSyntaxError)
+
+# Caminhos usados na extração (relativos ao nó indicado no comentário)
+CAMINHOS = (
+    'ns:gTimb',                 # DE
+    'ns:gDatGralOpe',           # DE
+    'ns:gTotSub/ns:dTotOpe',    # DE
+    'ns:gEmis',                 # gDatGralOpe
+    'ns:dFeEmiDE',              # gDatGralOpe
+    'ns:iTiDE',                 # gTimb
+    'ns:dDesTiDE',
+    'ns:dEst',
+    'ns:dPunExp',
+    'ns:dNumDoc',
+    'ns:cDepEmi',               # gEmis
+    'ns:dDesDepEmi',
+    'ns:cCiuEmi',
+    'ns:dDesCiuEmi',
+    'ns:dRucEm',
+    'ns:dNomEmi',
+    'ns:dNomFanEmi',
+    'ns:dNumTim',               # gTimb
+    'ns:gDatRec/ns:dRucRec',    # gDatGralOpe
+    'ns:gDatRec/ns:dNumIDRec',
+    'ns:gDatRec/ns:dNomRec',
+    'ns:gOpeCom/ns:cMoneOpe',
+    'ns:gDtipDE/ns:gCamCond/ns:iCondOpe',   # DE
+    'ns:gTotSub/ns:dTotIVA',
+    'ns:gTotSub/ns:dIVA5',
+    'ns:gTotSub/ns:dIVA10',
+    'ns:dCodInt',               # gCamItem
+    'ns:dDesProSer',
+    'ns:dDesUniMed',
+    'ns:dCantProSer',
+    'ns:gValorItem/ns:dPUniProSer',
+    'ns:gValorItem/ns:dTotBruOpeItem',
+    'ns:gValorItem/ns:gValorRestaItem/ns:dDescItem',
+    'ns:gValorItem/ns:gValorRestaItem/ns:dTotOpeItem',
+    'ns:gCamIVA/ns:dTasaIVA',
+)
+
+# Itens do documento (vários por DE)
+CAMINHO_ITENS = 'ns:gDtipDE/ns:gCamItem'
+
+# Backend lxml: XPath compilado uma única vez, no import do módulo
+_XPATH_DE = etree.XPath('descendant::ns:DE[1]', namespaces=NS)
+_XPATHS = {caminho: etree.XPath(f'{caminho}[1]', namespaces=NS) for caminho in CAMINHOS}
+_XPATH_ITENS = etree.XPath(CAMINHO_ITENS, namespaces=NS)
+# Caminhos avulsos (localizar_todos, ex.: PDF), compilados na primeira consulta
+_XPATHS_TODOS = {CAMINHO_ITENS: _XPATH_ITENS}
+
+# Streaming (iterparse): cada rDE de um rLoteDE, ou o DE solto
+_TAG_RDE = f"{{{NS['ns']}}}rDE"
+_TAG_DE = f"{{{NS['ns']}}}DE"
+_RE_DE = re.compile(rb'<(?:\w+:)?DE[\s>]')
+_RE_DE_TEXTO = re.compile(r'<(?:\w+:)?DE[\s>]')
+
+# encoding declarado no prólogo (<?xml version="1.0" encoding="ISO-8859-1"?>)
+_RE_ENCODING = re.compile(rb'^\s*<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+_RE_ENCODING_TEXTO = re.compile(r'^(\s*<\?xml[^>]*?\sencoding\s*=\s*)(["\'])[A-Za-z0-9._-]+\2')
+
+_parsers = threading.local()
+
+
+def backend_padrao():
+    """
+    Backend definido em settings.SIFEN_XML_BACKEND ('etree' se o Django não
+    estiver configurado, ex.: em um processo filho).
+    """
+    try:
+        from django.conf import settings
+        return getattr(settings, 'SIFEN_XML_BACKEND', 'etree')
+    except Exception:
+        return 'etree'
+
+def fromstring(xml, backend=None):
+    """
+    Faz o parse com o backend escolhido. `xml` pode ser str (já decodificado)
+    ou os bytes do arquivo (bytes/memoryview), e nesse caso vale o encoding
+    declarado no prólogo. As duas árvores aceitam find(caminho, NS), então o
+    restante do código não precisa saber qual foi usada.
+    """
+    backend = backend or backend_padrao()
+    if backend == 'lxml':
+        if isinstance(xml, str):
+            # Texto já decodificado: ignora o encoding declarado no prólogo (como o ET)
+            return etree.fromstring(xml.encode('utf-8'), parser=_parser_lxml())
+        return etree.fromstring(xml, parser=_parser_lxml(declarado=True))
+    if backend != 'etree':
+        raise ValueError(f"Backend de XML desconhecido: {backend} (use {', '.join(BACKENDS)}).")
+    return ET.fromstring(xml)
+
+def _parser_lxml(declarado=False):
+    # Um parser por thread (o leitor assíncrono processa contas em threads)
+    chave = 'declarado' if declarado else 'utf8'
+    parser = getattr(_parsers, chave, None)
+    if parser is None:
+        parser = etree.XMLParser(
+            encoding=None if declarado else 'utf-8',
+            remove_comments=True,
+            remove_pis=True,
+            resolve_entities=False,
+            no_network=True,
+        )
+        setattr(_parsers, chave, parser)
+    return parser
+
+def extrair_dados_nfe(xml, backend=None):
+    """
+    Faz o parse do XML de um DE e devolve um dict com os campos do Documento e
+    das tabelas de referência (departamento, cidade, tipo e emissor), sem
+    acessar o banco. `xml` é str ou os bytes do anexo (bytes/memoryview, sem
+    decodificar antes); documento_xml volta como recebido e é gravado assim no
+    storage (guardar_xml). `backend` é 'etree' (xml.etree) ou 'lxml' (XPath
+    pré-compilado); por padrão, settings.SIFEN_XML_BACKEND.
+    """
+    backend = backend or backend_padrao()
+    root = fromstring(xml, backend)
+    if backend == 'lxml':
+        return _extrair(root, _find_lxml, _itens_lxml, _de_lxml, xml)
+    return _extrair(root, _find_etree, _itens_etree, _de_etree, xml)
+
+def encoding_declarado(xml):
+    """
+    Encoding dos bytes de um XML: BOM, senão o declarado no prólogo, senão
+    UTF-8 (padrão do XML).
+    """
+    inicio = bytes(xml[:200])
+    if inicio.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if inicio.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    m = _RE_ENCODING.match(inicio)
+    if m:
+        try:
+            return codecs.lookup(m.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def texto_xml(xml):
+    """
+    XML como texto: bytes/memoryview são decodificados uma única vez, com o
+    encoding do próprio XML. O prólogo passa a declarar UTF-8, que é o
+    encoding do texto quando gravado ou servido (um encoding="ISO-8859-1"
+    mantido viraria mojibake).
+    """
+    if not isinstance(xml, str):
+        xml = str(xml, encoding_declarado(xml), 'replace')
+    return _RE_ENCODING_TEXTO.sub(r'\1\2UTF-8\2', xml, count=1)
+
+def _find_etree(node, path):
+    return node.find(path, NS)
+
+def _itens_etree(de):
+    return de.findall(CAMINHO_ITENS, NS)
+
+def _de_etree(root):
+    return root.find('.//ns:DE', NS)
+
+def _find_lxml(node, path):
+    encontrados = _XPATHS[path](node)
+    return encontrados[0] if encontrados else None
+
+def _itens_lxml(de):
+    return _XPATH_ITENS(de)
+
+def _de_lxml(root):
+    encontrados = _XPATH_DE(root)
+    return encontrados[0] if encontrados else None
+
+def localizar(node, caminho):
+    """
+    Primeiro nó em `caminho` (relativo a `node`, prefixo ns:), ou None, como
+    node.find(caminho, NS). Com o backend lxml usa XPath compilado na primeira
+    consulta e reutilizado depois (mesmo cache de CAMINHOS).
+    """
+    if node is None:
+        return None
+    if not isinstance(node, etree._Element):
+        return node.find(caminho, NS)
+    xpath = _XPATHS.get(caminho)
+    if xpath is None:
+        xpath = _XPATHS.setdefault(caminho, etree.XPath(f'{caminho}[1]', namespaces=NS))
+    encontrados = xpath(node)
+    return encontrados[0] if encontrados else None
+
+def localizar_todos(node, caminho):
+    """
+    Todos os nós em `caminho`, como node.findall(caminho, NS); XPath
+    compilado com o backend lxml.
+    """
+    if node is None:
+        return []
+    if not isinstance(node, etree._Element):
+        return node.findall(caminho, NS)
+    xpath = _XPATHS_TODOS.get(caminho)
+    if xpath is None:
+        xpath = _XPATHS_TODOS.setdefault(caminho, etree.XPath(caminho, namespaces=NS))
+    return xpath(node)
+
+def _extrair(root, find, localizar_itens, localizar_de, xml_str):
+    # helper pra extrair texto com erro amigável
+    def get_text(node, path, required=True, default=None):
+        el = find(node, path)
+        if el is None or el.text is None:
+            if required:
+                raise ValueError(f"Campo obrigatório não encontrado: {path}")
+            return default
+        return el.text.strip()
+
+    # 1) Aponta para o nó DE em qualquer lugar (por causa do rLoteDE/rDE)
+    de = localizar_de(root)
+    if de is None:
+        raise ValueError("Nó <DE> não encontrado (verifique namespace/caminho).")
+
+    # 2) Blocos principais (sempre RELATIVOS a 'de')
+    gTimb = find(de, 'ns:gTimb')
+    if gTimb is None:
+        raise ValueError("Bloco <gTimb> não encontrado em <DE>.")
+
+    gDatGralOpe = find(de, 'ns:gDatGralOpe')
+    if gDatGralOpe is None:
+        raise ValueError("Bloco <gDatGralOpe> não encontrado em <DE>.")
+
+    gEmis = find(gDatGralOpe, 'ns:gEmis')
+    if gEmis is None:
+        raise ValueError("Bloco <gEmis> não encontrado em <gDatGralOpe>.")
+
+    # 3) Campos principais
+    cdc = de.attrib.get("Id")
+    if not cdc:
+        raise ValueError("Atributo Id não encontrado em <DE>.")
+
+    est = get_text(gTimb, 'ns:dEst')
+    pun_exp = get_text(gTimb, 'ns:dPunExp')
+    num_doc = get_text(gTimb, 'ns:dNumDoc')
+    condicion_venta = _texto(find, de, 'ns:gDtipDE/ns:gCamCond/ns:iCondOpe')
+
+    return {
+        'cdc': cdc,
+        'tipo_documento': {
+            'code': int(get_text(gTimb, 'ns:iTiDE')),
+            'name': get_text(gTimb, 'ns:dDesTiDE'),
+        },
+        'est': est,
+        'pun_exp': pun_exp,
+        'num_doc': num_doc,
+        'numero_completo': f"{est}-{pun_exp}-{num_doc}",
+        'timbrado': _texto(find, gTimb, 'ns:dNumTim'),
+        'fecha_emision': datetime.fromisoformat(get_text(gDatGralOpe, 'ns:dFeEmiDE')),
+        # Receptor: RUC, ou o documento de identidade quando não contribuinte
+        'receptor_ruc': (
+            _texto(find, gDatGralOpe, 'ns:gDatRec/ns:dRucRec')
+            or _texto(find, gDatGralOpe, 'ns:gDatRec/ns:dNumIDRec')
+        ),
+        'receptor_nome': _texto(find, gDatGralOpe, 'ns:gDatRec/ns:dNomRec'),
+        'moneda': _texto(find, gDatGralOpe, 'ns:gOpeCom/ns:cMoneOpe'),
+        'condicion_venta': int(condicion_venta) if condicion_venta.isdigit() else None,
+        # Totais (dentro de DE)
+        'monto_total': Decimal(get_text(de, 'ns:gTotSub/ns:dTotOpe')),
+        'total_iva': _decimal(find, de, 'ns:gTotSub/ns:dTotIVA'),
+        'iva_5': _decimal(find, de, 'ns:gTotSub/ns:dIVA5'),
+        'iva_10': _decimal(find, de, 'ns:gTotSub/ns:dIVA10'),
+        # 4) Departamento, cidade e emissor
+        'departamento': {
+            'code': get_text(gEmis, 'ns:cDepEmi'),
+            'name': get_text(gEmis, 'ns:dDesDepEmi'),
+        },
+        'cidade': {
+            'code': get_text(gEmis, 'ns:cCiuEmi'),
+            'name': get_text(gEmis, 'ns:dDesCiuEmi'),
+        },
+        'emissor': {
+            'code': get_text(gEmis, 'ns:dRucEm'),
+            'nome': get_text(gEmis, 'ns:dNomEmi'),
+            'nome_fantasia': get_text(gEmis, 'ns:dNomFanEmi', required=False, default=None),
+        },
+        'itens': [_extrair_item(numero, item, find) for numero, item in enumerate(localizar_itens(de), 1)],
+        'documento_xml': xml_str,
+    }
+
+# Campos opcionais: ausente ou inválido vira '' / None, sem rejeitar o documento
+def _texto(find, node, path):
+    el = find(node, path)
+    return el.text.strip() if el is not None and el.text else ''
+
+def _decimal(find, node, path):
+    valor = _texto(find, node, path)
+    try:
+        return Decimal(valor) if valor else None
+    except InvalidOperation:
+        return None
+
+def _extrair_item(numero, item, find):
+    def texto(path):
+        return _texto(find, item, path)
+
+    def decimal(path):
+        return _decimal(find, item, path)
+
+    taxa_iva = texto('ns:gCamIVA/ns:dTasaIVA')
+    total = decimal('ns:gValorItem/ns:gValorRestaItem/ns:dTotOpeItem')
+    return {
+        'numero': numero,
+        'codigo': texto('ns:dCodInt')[:50],
+        'descricao': texto('ns:dDesProSer'),
+        'unidade': texto('ns:dDesUniMed')[:20],
+        'quantidade': decimal('ns:dCantProSer'),
+        'preco_unitario': decimal('ns:gValorItem/ns:dPUniProSer'),
+        'desconto': decimal('ns:gValorItem/ns:gValorRestaItem/ns:dDescItem') or Decimal('0'),
+        'taxa_iva': int(taxa_iva) if taxa_iva.isdigit() else None,
+        # Total líquido do item (dTotOpeItem); sem ele, o bruto (dTotBruOpeItem)
+        'total': total if total is not None else decimal('ns:gValorItem/ns:dTotBruOpeItem'),
+    }
+
+def extrair_documentos_nfe(xml, backend=None):
+    """
+    Como extrair_dados_nfe, mas para XMLs com um ou vários DE (rLoteDE).
+    Devolve (lista de dados, erros), com erros = [(posição do DE, exceção)].
+    Um XML com um único DE segue pelo caminho normal (e o erro, se houver, é
+    levantado); um lote é lido em streaming por iterar_documentos_nfe, e um DE
+    com erro não impede a leitura dos demais.
+    """
+    if not contem_varios_des(xml):
+        return [extrair_dados_nfe(xml, backend)], []
+
+    documentos, erros = [], []
+    posicao = 0
+    try:
+        for posicao, dados, erro in iterar_documentos_nfe(xml):
+            if erro is None:
+                documentos.append(dados)
+            else:
+                erros.append((posicao, erro))
+    except XMLParseError as e:
+        # XML truncado/malformado: os DE anteriores ao erro continuam válidos
+        erros.append((posicao + 1, e))
+    return documentos, erros
+
+def contem_varios_des(xml):
+    """
+    True se o conteúdo (str, bytes ou memoryview) tem mais de um elemento DE.
+    A busca é feita direto nos bytes, sem decodificar, e para no segundo
+    encontrado.
+    """
+    encontrados = (_RE_DE_TEXTO if isinstance(xml, str) else _RE_DE).finditer(xml)
+    return next(encontrados, None) is not None and next(encontrados, None) is not None
+
+def iterar_documentos_nfe(fonte):
+    """
+    Lê um XML de DE ou de lote (rLoteDE) em streaming, com lxml.iterparse, e
+    gera (posição, dados, erro) para cada DE, na ordem do arquivo. `fonte` é o
+    conteúdo (str, bytes ou memoryview), um caminho de arquivo ou um arquivo
+    aberto em modo binário. Os elementos já processados são descartados, então
+    a memória não cresce com a quantidade de DE no arquivo.
+
+    documento_xml de cada DE é o seu rDE serializado (com assinatura e QR);
+    se o conteúdo em memória tem um único DE, é o próprio conteúdo original.
+    XML malformado levanta XMLParseError no ponto do erro (os DE anteriores já
+    foram gerados).
+    """
+    original = None
+    opcoes = {}
+    if isinstance(fonte, str) and fonte.lstrip().startswith('<'):
+        original = fonte
+        # Texto já decodificado: ignora o encoding declarado no prólogo (como o fromstring)
+        fonte = io.BytesIO(fonte.encode('utf-8'))
+        opcoes['encoding'] = 'utf-8'
+    elif isinstance(fonte, (bytes, bytearray, memoryview)):
+        original = fonte
+        fonte = io.BytesIO(fonte)
+
+    eventos = etree.iterparse(
+        fonte,
+        events=('end',),
+        tag=(_TAG_RDE, _TAG_DE),
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities=False,
+        no_network=True,
+        **opcoes,
+    )
+
+    anterior = None
+    posicao = 0
+    try:
+        for _, elem in eventos:
+            pai = elem.getparent()
+            if elem.tag == _TAG_DE and pai is not None and pai.tag == _TAG_RDE:
+                # O DE é extraído junto com o rDE, no fim dele
+                continue
+
+            posicao += 1
+            try:
+                dados = _extrair(elem, _find_lxml, _itens_lxml, _de_do_elemento, etree.tostring(elem, encoding='unicode'))
+                item = (posicao, dados, None)
+            except Exception as e:
+                item = (posicao, None, e)
+
+            # Libera o elemento e os irmãos já processados
+            elem.clear(keep_tail=False)
+            if pai is not None:
+                while elem.getprevious() is not None:
+                    del pai[0]
+
+            # Segura um item: só no fim se sabe se o arquivo tinha um único DE
+            if anterior is not None:
+                yield anterior
+            anterior = item
+    except XMLParseError:
+        # Entrega o DE que estava segurando antes de propagar o erro
+        if anterior is not None:
+            yield anterior
+        raise
+
+    if anterior is None:
+        raise ValueError("Nó <DE> não encontrado (verifique namespace/caminho).")
+    if posicao == 1 and original is not None and anterior[1] is not None:
+        anterior[1]['documento_xml'] = original
+    yield anterior
+
+def _de_do_elemento(elem):
+    return elem if elem.tag == _TAG_DE else _de_lxml(elem)
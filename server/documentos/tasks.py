@@ -1,6 +1,97 @@
-from celery import shared_task
-from .email_reader import ler_emails_com_anexos
+from celery import chord, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from emails.models import User
+from .email_reader import imprimir_resumo_execucao, novo_resumo, processar_conta_email
+from .execucoes import finalizar_execucao, iniciar_execucao
+from .ingestao import consumir_anexos_pendentes
+from .leitor_async import ler_emails_concorrente
+from .perfil import perfilar
+
 
 @shared_task
 def tarefa_processar_emails():
-    ler_emails_com_anexos(max_emails=100)
+    """
+    Dispara uma task por conta ativa (chord) e agrega os resumos no callback.
+    O tempo total passa a ser o da conta mais lenta, não a soma de todas.
+
+    Com EMAIL_INGEST_ENGINE='asyncio', todas as contas são lidas aqui mesmo,
+    em um pool de threads limitado (ver leitor_async.ler_emails_concorrente).
+
+    Com PROFILE_INGESTAO, grava o perfil desta task (e cada conta grava o seu;
+    ver perfil.perfilar).
+    """
+    with perfilar("tarefa_processar_emails", ativo=settings.PROFILE_INGESTAO):
+        return _disparar_leitura_emails()
+
+def _disparar_leitura_emails():
+    if settings.EMAIL_INGEST_ENGINE == 'asyncio':
+        resumos = ler_emails_concorrente(max_emails=100)
+        if any(r.get('enfileirados') for r in resumos):
+            tarefa_consumir_anexos_pendentes.delay()
+        return resumos
+
+    contas = list(User.objects.filter(active=True).values_list('id', flat=True))
+    if not contas:
+        print("📭 Nenhuma conta de e-mail ativa.")
+        return
+
+    execucao_id = iniciar_execucao('chord')
+    cabecalho = [
+        tarefa_processar_conta.s(conta_id, max_emails=100, execucao_id=execucao_id)
+        for conta_id in contas
+    ]
+    chord(cabecalho)(tarefa_resumo_emails.s(execucao_id=execucao_id))
+    print(f"🚀 Disparadas {len(contas)} task(s) de leitura de e-mails.")
+
+@shared_task(
+    bind=True,
+    soft_time_limit=settings.EMAIL_TASK_SOFT_TIME_LIMIT,
+    time_limit=settings.EMAIL_TASK_TIME_LIMIT,
+    max_retries=settings.EMAIL_TASK_MAX_RETRIES,
+)
+def tarefa_processar_conta(self, conta_id, max_emails=100, execucao_id=None):
+    """
+    Processa uma única conta de e-mail. Falhas de conexão são re-tentadas com
+    backoff exponencial; esgotadas as tentativas (ou estourado o tempo), devolve
+    um resumo com o erro para não derrubar o chord.
+    """
+    try:
+        user = User.objects.get(pk=conta_id, active=True)
+    except User.DoesNotExist:
+        return None
+
+    try:
+        resumo = processar_conta_email(user, max_emails=max_emails, execucao_id=execucao_id)
+        if resumo.get('enfileirados'):
+            tarefa_consumir_anexos_pendentes.delay()
+        return resumo
+    except SoftTimeLimitExceeded:
+        print(f"⏱️ [{user.username}] Tempo limite excedido.")
+        return novo_resumo(user, erro="Tempo limite excedido")
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            countdown = settings.EMAIL_TASK_RETRY_BACKOFF * (2 ** self.request.retries)
+            print(f"🔁 [{user.username}] Erro: {e}. Nova tentativa em {countdown}s.")
+            raise self.retry(exc=e, countdown=countdown)
+        print(f"🚫 Erro ao conectar ou processar e-mails de {user.username}: {e}")
+        return novo_resumo(user, erro=str(e))
+
+@shared_task
+def tarefa_resumo_emails(resumos, execucao_id=None):
+    """
+    Callback do chord: fecha a IngestRun e imprime contagens e duração de cada
+    conta.
+    """
+    finalizar_execucao(execucao_id)
+    imprimir_resumo_execucao(resumos)
+    return resumos
+
+@shared_task
+def tarefa_consumir_anexos_pendentes():
+    """
+    Consumidor da fila AnexoPendente (EMAIL_INGEST_STAGING): faz o parse e grava
+    os documentos em lotes. Roda na fila STAGING_QUEUE, escalável à parte dos
+    leitores; várias instâncias podem rodar juntas (SKIP LOCKED).
+    """
+    return consumir_anexos_pendentes()
@@ -1,3 +1,2096 @@
-from django.test import TestCase
+import asyncio
+import base64
+import codecs
+import gzip
+import hashlib
+import io
+import os
+import pstats
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User as DjangoUser
+from django.core.cache import cache
+from django.core.files.storage import storages
+from django.core.management import call_command
+from app.celery import app as celery_app
+from celery.exceptions import SoftTimeLimitExceeded
+from common.models import Cidade, Departamento
+from companies.models import Company
+from django.db import IntegrityError, connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from documentos.blobs_xml import STORAGE_XML, chave_xml, guardar_xml
+from documentos.cache_referencias import (
+    CacheLRU,
+    buscar_em_cache,
+    guardar_em_cache,
+    invalidar_referencia,
+    limpar_caches,
+    versao_compartilhada,
+)
+from documentos.compactados import expandir_anexos
+from documentos.execucoes import finalizar_execucao, iniciar_execucao, medir, registrar_conta_execucao
+from documentos.email_reader import _buscar_lote_imap, _listar_mensagens_graph_delta, leitor_email_box, novo_resumo
+from documentos.graph import TOKEN_MARGEM, GraphClient, obter_token_graph
+from documentos.imap import compactar_uids, decodificar_filename, listar_partes_xml, parse_fetch_response
+from documentos.ingestao import (
+    consumir_anexos_pendentes,
+    enfileirar_anexos,
+    gravar_indice_anexos,
+    indice_anexos,
+    processar_anexos_lote,
+)
+from documentos.leitor_async import _ler_contas
+from documentos.metricas import metricas_view
+from documentos.models import (
+    AnexoPendente,
+    AnexoProcessado,
+    Documento,
+    DocumentoItem,
+    IngestRun,
+    IngestRunAccount,
+    TipoDocumento,
+)
+from documentos.parse_paralelo import extrair_arquivos, extrair_conteudos, numero_workers
+from documentos.perfil import perfilar
+from documentos.sifen import (
+    XMLParseError,
+    encoding_declarado,
+    extrair_dados_nfe,
+    extrair_documentos_nfe,
+    fromstring,
+    iterar_documentos_nfe,
+    localizar,
+    localizar_todos,
+    texto_xml,
+)
+from documentos.tasks import (
+    tarefa_consumir_anexos_pendentes,
+    tarefa_processar_conta,
+    tarefa_processar_emails,
+)
+from documentos.util import gravar_documentos, gravar_itens, sha256_anexo
+from documentos.views import DocumentoListView, DocumentoXMLDownloadView
+from emails.models import EmailXmlError, ImapSyncState, User
+from emissores.models import Emissor
+from rest_framework.test import APIClient
+
+SIFEN_NS = "http://ekuatia.set.gov.py/sifen/xsd"
+
+
+def montar_de(
+    cdc="01800628535055001003334022025072617152780206",
+    tipo="1",
+    desc_tipo="Factura electrónica",
+    num_doc="0003334",
+    nome_fantasia="<dNomFanEmi>  Comercial Asunción  </dNomFanEmi>",
+    total="1250000",
+    extra_emis="",
+    prolog='<?xml version="1.0" encoding="UTF-8"?>',
+    envelope="rDE",
+):
+    """
+    XML no formato dos DE recebidos por e-mail (rDE com assinatura e QR), com
+    os pontos que variam entre emissores parametrizados.
+    """
+    de = f"""
+    <DE Id="{cdc}">
+        <dDVId>6</dDVId>
+        <dFecFirma>2025-07-26T17:15:27</dFecFirma>
+        <dSisFact>1</dSisFact>
+        <gOpeDE><iTipEmi>1</iTipEmi><dDesTipEmi>Normal</dDesTipEmi><dCodSeg>780206123</dCodSeg></gOpeDE>
+        <gTimb>
+            <iTiDE>{tipo}</iTiDE>
+            <dDesTiDE>{desc_tipo}</dDesTiDE>
+            <dNumTim>16773372</dNumTim>
+            <dEst>001</dEst>
+            <dPunExp>003</dPunExp>
+            <dNumDoc>{num_doc}</dNumDoc>
+            <dFeIniT>2024-01-02</dFeIniT>
+        </gTimb>
+        <gDatGralOpe>
+            <dFeEmiDE>2025-07-26T17:15:27</dFeEmiDE>
+            <gOpeCom><iTipTra>1</iTipTra><dDesTipTra>Venta de mercadería</dDesTipTra><cMoneOpe>PYG</cMoneOpe></gOpeCom>
+            <gEmis>
+                <dRucEm>80062853</dRucEm>
+                <dDVEmi>5</dDVEmi>
+                <iTipCont>2</iTipCont>
+                <dNomEmi>COMERCIAL GUARANÍ S.A.</dNomEmi>
+                {nome_fantasia}
+                <dDirEmi>AVDA. MCAL. LÓPEZ 1234</dDirEmi>
+                <dNumCas>0</dNumCas>
+                <cDepEmi>1</cDepEmi>
+                <dDesDepEmi>CAPITAL</dDesDepEmi>
+                <cCiuEmi>1</cCiuEmi>
+                <dDesCiuEmi>ASUNCION (DISTRITO)</dDesCiuEmi>
+                <dTelEmi>021555000</dTelEmi>
+                <dEmailE>facturacion@example.com.py</dEmailE>
+                {extra_emis}
+            </gEmis>
+            <gDatRec><iNatRec>1</iNatRec><dRucRec>80099999</dRucRec><dDVRec>1</dDVRec><dNomRec>CLIENTE S.R.L.</dNomRec></gDatRec>
+        </gDatGralOpe>
+        <gDtipDE>
+            <gCamCond><iCondOpe>1</iCondOpe><dDCondOpe>Contado</dDCondOpe></gCamCond>
+            <gCamItem><dCodInt>A-1</dCodInt><dDesProSer>Producto 1</dDesProSer><dCantProSer>2</dCantProSer></gCamItem>
+        </gDtipDE>
+        <gTotSub>
+            <dSubExe>0</dSubExe>
+            <dTotOpe>{total}</dTotOpe>
+            <dIVA5>0</dIVA5>
+            <dIVA10>113636</dIVA10>
+            <dTotIVA>113636</dTotIVA>
+        </gTotSub>
+    </DE>"""
+    assinatura = '<Signature xmlns="http://www.w3.org/2000/09/xmldsig#"><SignedInfo/><SignatureValue>abc=</SignatureValue></Signature>'
+    qr = "<gCamFuFD><dCarQR>https://ekuatia.set.gov.py/consultas/qr?nVersion=150&amp;Id=1</dCarQR></gCamFuFD>"
+    rde = f'<rDE xmlns="{SIFEN_NS}"><dVerFor>150</dVerFor>{de}{assinatura}{qr}</rDE>'
+    if envelope == "rLoteDE":
+        rde = f'<rLoteDE xmlns="{SIFEN_NS}">{rde.replace(f" xmlns={chr(34)}{SIFEN_NS}{chr(34)}", "", 1)}</rLoteDE>'
+    return f"{prolog}\n{rde}"
+
+
+ITEM_COMPLETO = """
+            <gCamItem>
+                <dCodInt>B-2</dCodInt><dDesProSer> Producto 2 </dDesProSer><cUniMed>77</cUniMed><dDesUniMed>UNI</dDesUniMed>
+                <dCantProSer>1.5</dCantProSer>
+                <gValorItem>
+                    <dPUniProSer>10000</dPUniProSer><dTotBruOpeItem>15000</dTotBruOpeItem>
+                    <gValorRestaItem><dDescItem>1000</dDescItem><dTotOpeItem>13500</dTotOpeItem></gValorRestaItem>
+                </gValorItem>
+                <gCamIVA><iAfecIVA>1</iAfecIVA><dTasaIVA>10</dTasaIVA></gCamIVA>
+            </gCamItem>"""
+
+
+class SifenParserParidadeTest(SimpleTestCase):
+    """
+    O backend lxml (XPath pré-compilado) precisa devolver exatamente o mesmo
+    que o backend xml.etree, inclusive nos erros.
+    """
+
+    corpus = {
+        "fatura": montar_de(),
+        "nota_credito": montar_de(tipo="5", desc_tipo="Nota de crédito electrónica", total="-15000.50"),
+        "sem_nome_fantasia": montar_de(nome_fantasia=""),
+        "nome_fantasia_vazio": montar_de(nome_fantasia="<dNomFanEmi></dNomFanEmi>"),
+        "sem_prologo": montar_de(prolog=""),
+        "prologo_latin1": montar_de(prolog='<?xml version="1.0" encoding="ISO-8859-1"?>'),
+        "lote": montar_de(envelope="rLoteDE"),
+        "com_comentario": montar_de(extra_emis="<!-- gerado pelo sistema -->"),
+        "decimal_com_casas": montar_de(total="1250000.0000"),
+        "itens_completos": montar_de().replace("</gDtipDE>", ITEM_COMPLETO + "</gDtipDE>"),
+    }
+
+    corpus_erros = {
+        "sem_campo_obrigatorio": montar_de().replace("<dNumDoc>0003334</dNumDoc>", ""),
+        "campo_obrigatorio_vazio": montar_de(num_doc=""),
+        "sem_de": f'<rDE xmlns="{SIFEN_NS}"><dVerFor>150</dVerFor></rDE>',
+        "sem_namespace": montar_de().replace(f' xmlns="{SIFEN_NS}"', ""),
+        "sem_id": montar_de(cdc=""),
+        "tipo_invalido": montar_de(tipo="FAC"),
+    }
+
+    def test_campos_do_cabecalho(self):
+        for backend in ("etree", "lxml"):
+            with self.subTest(backend=backend):
+                dados = extrair_dados_nfe(self.corpus["fatura"], backend)
+                self.assertEqual(dados["numero_completo"], "001-003-0003334")
+                self.assertEqual(dados["timbrado"], "16773372")
+                self.assertEqual(dados["receptor_ruc"], "80099999")
+                self.assertEqual(dados["receptor_nome"], "CLIENTE S.R.L.")
+                self.assertEqual(dados["moneda"], "PYG")
+                self.assertEqual(dados["condicion_venta"], 1)
+                self.assertEqual(dados["iva_5"], Decimal("0"))
+                self.assertEqual(dados["iva_10"], Decimal("113636"))
+                self.assertEqual(dados["total_iva"], Decimal("113636"))
+
+                # Campos opcionais ausentes não rejeitam o documento
+                xml = self.corpus["fatura"].replace("<cMoneOpe>PYG</cMoneOpe>", "").replace("<dIVA5>0</dIVA5>", "")
+                dados = extrair_dados_nfe(xml, backend)
+                self.assertEqual((dados["moneda"], dados["iva_5"]), ("", None))
+
+    def test_itens(self):
+        for backend in ("etree", "lxml"):
+            with self.subTest(backend=backend):
+                itens = extrair_dados_nfe(self.corpus["itens_completos"], backend)["itens"]
+                self.assertEqual([item["codigo"] for item in itens], ["A-1", "B-2"])
+                # Item mínimo: campos ausentes ficam vazios
+                self.assertEqual(itens[0]["preco_unitario"], None)
+                self.assertEqual(itens[0]["desconto"], Decimal("0"))
+                self.assertEqual(itens[1], {
+                    "numero": 2,
+                    "codigo": "B-2",
+                    "descricao": "Producto 2",
+                    "unidade": "UNI",
+                    "quantidade": Decimal("1.5"),
+                    "preco_unitario": Decimal("10000"),
+                    "desconto": Decimal("1000"),
+                    "taxa_iva": 10,
+                    "total": Decimal("13500"),
+                })
+
+    def test_mesma_saida_nos_dois_backends(self):
+        for nome, xml in self.corpus.items():
+            with self.subTest(xml=nome):
+                self.assertEqual(extrair_dados_nfe(xml, "lxml"), extrair_dados_nfe(xml, "etree"))
+
+    def test_campos_extraidos(self):
+        dados = extrair_dados_nfe(self.corpus["fatura"], "lxml")
+        self.assertEqual(dados["cdc"], "01800628535055001003334022025072617152780206")
+        self.assertEqual(dados["tipo_documento"], {"code": 1, "name": "Factura electrónica"})
+        self.assertEqual(dados["emissor"]["nome_fantasia"], "Comercial Asunción")
+        self.assertEqual(str(dados["monto_total"]), "1250000")
+        self.assertIsNone(extrair_dados_nfe(self.corpus["sem_nome_fantasia"], "lxml")["emissor"]["nome_fantasia"])
+
+    def test_mesmos_erros_nos_dois_backends(self):
+        for nome, xml in self.corpus_erros.items():
+            with self.subTest(xml=nome):
+                erros = []
+                for backend in ("etree", "lxml"):
+                    with self.assertRaises(ValueError) as ctx:
+                        extrair_dados_nfe(xml, backend)
+                    erros.append(str(ctx.exception))
+                self.assertEqual(erros[0], erros[1])
+
+    def test_xml_malformado(self):
+        for backend in ("etree", "lxml"):
+            with self.subTest(backend=backend), self.assertRaises(XMLParseError):
+                extrair_dados_nfe('<rDE><DE Id="1"><gTimb>', backend)
+
+    def test_localizar_do_pdf(self):
+        # generate_pdf busca relativo ao DE com localizar/localizar_todos
+        xml = self.corpus["itens_completos"]
+        resultados = []
+        for backend in ("etree", "lxml"):
+            de = localizar(fromstring(xml, backend), "ns:DE")
+            itens = localizar_todos(de, "ns:gDtipDE/ns:gCamItem")
+            resultados.append((
+                de.get("Id"),
+                localizar(de, "ns:gTimb/ns:dNumDoc").text,
+                localizar(de, "ns:gTotSub/ns:inexistente"),
+                [localizar(item, "ns:dDesProSer").text for item in itens],
+            ))
+        self.assertEqual(resultados[0], resultados[1])
+        self.assertEqual(resultados[0][1], "0003334")
+        self.assertIsNone(resultados[0][2])
+        self.assertEqual(len(resultados[0][3]), 2)
+        self.assertIsNone(localizar(None, "ns:gTimb"))
+        self.assertEqual(localizar_todos(None, "ns:gTimb"), [])
+
+
+class SifenBytesTest(SimpleTestCase):
+    """
+    Entrada em bytes/memoryview: o encoding do prólogo é respeitado e o texto
+    só é gerado por texto_xml, na gravação.
+    """
+
+    def test_bytes_e_memoryview_iguais_ao_texto(self):
+        xml = montar_de()
+        esperado = extrair_dados_nfe(xml)
+        esperado.pop("documento_xml")
+        for backend in ("etree", "lxml"):
+            for entrada in (xml.encode("utf-8"), memoryview(xml.encode("utf-8"))):
+                with self.subTest(backend=backend, tipo=type(entrada).__name__):
+                    dados = extrair_dados_nfe(entrada, backend)
+                    self.assertIs(dados.pop("documento_xml"), entrada)
+                    self.assertEqual(dados, esperado)
+
+    def test_iso_8859_1_declarado(self):
+        xml = montar_de(prolog='<?xml version="1.0" encoding="ISO-8859-1"?>')
+        payload = xml.encode("latin-1")
+        for backend in ("etree", "lxml"):
+            with self.subTest(backend=backend):
+                dados = extrair_dados_nfe(payload, backend)
+                self.assertEqual(dados["emissor"]["nome"], "COMERCIAL GUARANÍ S.A.")
+                self.assertEqual(dados["emissor"]["nome_fantasia"], "Comercial Asunción")
+        self.assertEqual(encoding_declarado(payload), "iso8859-1")
+        self.assertEqual(texto_xml(payload), xml.replace('encoding="ISO-8859-1"', 'encoding="UTF-8"'))
+
+    def test_encoding_declarado(self):
+        self.assertEqual(encoding_declarado(b"<a/>"), "utf-8")
+        self.assertEqual(encoding_declarado(b"\xef\xbb\xbf<a/>"), "utf-8-sig")
+        self.assertEqual(encoding_declarado(b"<?xml version='1.0' encoding='windows-1252'?><a/>"), "cp1252")
+        self.assertEqual(encoding_declarado(b'<?xml version="1.0" encoding="nao-existe"?><a/>'), "utf-8")
+        self.assertEqual(texto_xml("<a/>"), "<a/>")
+        self.assertEqual(texto_xml("<?xml version='1.0' encoding='latin1'?><a/>"), "<?xml version='1.0' encoding='UTF-8'?><a/>")
+
+    def test_lote_em_bytes(self):
+        lote = montar_lote(montar_de(cdc="1" * 44), montar_de(cdc="2" * 44)).encode("utf-8")
+        documentos, erros = extrair_documentos_nfe(memoryview(lote))
+        self.assertEqual([dados["cdc"] for dados in documentos], ["1" * 44, "2" * 44])
+        self.assertEqual(erros, [])
+
+
+def montar_lote(*des):
+    """rLoteDE com os rDE dados (gerados por montar_de)."""
+    corpos = [de.split("\n", 1)[1].replace(f' xmlns="{SIFEN_NS}"', "", 1) for de in des]
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<rLoteDE xmlns="{SIFEN_NS}">{"".join(corpos)}</rLoteDE>'
+
+
+class SifenStreamingTest(SimpleTestCase):
+    """
+    Leitura em streaming (iterparse) de lotes rLoteDE: todos os DE, na ordem,
+    com os mesmos dados do parse de cada DE isolado.
+    """
+
+    def test_lote_gera_todos_os_des(self):
+        des = [montar_de(cdc=f"{i:044d}", num_doc=f"{i:07d}") for i in range(1, 6)]
+        resultados = list(iterar_documentos_nfe(montar_lote(*des)))
+
+        self.assertEqual([posicao for posicao, _, _ in resultados], [1, 2, 3, 4, 5])
+        for de, (_, dados, erro) in zip(des, resultados):
+            self.assertIsNone(erro)
+            esperado = extrair_dados_nfe(de, "lxml")
+            esperado.pop("documento_xml")
+            # Cada DE guarda o próprio rDE, que continua legível sozinho
+            relido = extrair_dados_nfe(dados.pop("documento_xml"))
+            relido.pop("documento_xml")
+            self.assertEqual(dados, esperado)
+            self.assertEqual(relido, esperado)
+
+    def test_de_unico_mantem_xml_original(self):
+        xml = montar_de()
+        (_, dados, erro), = iterar_documentos_nfe(xml)
+        self.assertIsNone(erro)
+        self.assertEqual(dados, extrair_dados_nfe(xml, "lxml"))
+        self.assertEqual(extrair_documentos_nfe(xml), ([extrair_dados_nfe(xml)], []))
+
+    def test_de_com_erro_nao_interrompe_o_lote(self):
+        lote = montar_lote(montar_de(cdc="1" * 44), montar_de(cdc="2" * 44, tipo="FAC"), montar_de(cdc="3" * 44))
+        documentos, erros = extrair_documentos_nfe(lote)
+        self.assertEqual([dados["cdc"] for dados in documentos], ["1" * 44, "3" * 44])
+        self.assertEqual([posicao for posicao, _ in erros], [2])
+
+    def test_lote_truncado(self):
+        lote = montar_lote(montar_de(cdc="1" * 44), montar_de(cdc="2" * 44))
+        documentos, erros = extrair_documentos_nfe(lote[:-200])
+        self.assertEqual([dados["cdc"] for dados in documentos], ["1" * 44])
+        self.assertIsInstance(erros[0][1], XMLParseError)
+
+
+@override_settings(XML_PARSE_MIN_PARALELO=1, XML_PARSE_WORKERS=0)
+class ParseParaleloTest(SimpleTestCase):
+    """
+    Parse em processos (parse_paralelo): o resultado volta na ordem da
+    entrada, um XML com erro não afeta os outros, e dentro de um processo
+    daemon o parse roda no próprio processo.
+    """
+
+    def setUp(self):
+        self.diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.diretorio)
+
+    def itens(self):
+        return [
+            ("a", dados_xml(1)),
+            ("quebrado", b'<rDE><DE Id="1"><gTimb>'),
+            ("texto", montar_de(cdc=f"{2:044d}")),
+            ("lote", montar_lote(montar_de(cdc="3" * 44), montar_de(cdc="4" * 44))),
+            ("lote_com_erro", montar_lote(montar_de(cdc="5" * 44), montar_de(cdc="6" * 44, tipo="FAC"))),
+            ("memoria", memoryview(dados_xml(7))),
+        ]
+
+    def test_conteudos(self):
+        for workers in (1, 2):
+            with self.subTest(workers=workers), \
+                    mock.patch("documentos.parse_paralelo.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as pool:
+                resultados = extrair_conteudos(self.itens(), workers=workers)
+
+                self.assertEqual(pool.call_count, 0 if workers == 1 else 1)
+                self.assertEqual([chave for chave, _, _ in resultados], ["a", "quebrado", "texto", "lote", "lote_com_erro", "memoria"])
+                cdcs = {chave: [dados["cdc"] for dados in documentos] for chave, documentos, _ in resultados if documentos}
+                self.assertEqual(cdcs, {
+                    "a": [dados_de(1)["cdc"]],
+                    "texto": [f"{2:044d}"],
+                    "lote": ["3" * 44, "4" * 44],
+                    "memoria": [dados_de(7)["cdc"]],
+                })
+                erros = {chave: erro for chave, documentos, erro in resultados if erro}
+                self.assertEqual(set(erros), {"quebrado", "lote_com_erro"})
+                self.assertTrue(erros["lote_com_erro"]["mensagem"].startswith("DE 2: "))
+                self.assertIn("Traceback", erros["quebrado"]["traceback"])
+
+    def test_arquivos(self):
+        conteudos = {"1.xml": dados_xml(1), "leia-me.xml": b"<nota/>", "quebrado.xml": b'<rDE><DE Id="1"><gTimb>', "2.xml": dados_xml(2)}
+        caminhos = []
+        for nome, conteudo in conteudos.items():
+            caminhos.append(os.path.join(self.diretorio, nome))
+            with open(caminhos[-1], "wb") as f:
+                f.write(conteudo)
+        caminhos.append(os.path.join(self.diretorio, "apagado.xml"))
+
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                resultados = extrair_arquivos(caminhos, workers=workers)
+                self.assertEqual([chave for chave, _, _ in resultados], caminhos)
+                situacoes = [
+                    "ok" if documentos else ("erro" if erro else "ignorado")
+                    for _, documentos, erro in resultados
+                ]
+                self.assertEqual(situacoes, ["ok", "ignorado", "erro", "ok", "erro"])
+                self.assertEqual(resultados[3][1][0]["num_doc"], "0000002")
+
+    def test_numero_workers(self):
+        self.assertEqual(numero_workers(3), 3)
+        with override_settings(XML_PARSE_WORKERS=5):
+            self.assertEqual(numero_workers(), 5)
+        with override_settings(XML_PARSE_WORKERS=0), mock.patch("documentos.parse_paralelo.os.cpu_count", return_value=None):
+            self.assertEqual(numero_workers(), 1)
+
+    def test_processo_daemon_roda_no_proprio_processo(self):
+        # Worker prefork do Celery: processo daemon não pode ter filhos
+        with mock.patch("documentos.parse_paralelo.multiprocessing.current_process", return_value=SimpleNamespace(daemon=True)), \
+                mock.patch("documentos.parse_paralelo.ProcessPoolExecutor") as pool:
+            self.assertEqual(numero_workers(4), 1)
+            resultados = extrair_conteudos(self.itens(), workers=4)
+        pool.assert_not_called()
+        self.assertEqual([erro is None for _, _, erro in resultados], [True, False, True, True, False, True])
+
+    @override_settings(XML_PARSE_MIN_PARALELO=50)
+    def test_poucos_xmls_no_proprio_processo(self):
+        with mock.patch("documentos.parse_paralelo.ProcessPoolExecutor") as pool:
+            self.assertEqual(len(extrair_conteudos(self.itens(), workers=2)), 6)
+        pool.assert_not_called()
+
+
+class AnexosCompactadosTest(SimpleTestCase):
+    """
+    Expansão em memória de anexos .zip / .xml.gz, com os limites contra zip bomb.
+    """
+
+    def _zip(self, arquivos):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for nome, conteudo in arquivos.items():
+                zf.writestr(nome, conteudo)
+        return {"filename": "notas.zip", "mime_type": "application/zip", "payload_bytes": buffer.getvalue()}
+
+    def test_cada_xml_vira_um_anexo(self):
+        xml = montar_de().encode("utf-8")
+        anexos = expandir_anexos([
+            self._zip({"2025/a.xml": xml, "b.XML": xml, "leia.pdf": b"%PDF", "__MACOSX/._a.xml": b"x"}),
+            {"filename": "c.xml.gz", "mime_type": "application/gzip", "payload_bytes": gzip.compress(xml)},
+            {"filename": "d.xml", "mime_type": "text/xml", "payload_bytes": xml},
+        ])
+        self.assertEqual(
+            [anexo["filename"] for anexo in anexos],
+            ["notas.zip/a.xml", "notas.zip/b.XML", "c.xml.gz/c.xml", "d.xml"],
+        )
+        self.assertTrue(all(anexo["payload_bytes"] == xml for anexo in anexos))
+
+    def test_gzip_sem_xml_e_ignorado(self):
+        xml = montar_de().encode("utf-8")
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename="nota.xml", mode="wb", fileobj=buffer) as saida:
+            saida.write(xml)
+        anexos = expandir_anexos([
+            {"filename": "backup.tar.gz", "mime_type": "application/gzip", "payload_bytes": gzip.compress(b"tar")},
+            {"filename": "relatorio.pdf.gz", "mime_type": "application/gzip", "payload_bytes": gzip.compress(b"%PDF")},
+            # Sem extensão: vale o nome original gravado no cabeçalho do gzip
+            {"filename": "anexo", "mime_type": "application/gzip", "payload_bytes": buffer.getvalue()},
+        ])
+        self.assertEqual([(a["filename"], a["payload_bytes"]) for a in anexos], [("anexo/nota.xml", xml)])
+
+    def test_limites(self):
+        zip_grande = self._zip({"a.xml": b"0" * 10_000})
+        (anexo,) = expandir_anexos([zip_grande], max_bytes=1_000)
+        self.assertIn("acima de 1000 bytes", anexo["erro"])
+        self.assertEqual(anexo["filename"], "notas.zip")
+
+        (anexo,) = expandir_anexos([self._zip({"a.xml": b"<a/>", "b.xml": b"<b/>"})], max_arquivos=1)
+        self.assertIn("mais de 1 XML", anexo["erro"])
+
+    def test_compactado_corrompido(self):
+        (anexo,) = expandir_anexos([{"filename": "x.zip", "mime_type": "application/zip", "payload_bytes": b"lixo"}])
+        self.assertIn("erro", anexo)
+        (anexo,) = expandir_anexos([{"filename": "x.xml.gz", "mime_type": "", "payload_bytes": b"lixo"}])
+        self.assertIn("erro", anexo)
+
+
+def storage_xml_temporario(caso):
+    """
+    Aponta o storage documentos_xml para um diretório temporário até o fim do
+    teste `caso`; devolve o diretório.
+    """
+    diretorio = tempfile.mkdtemp()
+    caso.addCleanup(shutil.rmtree, diretorio)
+    storages = {
+        **settings.STORAGES,
+        STORAGE_XML: {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": diretorio},
+        },
+    }
+    configuracao = override_settings(STORAGES=storages)
+    configuracao.enable()
+    caso.addCleanup(configuracao.disable)
+    return diretorio
+
+
+class DocumentoXmlStorageTest(SimpleTestCase):
+    def setUp(self):
+        self.diretorio = storage_xml_temporario(self)
+
+    def test_xml_no_storage_por_sha256(self):
+        payload = montar_de().encode("utf-8")
+        sha256, tamanho = guardar_xml(payload)
+        self.assertEqual((sha256, tamanho), (hashlib.sha256(payload).hexdigest(), len(payload)))
+        documento = Documento(cdc="1", xml_sha256=sha256, xml_tamanho=tamanho)
+        self.assertEqual(documento.documento_xml_bytes, payload)
+        self.assertEqual(documento.documento_xml, payload.decode("utf-8"))
+
+        # O mesmo XML (outra empresa, reenvio) não gera outro arquivo
+        self.assertEqual(guardar_xml(memoryview(payload), sha256=sha256), (sha256, tamanho))
+        arquivos = [nome for _, _, nomes in os.walk(self.diretorio) for nome in nomes]
+        self.assertEqual(arquivos, [f"{sha256}.xml.z"])
+
+    def test_download_de_xml_iso_8859_1(self):
+        xml = montar_de(prolog='<?xml version="1.0" encoding="ISO-8859-1"?>')
+        payload = xml.encode("latin-1")
+        # Mesmo caminho da gravação: os bytes do anexo vão para o storage como vieram
+        sha256, tamanho = guardar_xml(payload)
+        self.assertEqual(sha256, sha256_anexo(payload))  # o mesmo digest de AnexoProcessado
+        documento = Documento(cdc="1", xml_sha256=sha256, xml_tamanho=tamanho)
+        request = RequestFactory().get("/documentos/1/xml/")
+        with mock.patch.object(Documento.objects, "get", return_value=documento):
+            response = DocumentoXMLDownloadView.as_view()(request, cdc="1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, payload)
+        self.assertNotIn("charset", response["Content-Type"])
+        raiz = ET.fromstring(response.content)
+        self.assertEqual(raiz.find(".//ns:dNomFanEmi", {"ns": SIFEN_NS}).text.strip(), "Comercial Asunción")
+        # Como texto, o prólogo passa a declarar UTF-8
+        self.assertEqual(documento.documento_xml, xml.replace('encoding="ISO-8859-1"', 'encoding="UTF-8"'))
+
+    def test_limpar_xml_orfaos(self):
+        usado, _ = guardar_xml(b"<rDE>usado</rDE>")
+        orfao, _ = guardar_xml(b"<rDE>rollback</rDE>")
+        consulta = mock.Mock()
+        consulta.values_list.return_value = [usado]
+        with mock.patch.object(Documento.objects, "filter", return_value=consulta):
+            call_command("limpar_xml_orfaos", "--idade-minima", "1", stdout=io.StringIO())
+            self.assertTrue(storages[STORAGE_XML].exists(chave_xml(orfao)))  # recente: pode ser gravação em andamento
+
+            saida = io.StringIO()
+            call_command("limpar_xml_orfaos", "--idade-minima", "0", "--dry-run", stdout=saida)
+            self.assertIn(chave_xml(orfao), saida.getvalue())
+            self.assertTrue(storages[STORAGE_XML].exists(chave_xml(orfao)))
+
+            call_command("limpar_xml_orfaos", "--idade-minima", "0", stdout=io.StringIO())
+        self.assertFalse(storages[STORAGE_XML].exists(chave_xml(orfao)))
+        self.assertTrue(storages[STORAGE_XML].exists(chave_xml(usado)))
+
+    def test_linhas_antigas(self):
+        xml = montar_de()
+        # PostgreSQL devolve o BinaryField como memoryview
+        documento = Documento(cdc="1", documento_xml_zlib=memoryview(zlib.compress(xml.encode("utf-8"))))
+        self.assertEqual(documento.documento_xml, xml)
+
+        documento = Documento(cdc="1", documento_xml_texto="<rDE/>")
+        self.assertEqual(documento.documento_xml, "<rDE/>")
+
+        # Texto gravado antes da correção, ainda com o encoding original no prólogo
+        documento = Documento(cdc="1", documento_xml_texto='<?xml version="1.0" encoding="ISO-8859-1"?><rDE/>')
+        self.assertEqual(documento.documento_xml, '<?xml version="1.0" encoding="UTF-8"?><rDE/>')
+
+
+@override_settings(METRICS_TOKEN="segredo", PROMETHEUS_MULTIPROC_DIR="")
+class MetricasTest(SimpleTestCase):
+    def test_etapa_medida_aparece_no_metrics(self):
+        resumo = {"conta": "metricas@teste", "tempos": {}}
+        with medir(resumo, "parse"):
+            pass
+        self.assertIn("parse", resumo["tempos"])
+
+        response = metricas_view(RequestFactory().get("/metrics", HTTP_AUTHORIZATION="Bearer segredo"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'ingestao_etapa_segundos_count{conta="metricas@teste",etapa="parse"} 1.0',
+            response.content.decode(),
+        )
+
+    def test_token(self):
+        self.assertEqual(metricas_view(RequestFactory().get("/metrics")).status_code, 403)
+        response = metricas_view(RequestFactory().get("/metrics", HTTP_AUTHORIZATION="Bearer outro"))
+        self.assertEqual(response.status_code, 403)
+        response = metricas_view(RequestFactory().get("/metrics", HTTP_AUTHORIZATION="Bearer segredo"))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_sem_token_so_staff(self):
+        # Sem token configurado, /metrics não fica público (expõe o e-mail das contas)
+        self.assertEqual(metricas_view(RequestFactory().get("/metrics")).status_code, 403)
+        request = RequestFactory().get("/metrics", HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(metricas_view(request).status_code, 403)
+
+        request = RequestFactory().get("/metrics")
+        request.user = AnonymousUser()
+        self.assertEqual(metricas_view(request).status_code, 403)
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=False)
+        self.assertEqual(metricas_view(request).status_code, 403)
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=True)
+        self.assertEqual(metricas_view(request).status_code, 200)
+
+
+# Respostas do imaplib para "UID FETCH ... (UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])"
+# e "UID FETCH ... (UID BODY.PEEK[n])", como capturadas de servidores reais
+TEXTO_PLANO = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL NIL)'
+TEXTO_HTML = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 80 2 NIL NIL NIL NIL)'
+PDF = b'("APPLICATION" "PDF" ("NAME" "factura.pdf") NIL NIL "BASE64" 5120 NIL ("ATTACHMENT" ("FILENAME" "factura.pdf")) NIL NIL)'
+NOTA_XML = b'("APPLICATION" "XML" ("NAME" "nota.xml") NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "nota.xml")) NIL NIL)'
+CABECALHOS = b"Subject: Factura 001-003-0003334\r\nFrom: facturacion@example.com.py\r\n\r\n"
+
+
+def resposta_estrutura(seq, uid, bodystructure):
+    return [
+        (
+            b"%d (UID %d BODYSTRUCTURE %s BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {%d}"
+            % (seq, uid, bodystructure, len(CABECALHOS)),
+            CABECALHOS,
+        ),
+        b")",
+    ]
+
+
+class ImapParserTest(SimpleTestCase):
+    """
+    Parser do BODYSTRUCTURE/FETCH (imap.py): seções BODY[n] de cada anexo XML
+    e associação das respostas aos UIDs.
+    """
+
+    def partes(self, bodystructure):
+        (dados,) = parse_fetch_response(resposta_estrutura(1, 101, bodystructure)).values()
+        return listar_partes_xml(dados["BODYSTRUCTURE"])
+
+    def test_parte_unica(self):
+        partes = self.partes(
+            b'("APPLICATION" "XML" ("NAME" "nota.xml") NIL NIL "BASE64" 1234 NIL '
+            b'("ATTACHMENT" ("FILENAME" "nota.xml")) NIL NIL)'
+        )
+        self.assertEqual(partes, [{
+            "secao": "1", "filename": "nota.xml", "mime_type": "application/xml", "encoding": "base64", "size": 1234,
+        }])
+
+    def test_multipart(self):
+        xml = b'("APPLICATION" "OCTET-STREAM" ("NAME" "nota.XML") NIL NIL "BASE64" 2048 NIL ("ATTACHMENT" ("FILENAME" "nota.XML")) NIL NIL)'
+        partes = self.partes(b"(%s%s%s \"MIXED\" (\"BOUNDARY\" \"b1\") NIL NIL NIL)" % (TEXTO_PLANO, PDF, xml))
+        self.assertEqual([(p["secao"], p["filename"], p["size"]) for p in partes], [("3", "nota.XML", 2048)])
+
+        # Sem XML: PDF e texto não são baixados
+        self.assertEqual(self.partes(b"(%s%s \"MIXED\" (\"BOUNDARY\" \"b1\") NIL NIL NIL)" % (TEXTO_PLANO, PDF)), [])
+
+    def test_multipart_aninhado(self):
+        alternativa = b"(%s%s \"ALTERNATIVE\" (\"BOUNDARY\" \"b2\") NIL NIL NIL)" % (TEXTO_PLANO, TEXTO_HTML)
+        # text/xml tem o campo extra de linhas antes da disposition
+        xml = b'("TEXT" "XML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 900 20 NIL ("ATTACHMENT" ("FILENAME" "a.xml")) NIL NIL)'
+        zip_ = b'("APPLICATION" "ZIP" ("NAME" "notas.zip") NIL NIL "BASE64" 4096 NIL ("ATTACHMENT" ("FILENAME" "notas.zip")) NIL NIL)'
+        interno = b"(%s%s \"MIXED\" (\"BOUNDARY\" \"b3\") NIL NIL NIL)" % (xml, zip_)
+        partes = self.partes(b"(%s%s \"MIXED\" (\"BOUNDARY\" \"b1\") NIL NIL NIL)" % (alternativa, interno))
+        self.assertEqual(
+            [(p["secao"], p["filename"], p["mime_type"], p["encoding"]) for p in partes],
+            [("2.1", "a.xml", "text/xml", "quoted-printable"), ("2.2", "notas.zip", "application/zip", "base64")],
+        )
+
+    def test_mensagem_encaminhada_nao_e_percorrida(self):
+        encaminhada = (
+            b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 3000 ("Mon, 1 Jan 2025 10:00:00 -0300" "Fwd" NIL NIL NIL NIL NIL NIL NIL NIL) '
+            b'(%s "MIXED" ("BOUNDARY" "b9") NIL NIL NIL) 60 NIL ("ATTACHMENT" ("FILENAME" "fwd.eml")) NIL NIL)'
+            % b'("APPLICATION" "XML" ("NAME" "dentro.xml") NIL NIL "BASE64" 10 NIL NIL NIL NIL)'
+        )
+        self.assertEqual(self.partes(b"(%s%s \"MIXED\" NIL NIL NIL NIL)" % (TEXTO_PLANO, encaminhada)), [])
+
+    def test_filename_em_literal(self):
+        # Nomes com caracteres especiais chegam como literal {n}: o imaplib quebra a resposta em tuplas
+        resposta = [
+            (
+                b'1 (UID 101 BODYSTRUCTURE (%s("APPLICATION" "OCTET-STREAM" ("NAME" {12}' % TEXTO_PLANO,
+                b'nota "1".xml',
+            ),
+            (
+                b') NIL NIL "BASE64" 2048 NIL ("ATTACHMENT" ("FILENAME" {12}',
+                b'nota "1".xml',
+            ),
+            (
+                b')) NIL NIL) "MIXED" ("BOUNDARY" "b1") NIL NIL NIL) BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {%d}'
+                % len(CABECALHOS),
+                CABECALHOS,
+            ),
+            b")",
+        ]
+        dados = parse_fetch_response(resposta)[101]
+        self.assertEqual(dados["BODY[HEADER]"], CABECALHOS)
+        (parte,) = listar_partes_xml(dados["BODYSTRUCTURE"])
+        self.assertEqual((parte["secao"], parte["filename"]), ("2", 'nota "1".xml'))
+
+    def test_disposition_nil(self):
+        # Sem Content-Disposition: o nome vem do parâmetro NAME do Content-Type
+        partes = self.partes(
+            b'(%s("APPLICATION" "OCTET-STREAM" ("NAME" "nota.xml") NIL NIL "BASE64" 100 NIL NIL NIL NIL) "MIXED" NIL NIL NIL NIL)'
+            % TEXTO_PLANO
+        )
+        self.assertEqual([(p["secao"], p["filename"]) for p in partes], [("2", "nota.xml")])
+
+        # Sem nome algum, vale o content-type
+        partes = self.partes(b'("APPLICATION" "XML" NIL NIL NIL "7BIT" 100 NIL NIL NIL NIL)')
+        self.assertEqual([(p["secao"], p["filename"], p["encoding"]) for p in partes], [("1", "parte-1.xml", "7bit")])
+
+    def test_nomes_codificados(self):
+        # RFC 2231, inteiro e em continuações
+        self.assertEqual(decodificar_filename({"filename*": "utf-8''fatura%20n%C2%BA1.xml"}), "fatura nº1.xml")
+        self.assertEqual(
+            decodificar_filename({"filename*0*": "iso-8859-1'es'Fact%FAra", "filename*1": "_2025.xml"}),
+            "Factúra_2025.xml",
+        )
+        # RFC 2047
+        self.assertEqual(decodificar_filename({"name": "=?UTF-8?B?RmFjdHVyYcOhLnhtbA==?="}), "Facturaá.xml")
+        self.assertEqual(decodificar_filename({"name": "=?iso-8859-1?Q?Nota_cr=E9dito.xml?="}), "Nota crédito.xml")
+        # filename (disposition) tem prioridade sobre name (content-type)
+        self.assertEqual(decodificar_filename({"name": "a.xml", "filename": "b.xml"}), "b.xml")
+        self.assertIsNone(decodificar_filename({}))
+
+        partes = self.partes(
+            b'("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 100 NIL '
+            b'("ATTACHMENT" ("FILENAME*" "utf-8\'\'nota%20cr%C3%A9dito.xml")) NIL NIL)'
+        )
+        self.assertEqual([p["filename"] for p in partes], ["nota crédito.xml"])
+
+    def test_secoes_do_fetch_por_uid(self):
+        resposta = [
+            (b"1 (UID 101 BODY[2] {8}", b"PERFIC8+"),
+            b")",
+            # Alguns servidores mandam o UID depois do conteúdo e o offset <0>
+            (b"2 (BODY[2]<0> {8}", b"PEVGIC8+"),
+            b" UID 102)",
+            # Várias seções: uma tupla por literal
+            (b"3 (UID 103 BODY[2.1] {4}", b"AAAA"),
+            (b" BODY[3] {4}", b"BBBB"),
+            b")",
+        ]
+        self.assertEqual(parse_fetch_response(resposta), {
+            101: {"UID": "101", "BODY[2]": b"PERFIC8+"},
+            102: {"BODY[2]": b"PEVGIC8+", "UID": "102"},
+            103: {"UID": "103", "BODY[2.1]": b"AAAA", "BODY[3]": b"BBBB"},
+        })
+
+        # Sem o item UID, a chave é o número de sequência
+        self.assertEqual(parse_fetch_response([(b"7 (BODY[1] {2}", b"ok"), b")"]), {7: {"BODY[1]": b"ok"}})
+
+
+class ImapFalso:
+    """
+    Conexão IMAP com respostas prontas para cada UID FETCH, registrando os
+    comandos recebidos.
+    """
+
+    def __init__(self, respostas):
+        self.respostas = respostas
+        self.comandos = []
+
+    def uid(self, comando, conjunto, itens):
+        self.comandos.append((comando, conjunto, itens))
+        for trecho, resposta in self.respostas:
+            if trecho in itens:
+                return "OK", resposta
+        return "NO", [None]
+
+
+class ImapLotesTest(SimpleTestCase):
+    """
+    Conjuntos de UIDs (o mesmo formato vai no UID STORE +FLAGS (\\Deleted)) e
+    associação das respostas do FETCH em lote a cada UID.
+    """
+
+    def test_compactar_uids(self):
+        self.assertEqual(compactar_uids([1, 2, 3, 5, 7, 8]), "1:3,5,7:8")
+        self.assertEqual(compactar_uids([42]), "42")
+        self.assertEqual(compactar_uids([9, 3, 1, 2, 10]), "1:3,9:10")
+        self.assertEqual(compactar_uids([5, 5, 6, 6, 4]), "4:6")
+        self.assertEqual(compactar_uids(["12", b"11", 13]), "11:13")
+        self.assertEqual(compactar_uids([100, 102, 104]), "100,102,104")
+        self.assertEqual(compactar_uids([]), "")
+
+    def estrutura_xml(self, secao_xml):
+        xml = b'("APPLICATION" "XML" ("NAME" "nota.xml") NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "nota.xml")) NIL NIL)'
+        if secao_xml == "1":
+            return xml
+        return b"(%s%s \"MIXED\" NIL NIL NIL NIL)" % (TEXTO_PLANO, xml)
+
+    def test_fetch_em_lote_por_uid(self):
+        estrutura = (
+            resposta_estrutura(1, 101, self.estrutura_xml("2"))
+            + resposta_estrutura(2, 102, self.estrutura_xml("1"))
+            + resposta_estrutura(3, 103, b"(%s%s \"MIXED\" NIL NIL NIL NIL)" % (TEXTO_PLANO, PDF))
+            + resposta_estrutura(4, 104, self.estrutura_xml("2"))
+        )
+        mail = ImapFalso([
+            ("BODYSTRUCTURE", estrutura),
+            # Respostas fora da ordem dos UIDs pedidos
+            ("BODY.PEEK[2]", [(b"4 (UID 104 BODY[2] {8}", b"PGQvPg=="), b")", (b"1 (UID 101 BODY[2] {8}", b"PGEvPg=="), b")"]),
+            ("BODY.PEEK[1]", [(b"2 (UID 102 BODY[1] {8}", b"PGIvPg=="), b")"]),
+        ])
+
+        # 105 não veio na resposta do BODYSTRUCTURE (apagada por outro cliente)
+        mensagens = _buscar_lote_imap(mail, [104, 101, 102, 103, 105])
+
+        self.assertEqual(sorted(mensagens), [101, 102, 103, 104])
+        conteudo = {uid: [a["payload_bytes"] for a in anexos] for uid, (_, anexos) in mensagens.items()}
+        self.assertEqual(conteudo, {101: [b"<a/>"], 102: [b"<b/>"], 103: [], 104: [b"<d/>"]})
+        self.assertEqual(mensagens[101][0]["subject"], "Factura 001-003-0003334")
+
+        # Um FETCH de estrutura para o lote e um por combinação de seções
+        self.assertEqual(mail.comandos, [
+            ("FETCH", "101:105", "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])"),
+            ("FETCH", "101,104", "(UID BODY.PEEK[2])"),
+            ("FETCH", "102", "(UID BODY.PEEK[1])"),
+        ])
+
+    def test_falha_no_fetch_do_conteudo(self):
+        mail = ImapFalso([
+            ("BODYSTRUCTURE", resposta_estrutura(1, 101, self.estrutura_xml("2")) + resposta_estrutura(2, 102, self.estrutura_xml("2"))),
+            # O servidor só devolveu uma das mensagens
+            ("BODY.PEEK[2]", [(b"2 (UID 102 BODY[2] {8}", b"PGIvPg=="), b")"]),
+        ])
+        mensagens = _buscar_lote_imap(mail, [101, 102])
+        # 101 fica fora do resultado (falha de FETCH): não é apagada e segura o watermark
+        self.assertEqual(list(mensagens), [102])
+        self.assertEqual(mensagens[102][1][0]["payload_bytes"], b"<b/>")
+
+        self.assertEqual(_buscar_lote_imap(ImapFalso([]), [101, 102]), {})
+
+
+def criar_conta(username="conta@empresa.com.py", **campos):
+    empresa = Company.objects.create(name="Empresa Teste")
+    campos.setdefault("host", "imap.empresa.com.py")
+    campos.setdefault("port", "993")
+    return User.objects.create(company=empresa, username=username, password="senha", **campos)
+
+
+class ContaImapFalsa(ImapFalso):
+    """
+    ImapFalso com o resto da sessão usada por leitor_email_box: SELECT com
+    UIDVALIDITY, UID SEARCH (devolve `uids`), STORE e EXPUNGE. Cada mensagem
+    tem um PDF ou, se o UID está em `xmls` ({uid: bytes}), um XML na parte 2.
+    Os FETCH de estrutura cujo conjunto está em `falhas` respondem NO.
+    """
+
+    def __init__(self, uidvalidity, uids, falhas=(), xmls=None):
+        xmls = xmls or {}
+        estrutura = []
+        conteudo = []
+        for seq, uid in enumerate(uids, start=1):
+            anexo = NOTA_XML if uid in xmls else PDF
+            estrutura += resposta_estrutura(seq, uid, b"(%s%s \"MIXED\" NIL NIL NIL NIL)" % (TEXTO_PLANO, anexo))
+            if uid in xmls:
+                dados = base64.b64encode(xmls[uid])
+                conteudo += [(b"%d (UID %d BODY[2] {%d}" % (seq, uid, len(dados)), dados), b")"]
+        super().__init__([("BODYSTRUCTURE", estrutura), ("BODY.PEEK[2]", conteudo)])
+        self.uidvalidity = uidvalidity
+        self.uids = uids
+        self.falhas = set(falhas)
+
+    def login(self, username, password):
+        return "OK", [b"LOGIN completed"]
+
+    def select(self, folder):
+        return "OK", [str(len(self.uids)).encode()]
+
+    def response(self, codigo):
+        return codigo, [str(self.uidvalidity).encode()]
+
+    def uid(self, comando, *args):
+        if comando == "SEARCH":
+            self.comandos.append((comando, args[1]))
+            return "OK", [" ".join(str(uid) for uid in self.uids).encode()]
+        if comando == "STORE":
+            self.comandos.append((comando, args[0]))
+            return "OK", [None]
+        if args[0] in self.falhas:
+            self.comandos.append((comando, args[0], args[1]))
+            return "NO", [None]
+        return super().uid(comando, *args)
+
+    def expunge(self):
+        return "OK", [None]
+
+    def close(self):
+        return "OK", [None]
+
+    def logout(self):
+        return "BYE", [None]
+
+
+@override_settings(IMAP_FETCH_BATCH=2, EMAIL_INGEST_STAGING=False)
+class ImapWatermarkTest(TestCase):
+    """
+    Sincronização incremental por UID (ImapSyncState): janela de datas só na
+    primeira execução ou com UIDVALIDITY novo, e o watermark parado no
+    primeiro UID que falhou no FETCH.
+    """
+
+    def setUp(self):
+        self.conta = criar_conta()
+
+    def ler(self, mail):
+        with mock.patch("documentos.email_reader.imaplib.IMAP4_SSL", return_value=mail), \
+                mock.patch("documentos.email_reader._processar_anexos"), \
+                mock.patch("documentos.email_reader._processar_mensagem_email", return_value=True), \
+                redirect_stdout(io.StringIO()):
+            resumo = leitor_email_box(self.conta)
+        estado = ImapSyncState.objects.get(account=self.conta)
+        buscas = [comando[1] for comando in mail.comandos if comando[0] == "SEARCH"]
+        apagados = [comando[1] for comando in mail.comandos if comando[0] == "STORE"]
+        return resumo, (estado.uidvalidity, estado.last_uid), buscas, apagados
+
+    def estado(self, uidvalidity, last_uid):
+        ImapSyncState.objects.create(account=self.conta, folder="inbox", uidvalidity=uidvalidity, last_uid=last_uid)
+
+    def test_primeira_execucao_pela_janela_de_datas(self):
+        resumo, estado, buscas, apagados = self.ler(ContaImapFalsa(100, [5, 7, 8]))
+        self.assertTrue(buscas[0].startswith("(SINCE "))
+        self.assertEqual(estado, (100, 8))
+        self.assertEqual(apagados, ["5,7", "8"])
+        self.assertEqual(resumo["apagados"], 3)
+
+    def test_incremental_pelo_uid(self):
+        self.estado(100, 7)
+        # "UID 8:*" também devolve o maior UID da pasta (7), que é ignorado
+        resumo, estado, buscas, apagados = self.ler(ContaImapFalsa(100, [7, 9, 10]))
+        self.assertEqual(buscas, ["UID 8:*"])
+        self.assertEqual(estado, (100, 10))
+        self.assertEqual(apagados, ["9:10"])
+        self.assertEqual(resumo["encontrados"], 2)
+
+    def test_incremental_com_watermark_zero(self):
+        # Estado gravado sem nada processado: não volta para a janela de datas
+        self.estado(100, 0)
+        _, estado, buscas, _ = self.ler(ContaImapFalsa(100, [3]))
+        self.assertEqual(buscas, ["UID 1:*"])
+        self.assertEqual(estado, (100, 3))
+
+    def test_uidvalidity_novo_reinicia_a_pasta(self):
+        self.estado(100, 500)
+        _, estado, buscas, apagados = self.ler(ContaImapFalsa(200, [2, 3]))
+        self.assertTrue(buscas[0].startswith("(SINCE "))
+        # UIDs abaixo do watermark antigo valem na pasta nova
+        self.assertEqual(estado, (200, 3))
+        self.assertEqual(apagados, ["2:3"])
+
+    def test_falha_no_fetch_segura_o_watermark(self):
+        self.estado(100, 7)
+        # Lotes de 2: o segundo (10,11) falha; o terceiro (12) é lido e apagado
+        resumo, estado, _, apagados = self.ler(ContaImapFalsa(100, [8, 9, 10, 11, 12], falhas={"10:11"}))
+        self.assertEqual(estado, (100, 9))
+        self.assertEqual(apagados, ["8:9", "12"])
+        self.assertEqual(resumo["apagados"], 3)
+
+        # A próxima execução busca de novo a partir do UID que falhou
+        _, estado, buscas, _ = self.ler(ContaImapFalsa(100, [10, 11]))
+        self.assertEqual(buscas, ["UID 10:*"])
+        self.assertEqual(estado, (100, 11))
+
+
+class GraphPaginasFalso:
+    """
+    GraphClient.paginas com páginas prontas por URL, seguindo @odata.nextLink.
+    """
+
+    def __init__(self, paginas):
+        self.paginas_por_url = paginas
+        self.urls = []
+
+    def paginas(self, url, headers=None):
+        while url:
+            self.urls.append(url)
+            pagina = self.paginas_por_url[url]
+            yield pagina
+            url = pagina.get("@odata.nextLink")
+
+
+class GraphDeltaTest(SimpleTestCase):
+    """
+    Delta query com limite de mensagens por execução: a leitura para no fim
+    de uma página e continua dela na execução seguinte, até o deltaLink.
+    """
+
+    def pagina(self, ids, proxima=None, delta=None):
+        pagina = {"value": [{"id": i} for i in ids]}
+        if proxima:
+            pagina["@odata.nextLink"] = proxima
+        if delta:
+            pagina["@odata.deltaLink"] = delta
+        return pagina
+
+    def test_limite_salva_o_next_link(self):
+        conta = SimpleNamespace(username="conta@empresa.com.py", office365_delta_link=None)
+        inicial = (
+            "/users/conta@empresa.com.py/mailFolders/inbox/messages/delta"
+            "?$filter=receivedDateTime ge 2025-07-21T00:00:00Z&$select=id,subject,from,receivedDateTime,hasAttachments"
+        )
+        cliente = GraphPaginasFalso({
+            inicial: self.pagina(["m1", "m2"], proxima="https://graph/p2"),
+            "https://graph/p2": {"value": [{"id": "m3"}, {"id": "m0", "@removed": {"reason": "deleted"}}],
+                                 "@odata.nextLink": "https://graph/p3"},
+            "https://graph/p3": self.pagina(["m4", "m5"], proxima="https://graph/p4"),
+            "https://graph/p4": self.pagina(["m6"], delta="https://graph/delta?token=1"),
+        })
+
+        with override_settings(GRAPH_PAGE_SIZE=50):
+            mensagens, link = _listar_mensagens_graph_delta(conta, cliente, "2025-07-21T00:00:00Z", 3)
+        # Para no fim da página em que o limite foi atingido, sem baixar a seguinte
+        self.assertEqual([m["id"] for m in mensagens], ["m1", "m2", "m3"])
+        self.assertEqual(link, "https://graph/p3")
+        self.assertEqual(cliente.urls, [inicial, "https://graph/p2"])
+
+        # Próxima execução: continua do link salvo, não do início
+        conta.office365_delta_link = link
+        mensagens, link = _listar_mensagens_graph_delta(conta, cliente, "2025-07-21T00:00:00Z", 3)
+        self.assertEqual([m["id"] for m in mensagens], ["m4", "m5", "m6"])
+        self.assertEqual(link, "https://graph/delta?token=1")
+
+    def test_sem_limite_le_ate_o_delta_link(self):
+        conta = SimpleNamespace(username="c", office365_delta_link="https://graph/delta?token=0")
+        cliente = GraphPaginasFalso({
+            "https://graph/delta?token=0": self.pagina(["m1"], proxima="https://graph/p2"),
+            "https://graph/p2": self.pagina([], delta="https://graph/delta?token=1"),
+        })
+        mensagens, link = _listar_mensagens_graph_delta(conta, cliente, "2025-07-21T00:00:00Z", 200)
+        self.assertEqual(([m["id"] for m in mensagens], link), (["m1"], "https://graph/delta?token=1"))
+
+
+class RespostaFalsa:
+    def __init__(self, status_code=200, dados=None, headers=None):
+        self.status_code = status_code
+        self.dados = dados or {}
+        self.headers = headers or {}
+        self.text = str(self.dados)
+
+    def json(self):
+        return self.dados
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise AssertionError(f"HTTP {self.status_code}")
+
+
+class SessaoFalsa:
+    """
+    requests.Session que devolve as respostas na ordem (ou as calcula a partir
+    da requisição) e registra as chamadas.
+    """
+
+    def __init__(self, respostas):
+        self.respostas = list(respostas)
+        self.chamadas = []
+
+    def _responder(self, method, url, **kwargs):
+        self.chamadas.append((method, url, kwargs))
+        resposta = self.respostas.pop(0)
+        return resposta(method, url, **kwargs) if callable(resposta) else resposta
+
+    def request(self, method, url, **kwargs):
+        return self._responder(method, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._responder("POST", url, **kwargs)
+
+
+@override_settings(GRAPH_MAX_RETRIES=3)
+class GraphBatchTest(SimpleTestCase):
+    """
+    GraphClient.batch: lotes de até 20 sub-requisições, reenvio só das
+    limitadas (429/503) após o maior Retry-After e respostas por id.
+    """
+
+    def setUp(self):
+        self.cliente = GraphClient("tenant", "client", "segredo")
+        self.cliente.token = lambda renovar=False: "token"
+        pausa = mock.patch("documentos.graph.time.sleep")
+        self.sleep = pausa.start()
+        self.addCleanup(pausa.stop)
+
+    def requisicoes(self, quantidade):
+        return [{"id": str(i), "method": "GET", "url": f"/users/u/messages/m{i}/attachments"} for i in range(quantidade)]
+
+    def batch(self, status_por_id=None, retry_after=None):
+        # Responde cada sub-requisição com o status definido (ou 200) para aquele id
+        status_por_id = status_por_id or {}
+        retry_after = retry_after or {}
+
+        def responder(method, url, json=None, **kwargs):
+            respostas = []
+            for sub in json["requests"]:
+                status = status_por_id.get(sub["id"], 200)
+                headers = {"Retry-After": retry_after[sub["id"]]} if sub["id"] in retry_after else {}
+                respostas.append({"id": sub["id"], "status": status, "headers": headers, "body": {"url": sub["url"]}})
+            return RespostaFalsa(200, {"responses": list(reversed(respostas))})
+        return responder
+
+    def test_lotes_de_20(self):
+        self.cliente.sessao = SessaoFalsa([self.batch(), self.batch(), self.batch()])
+        respostas = self.cliente.batch(self.requisicoes(45))
+
+        lotes = [[sub["id"] for sub in kwargs["json"]["requests"]] for _, _, kwargs in self.cliente.sessao.chamadas]
+        self.assertEqual([len(lote) for lote in lotes], [20, 20, 5])
+        self.assertEqual(sum(lotes, []), [str(i) for i in range(45)])
+        self.assertTrue(all(url.endswith("/$batch") for _, url, _ in self.cliente.sessao.chamadas))
+        # Respostas fora de ordem voltam pelo id
+        self.assertEqual(len(respostas), 45)
+        self.assertEqual(respostas["7"]["body"]["url"], "/users/u/messages/m7/attachments")
+        self.sleep.assert_not_called()
+
+    def test_reenvia_so_as_limitadas(self):
+        self.cliente.sessao = SessaoFalsa([
+            self.batch({"1": 429, "3": 503}, retry_after={"1": "7", "3": "3"}),
+            self.batch({"3": 429}, retry_after={"3": "2"}),
+            self.batch(),
+        ])
+        respostas = self.cliente.batch(self.requisicoes(5))
+
+        reenviadas = [{sub["id"] for sub in kwargs["json"]["requests"]} for _, _, kwargs in self.cliente.sessao.chamadas]
+        self.assertEqual(reenviadas, [{"0", "1", "2", "3", "4"}, {"1", "3"}, {"3"}])
+        # Aguarda o maior Retry-After de cada rodada
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [7, 2])
+        self.assertEqual({i: r["status"] for i, r in respostas.items()}, {str(i): 200 for i in range(5)})
+        self.assertEqual(respostas["3"]["body"]["url"], "/users/u/messages/m3/attachments")
+
+    def test_desiste_depois_de_graph_max_retries(self):
+        self.cliente.sessao = SessaoFalsa([self.batch({"0": 429})] * 4)
+        respostas = self.cliente.batch(self.requisicoes(2))
+        # Sem Retry-After: backoff exponencial; na última rodada o 429 é devolvido
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2, 4])
+        self.assertEqual((respostas["0"]["status"], respostas["1"]["status"]), (429, 200))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "graph-testes"}},
+    GRAPH_MAX_RETRIES=2,
+)
+class GraphClientTest(SimpleTestCase):
+    """
+    Token em cache até TOKEN_MARGEM antes de expirar, uma única renovação em
+    401 e backoff em 429/503 respeitando Retry-After.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.emitidos = 0
+
+        def emitir_token(method, url, **kwargs):
+            self.emitidos += 1
+            return RespostaFalsa(200, {"access_token": f"token-{self.emitidos}", "expires_in": 3600})
+
+        self.login = SessaoFalsa([emitir_token] * 5)
+        sessoes = mock.patch("documentos.graph._sessao", side_effect=lambda chave: self.login)
+        sessoes.start()
+        self.addCleanup(sessoes.stop)
+        pausa = mock.patch("documentos.graph.time.sleep")
+        self.sleep = pausa.start()
+        self.addCleanup(pausa.stop)
+
+    def test_token_em_cache_com_margem(self):
+        with mock.patch.object(cache, "set", wraps=cache.set) as gravar:
+            self.assertEqual(obter_token_graph("tenant", "client", "segredo"), "token-1")
+        (chave, token, timeout), _ = gravar.call_args
+        self.assertEqual((chave, token, timeout), ("graph-token:tenant:client", "token-1", 3600 - TOKEN_MARGEM))
+
+        # Do cache, sem novo login; renovar=True ignora o cache
+        self.assertEqual(obter_token_graph("tenant", "client", "segredo"), "token-1")
+        self.assertEqual(len(self.login.chamadas), 1)
+        self.assertEqual(obter_token_graph("tenant", "client", "segredo", renovar=True), "token-2")
+        self.assertEqual(obter_token_graph("tenant", "client", "segredo"), "token-2")
+
+    def test_token_de_vida_curta(self):
+        self.login.respostas = [RespostaFalsa(200, {"access_token": "curto", "expires_in": 120})]
+        with mock.patch.object(cache, "set", wraps=cache.set) as gravar:
+            obter_token_graph("tenant", "client", "segredo")
+        self.assertEqual(gravar.call_args.args[2], 60)
+
+    def cliente(self, respostas):
+        cliente = GraphClient("tenant", "client", "segredo")
+        cliente.sessao = SessaoFalsa(respostas)
+        return cliente
+
+    def autorizacoes(self, cliente):
+        return [kwargs["headers"]["Authorization"] for _, _, kwargs in cliente.sessao.chamadas]
+
+    def test_401_renova_o_token_uma_vez(self):
+        cliente = self.cliente([RespostaFalsa(401), RespostaFalsa(200, {"value": []})])
+        response = cliente.get("/users/u/messages")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.autorizacoes(cliente), ["Bearer token-1", "Bearer token-2"])
+        self.assertEqual(cliente.sessao.chamadas[0][1], "https://graph.microsoft.com/v1.0/users/u/messages")
+
+        # Segundo 401 seguido: devolve a resposta em vez de renovar de novo
+        cliente = self.cliente([RespostaFalsa(401), RespostaFalsa(401)])
+        self.assertEqual(cliente.get("/users/u/messages").status_code, 401)
+        self.assertEqual(len(cliente.sessao.chamadas), 2)
+        self.assertEqual(self.emitidos, 3)
+
+    def test_backoff_com_retry_after(self):
+        cliente = self.cliente([
+            RespostaFalsa(429, headers={"Retry-After": "4"}),
+            RespostaFalsa(503),
+            RespostaFalsa(200),
+        ])
+        self.assertEqual(cliente.get("https://graph.microsoft.com/v1.0/$batch").status_code, 200)
+        # Retry-After quando presente; senão, 2 ** tentativa
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [4, 2])
+        self.assertEqual(self.autorizacoes(cliente), ["Bearer token-1"] * 3)
+
+    def test_desiste_depois_de_graph_max_retries(self):
+        cliente = self.cliente([RespostaFalsa(429, headers={"Retry-After": "abc"})] * 3)
+        self.assertEqual(cliente.get("/users/u/messages").status_code, 429)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2])
+        self.assertEqual(len(cliente.sessao.chamadas), 3)
+
+
+@override_settings(
+    EMAIL_ASYNC_MAX_CONTAS=4,
+    EMAIL_ASYNC_MAX_POR_HOST=1,
+    EMAIL_TASK_SOFT_TIME_LIMIT=0.05,
+    EMAIL_TASK_MAX_RETRIES=0,
+)
+class LeitorConcorrenteTest(SimpleTestCase):
+    """
+    Tempo limite do leitor concorrente: a leitura é cancelada entre lotes e a
+    vaga do host só é liberada quando a thread termina.
+    """
+
+    def conta(self, pk):
+        return SimpleNamespace(pk=pk, username=f"conta{pk}@empresa.com.py", host="imap.empresa.com.py", office365=False)
+
+    def test_vaga_do_host_fica_com_a_thread_ate_o_fim(self):
+        eventos = []
+        lock = threading.Lock()
+
+        def ler(user, max_emails, execucao_id, cancelar):
+            with lock:
+                eventos.append(("inicio", user.pk, time.monotonic()))
+            # Lotes de 20ms até o cancelamento (leitura lenta, além do limite)
+            while not cancelar.wait(0.02):
+                pass
+            time.sleep(0.03)  # termina o lote em andamento
+            with lock:
+                eventos.append(("fim", user.pk, time.monotonic()))
+            return novo_resumo(user, erro="Tempo limite excedido")
+
+        with mock.patch("documentos.leitor_async._processar_conta_thread", side_effect=ler):
+            resumos = asyncio.run(_ler_contas([self.conta(1), self.conta(2)], 100))
+
+        self.assertEqual([r["erro"] for r in resumos], ["Tempo limite excedido"] * 2)
+        # Mesmo host com limite 1: a segunda conta só começa depois que a thread da primeira termina
+        (fim_1,) = [t for evento, pk, t in eventos if (evento, pk) == ("fim", 1)]
+        (inicio_2,) = [t for evento, pk, t in eventos if (evento, pk) == ("inicio", 2)]
+        self.assertGreaterEqual(inicio_2, fim_1)
+        # E a espera pela thread entra na duração da conta
+        self.assertGreaterEqual(resumos[0]["duracao"], 0.08)
+
+    def test_conta_rapida_nao_e_cancelada(self):
+        def ler(user, max_emails, execucao_id, cancelar):
+            resumo = novo_resumo(user)
+            resumo["cancelada"] = cancelar.is_set()
+            return resumo
+
+        with mock.patch("documentos.leitor_async._processar_conta_thread", side_effect=ler):
+            (resumo,) = asyncio.run(_ler_contas([self.conta(1)], 100))
+        self.assertEqual((resumo["erro"], resumo["cancelada"]), (None, False))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "referencias-testes"}},
+)
+class CacheReferenciasTest(SimpleTestCase):
+    """
+    CacheLRU (despejo, TTL e contadores) e a invalidação entre processos pela
+    versão compartilhada no cache do Django.
+    """
+
+    def setUp(self):
+        cache.clear()
+        limpar_caches()
+
+    def test_despeja_o_menos_usado(self):
+        lru = CacheLRU(tamanho_max=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")  # "b" passa a ser o menos usado
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+        self.assertEqual(lru.estatisticas()["tamanho"], 2)
+
+    def test_item_expira_pelo_ttl(self):
+        lru = CacheLRU(tamanho_max=10, ttl=60)
+        with mock.patch("documentos.cache_referencias.time.monotonic", return_value=1000.0):
+            lru.set("a", 1)
+        with mock.patch("documentos.cache_referencias.time.monotonic", return_value=1059.0):
+            self.assertEqual(lru.get("a"), 1)
+        with mock.patch("documentos.cache_referencias.time.monotonic", return_value=1060.0):
+            self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.estatisticas(), {"hits": 1, "misses": 1, "tamanho": 0})
+
+    def test_contadores_de_acertos_e_falhas(self):
+        lru = CacheLRU(tamanho_max=10, ttl=60)
+        lru.get("a")
+        lru.set("a", 1)
+        lru.get("a")
+        lru.get("a")
+        lru.delete("a")
+        lru.get("a")
+        self.assertEqual(lru.estatisticas(), {"hits": 2, "misses": 2, "tamanho": 0})
+
+    def test_invalidacao_em_outro_processo_descarta_o_cache_local(self):
+        buscar_em_cache(Departamento, ["11"])  # primeira leitura: falha e vai ao banco
+        guardar_em_cache(Departamento, [Departamento(pk=1, code="11", name="CENTRAL")])
+        encontrados, faltantes = buscar_em_cache(Departamento, ["11", "12"])
+        self.assertEqual((list(encontrados), faltantes), (["11"], ["12"]))
+
+        # Outro worker apaga o departamento: só a versão compartilhada muda
+        cache.set(f"referencias-versao:{Departamento._meta.label}", 1, None)
+        encontrados, faltantes = buscar_em_cache(Departamento, ["11"])
+        self.assertEqual((encontrados, faltantes), ({}, ["11"]))
+
+    def test_sinal_incrementa_a_versao_compartilhada(self):
+        antes = versao_compartilhada(Cidade)
+        invalidar_referencia(Cidade, Cidade(code="1"))
+        self.assertEqual(versao_compartilhada(Cidade), antes + 1)
+
+    def test_gravacao_limpa_o_cache_e_repete_em_integrity_error(self):
+        resultado = ({}, set())
+        consulta = mock.Mock()
+        consulta.values_list.return_value = ["1"]  # já gravado: nenhum XML novo
+        with mock.patch("documentos.util._gravar_documentos", side_effect=[IntegrityError("fk"), resultado]) as gravar, \
+                mock.patch.object(Documento.objects, "filter", return_value=consulta), \
+                mock.patch("documentos.util.limpar_caches") as limpar, redirect_stdout(io.StringIO()):
+            self.assertEqual(gravar_documentos([{"cdc": "1"}], company=None), resultado)
+        self.assertEqual(gravar.call_count, 2)
+        limpar.assert_called_once_with()
+
+
+class DocumentoListFiltrosTest(SimpleTestCase):
+    """
+    Filtros da DocumentoListView sobre as colunas do cabeçalho: confere o
+    WHERE montado, sem ir ao banco.
+    """
+
+    def filtros(self, **params):
+        view = DocumentoListView()
+        view.request = RequestFactory().get("/documentos/", {"company": "1", **params})
+        with redirect_stdout(io.StringIO()):
+            queryset = view.get_queryset()
+        return {
+            (no.lhs.target.name, no.lookup_name, tuple(no.rhs) if isinstance(no.rhs, list) else no.rhs)
+            for no in queryset.query.where.children
+            if no.lhs.target.name != "company"  # company__id__in, presente em todas
+        }
+
+    def test_sem_filtros(self):
+        self.assertEqual(self.filtros(), set())
+
+    def test_numero(self):
+        self.assertEqual(self.filtros(numero="001-002-0003334"), {("numero_completo", "exact", "001-002-0003334")})
+
+    def test_timbrado(self):
+        self.assertEqual(self.filtros(timbrado="12345678"), {("timbrado", "exact", "12345678")})
+
+    def test_receptor_ruc(self):
+        self.assertEqual(self.filtros(receptor_ruc="80012345-6"), {("receptor_ruc", "exact", "80012345-6")})
+
+    def test_receptor_nome(self):
+        self.assertEqual(self.filtros(receptor_nome="guaraní"), {("receptor_nome", "icontains", "guaraní")})
+
+    def test_moneda_em_maiusculas(self):
+        self.assertEqual(self.filtros(moneda="usd"), {("moneda", "exact", "USD")})
+
+    def test_condicion_venta(self):
+        self.assertEqual(self.filtros(condicion_venta="2"), {("condicion_venta", "exact", 2)})
+        self.assertEqual(self.filtros(condicion_venta="credito"), set())
+
+    def test_faixas_de_iva(self):
+        self.assertEqual(
+            self.filtros(total_iva_min="100", total_iva_max="250.50", iva_5_min="1", iva_10_max="99"),
+            {
+                ("total_iva", "gte", Decimal("100")),
+                ("total_iva", "lte", Decimal("250.50")),
+                ("iva_5", "gte", Decimal("1")),
+                ("iva_10", "lte", Decimal("99")),
+            },
+        )
+        # Valor inválido é ignorado, sem erro
+        self.assertEqual(self.filtros(iva_5_max="abc"), set())
+
+
+CACHE_LOCAL = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "gravacao-testes"}}
+
+
+def dados_xml(numero, ruc="80062853", cidade="1", itens=""):
+    """
+    Bytes de um DE de montar_de com cdc e número próprios; `ruc` e `cidade`
+    trocam o emissor e a cidade, `itens` acrescenta gCamItem.
+    """
+    xml = montar_de(cdc=f"018006285350550010033340220250726171527{numero:05d}", num_doc=f"{numero:07d}")
+    xml = xml.replace("<dRucEm>80062853</dRucEm>", f"<dRucEm>{ruc}</dRucEm>")
+    xml = xml.replace("<cCiuEmi>1</cCiuEmi>", f"<cCiuEmi>{cidade}</cCiuEmi>")
+    return xml.replace("</gDtipDE>", itens + "</gDtipDE>").encode("utf-8")
+
+
+def dados_de(numero, **kwargs):
+    return extrair_dados_nfe(dados_xml(numero, **kwargs))
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class GravarDocumentosTest(TestCase):
+    """
+    gravar_documentos: referências e documentos em lote (número de queries
+    fixo por lote), retorno de novos x existentes, retry com o cache limpo e a
+    corrida pelo mesmo cdc entre workers.
+    """
+
+    def setUp(self):
+        storage_xml_temporario(self)
+        cache.clear()
+        limpar_caches()
+        self.addCleanup(limpar_caches)
+        self.empresa = Company.objects.create(name="Empresa Teste")
+
+    def gravar(self, lista_dados):
+        with redirect_stdout(io.StringIO()):
+            return gravar_documentos(lista_dados, self.empresa)
+
+    def test_primeira_gravacao_cria_as_referencias(self):
+        documentos, novos = self.gravar([dados_de(1, itens=ITEM_COMPLETO)])
+        cdc = dados_de(1)["cdc"]
+        self.assertEqual(novos, {cdc})
+
+        documento = Documento.objects.select_related("emissor__cidade__departamento", "tipo_documento").get(cdc=cdc)
+        self.assertEqual(documentos[cdc].pk, documento.pk)
+        self.assertEqual((documento.tipo_documento.code, documento.tipo_documento.name), (1, "Factura electrónica"))
+        emissor = documento.emissor
+        self.assertEqual(
+            (emissor.code, emissor.nome, emissor.nome_fantasia),
+            ("80062853", "COMERCIAL GUARANÍ S.A.", "Comercial Asunción"),
+        )
+        self.assertEqual((emissor.cidade.code, emissor.cidade.name), ("1", "ASUNCION (DISTRITO)"))
+        self.assertEqual((emissor.cidade.departamento.code, emissor.cidade.departamento.name), ("1", "CAPITAL"))
+        self.assertEqual((documento.numero_completo, documento.receptor_ruc, documento.iva_10), ("001-003-0000001", "80099999", Decimal("113636")))
+        self.assertEqual(len(documento.xml_sha256), 64)
+        self.assertEqual(list(documento.itens.values_list("numero", "codigo")), [(1, "A-1"), (2, "B-2")])
+
+    def test_novos_e_existentes(self):
+        primeiro, _ = self.gravar([dados_de(1)])
+        # O existente volta no dict, mas não entra nos criados nem é alterado
+        alterado = {**dados_de(1), "monto_total": Decimal("1")}
+        documentos, novos = self.gravar([alterado, dados_de(2), dados_de(2)])
+        cdc_1, cdc_2 = dados_de(1)["cdc"], dados_de(2)["cdc"]
+        self.assertEqual(novos, {cdc_2})
+        self.assertEqual(set(documentos), {cdc_1, cdc_2})
+        self.assertEqual(documentos[cdc_1].pk, primeiro[cdc_1].pk)
+        self.assertEqual(Documento.objects.get(cdc=cdc_1).monto_total, Decimal("1250000"))
+        self.assertEqual(Documento.objects.count(), 2)
+        self.assertEqual(DocumentoItem.objects.count(), 2)
+
+        self.assertEqual(self.gravar([dados_de(2)]), ({cdc_2: mock.ANY}, set()))
+        self.assertEqual(self.gravar([]), ({}, set()))
+
+    def test_queries_por_lote(self):
+        # Referências e documentos em lote: o número de queries não depende do
+        # tamanho do lote nem de quantos emissores/cidades são novos
+        def lote(inicio, tamanho):
+            return [dados_de(n, ruc=f"8{n:07d}", cidade=str(n)) for n in range(inicio, inicio + tamanho)]
+
+        with self.assertNumQueries(22):
+            self.gravar(lote(1, 1))
+        # Departamento e tipo já gravados: sem o INSERT e a releitura deles
+        with self.assertNumQueries(18):
+            self.gravar(lote(2, 1))
+        with self.assertNumQueries(18):
+            self.gravar(lote(100, 25))
+
+        # Referências já em cache (depois do commit): sem as consultas de referência
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gravar([dados_de(200)])
+        with self.assertNumQueries(10):
+            self.gravar([dados_de(n) for n in range(201, 226)])
+
+    def test_referencia_invalida_no_cache_limpa_e_repete(self):
+        # Departamento apagado por fora, mas ainda no cache deste processo
+        buscar_em_cache(Departamento, ["1"])
+        guardar_em_cache(Departamento, [Departamento(pk=999999, code="1", name="CAPITAL")])
+
+        with mock.patch("documentos.util.limpar_caches", wraps=limpar_caches) as limpar:
+            documentos, novos = self.gravar([dados_de(1)])
+
+        limpar.assert_called_once_with()
+        self.assertEqual(novos, {dados_de(1)["cdc"]})
+        departamento = Departamento.objects.get(code="1")
+        self.assertNotEqual(departamento.pk, 999999)
+        self.assertEqual(Cidade.objects.get(code="1").departamento, departamento)
+        self.assertEqual(Documento.objects.count(), 1)
+
+    def test_corrida_pelo_mesmo_cdc(self):
+        # Outro worker grava o cdc 1 entre a consulta dos existentes e o INSERT
+        cdc_1, cdc_2 = dados_de(1)["cdc"], dados_de(2)["cdc"]
+        concorrente = []
+
+        def outro_worker(execute, sql, params, many, context):
+            resultado = execute(sql, params, many, context)
+            if not concorrente and sql.startswith('SELECT "documentos_documento"."id", "documentos_documento"."cdc"'):
+                concorrente.append(Documento.objects.create(
+                    cdc=cdc_1,
+                    company=self.empresa,
+                    tipo_documento=TipoDocumento.objects.get(code=1),
+                    num_doc="0000001",
+                    emissor=Emissor.objects.get(code="80062853"),
+                    fecha_emision=dados_de(1)["fecha_emision"],
+                    monto_total=Decimal("1250000"),
+                ))
+            return resultado
+
+        with connection.execute_wrapper(outro_worker):
+            documentos, novos = self.gravar([dados_de(1), dados_de(2)])
+
+        self.assertEqual(novos, {cdc_2})
+        self.assertEqual(documentos[cdc_1].pk, concorrente[0].pk)
+        self.assertEqual(Documento.objects.count(), 2)
+        # Itens só do documento gravado por esta chamada
+        self.assertEqual(list(DocumentoItem.objects.values_list("documento__cdc", flat=True)), [cdc_2])
+
+
+@override_settings(CACHES=CACHE_LOCAL, EMAIL_INGEST_STAGING=True, IMAP_FETCH_BATCH=10, XML_PARSE_WORKERS=1)
+class FilaAnexosTest(TestCase):
+    """
+    Fila AnexoPendente (EMAIL_INGEST_STAGING): o leitor só enfileira e apaga a
+    mensagem depois do commit; o consumidor grava os documentos, registra os
+    erros e esvazia a fila.
+    """
+
+    def setUp(self):
+        storage_xml_temporario(self)
+        cache.clear()
+        limpar_caches()
+        self.addCleanup(limpar_caches)
+        # xmls_erros/ é criado no diretório atual
+        diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, diretorio)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(diretorio)
+        self.conta = criar_conta()
+
+    def mensagem(self, *anexos):
+        contexto = {"assunto": "Factura", "remetente": "facturacion@example.com.py", "received_at": None}
+        return contexto, [
+            {"filename": nome, "mime_type": "application/xml", "payload_bytes": payload}
+            for nome, payload in anexos
+        ]
+
+    def ler(self, mail):
+        with mock.patch("documentos.email_reader.imaplib.IMAP4_SSL", return_value=mail), redirect_stdout(io.StringIO()):
+            return leitor_email_box(self.conta)
+
+    def consumir(self, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return consumir_anexos_pendentes(**kwargs)
+
+    def test_enfileira_sem_parse(self):
+        mensagens = [
+            self.mensagem(("a.xml", montar_de().encode()), ("leia-me.xml", b"<nota/>")),
+            self.mensagem(("b.xml", b'<rDE><DE Id="1">')),
+        ]
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(enfileirar_anexos(self.conta, mensagens), 2)
+
+        self.assertEqual([a["situacao"] for _, anexos in mensagens for a in anexos], ["enfileirado", "ignorado", "enfileirado"])
+        pendentes = AnexoPendente.objects.order_by("id")
+        self.assertEqual([(p.filename, p.account_id, p.subject) for p in pendentes], [
+            ("a.xml", self.conta.pk, "Factura"),
+            ("b.xml", self.conta.pk, "Factura"),
+        ])
+        self.assertEqual(bytes(pendentes[0].payload), montar_de().encode())
+        self.assertFalse(Documento.objects.exists())
+
+    def test_mensagem_so_e_apagada_depois_do_commit(self):
+        mail = ContaImapFalsa(100, [1, 2], xmls={1: dados_xml(1), 2: dados_xml(2)})
+        na_fila = []
+        uid = mail.uid
+
+        def uid_com_fila(comando, *args):
+            if comando == "STORE":
+                na_fila.append(AnexoPendente.objects.count())
+            return uid(comando, *args)
+
+        mail.uid = uid_com_fila
+        resumo = self.ler(mail)
+        self.assertEqual((resumo["enfileirados"], resumo["apagados"]), (2, 2))
+        # Quando o STORE foi enviado, os anexos já estavam gravados na fila
+        self.assertEqual(na_fila, [2])
+        self.assertFalse(Documento.objects.exists())
+
+    def test_falha_ao_enfileirar_nao_apaga_a_mensagem(self):
+        mail = ContaImapFalsa(100, [1], xmls={1: dados_xml(1)})
+        with mock.patch.object(AnexoPendente.objects, "bulk_create", side_effect=IntegrityError("fila")), \
+                self.assertRaises(IntegrityError):
+            self.ler(mail)
+        self.assertNotIn("STORE", [comando[0] for comando in mail.comandos])
+        self.assertEqual(ImapSyncState.objects.get(account=self.conta).last_uid, 0)
+
+    def test_consumidor_grava_e_isola_o_anexo_com_erro(self):
+        mensagens = [
+            self.mensagem(("1.xml", dados_xml(1))),
+            self.mensagem(("quebrado.xml", b'<rDE><DE Id="1"><gTimb>')),
+            self.mensagem(("2.xml", dados_xml(2))),
+            self.mensagem(("1-reenvio.xml", dados_xml(1))),
+        ]
+        with redirect_stdout(io.StringIO()):
+            enfileirar_anexos(self.conta, mensagens)
+
+        resumo = self.consumir(tamanho_lote=3)
+        self.assertEqual(resumo, {"lotes": 2, "anexos": 4, "ok": 2, "duplicados": 1, "ignorados": 0, "erros": 1})
+        self.assertFalse(AnexoPendente.objects.exists())
+        self.assertEqual(set(Documento.objects.values_list("num_doc", flat=True)), {"0000001", "0000002"})
+        self.assertEqual(AnexoProcessado.objects.count(), 2)
+        erro = EmailXmlError.objects.get()
+        self.assertEqual((erro.filename, erro.account_id), ("quebrado.xml", self.conta.pk))
+        self.assertTrue(os.path.exists(os.path.join("xmls_erros", "quebrado.xml")))
+
+        # Fila vazia: nada a fazer
+        self.assertEqual(self.consumir()["lotes"], 0)
+
+    def test_ida_e_volta_pela_tarefa(self):
+        self.ler(ContaImapFalsa(100, [1, 2], xmls={1: dados_xml(1), 2: b'<rDE><DE Id="2">'}))
+        self.assertEqual(AnexoPendente.objects.count(), 2)
+
+        with redirect_stdout(io.StringIO()):
+            resumo = tarefa_consumir_anexos_pendentes.apply().get()
+        self.assertEqual((resumo["ok"], resumo["erros"]), (1, 1))
+        self.assertFalse(AnexoPendente.objects.exists())
+        documento = Documento.objects.get()
+        self.assertEqual((documento.company_id, documento.num_doc), (self.conta.company_id, "0000001"))
+        self.assertEqual(documento.documento_xml_bytes, dados_xml(1))
+        self.assertEqual(EmailXmlError.objects.get().subject, "Factura 001-003-0003334")
+
+
+@override_settings(CACHES=CACHE_LOCAL, EMAIL_INGEST_STAGING=False, IMAP_FETCH_BATCH=10)
+class IndiceAnexosTest(TestCase):
+    """
+    Índice SHA-256 dos anexos (AnexoProcessado): hash conhecido não passa pelo
+    parse e conta como duplicado; só anexos gravados com sucesso entram no
+    índice.
+    """
+
+    def setUp(self):
+        storage_xml_temporario(self)
+        cache.clear()
+        limpar_caches()
+        self.addCleanup(limpar_caches)
+        diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, diretorio)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(diretorio)
+        self.conta = criar_conta()
+
+    def processar(self, *anexos):
+        contexto = {"assunto": "Factura", "remetente": "facturacion@example.com.py", "received_at": None}
+        mensagens = [(contexto, [{"filename": nome, "mime_type": "application/xml", "payload_bytes": payload}]) for nome, payload in anexos]
+        with redirect_stdout(io.StringIO()):
+            indice = indice_anexos(anexo for _, lista in mensagens for anexo in lista)
+            processar_anexos_lote(self.conta, mensagens, indice)
+            gravar_indice_anexos(indice)
+        return [lista[0] for _, lista in mensagens]
+
+    def test_hash_conhecido_nao_passa_pelo_parse(self):
+        self.processar(("1.xml", dados_xml(1)))
+        with mock.patch("documentos.ingestao.extrair_conteudos", wraps=extrair_conteudos) as extrair:
+            reenvio, novo = self.processar(("1-copia.xml", dados_xml(1)), ("2.xml", dados_xml(2)))
+
+        self.assertEqual((reenvio["situacao"], novo["situacao"]), ("duplicado", "ok"))
+        self.assertEqual(reenvio["sha256"], sha256_anexo(dados_xml(1)))
+        # Só o anexo novo foi para o parse
+        self.assertEqual([conteudo for _, conteudo in extrair.call_args.args[0]], [dados_xml(2)])
+        self.assertEqual(Documento.objects.count(), 2)
+
+    def test_so_anexos_gravados_entram_no_indice(self):
+        ok, quebrado, ignorado = self.processar(
+            ("1.xml", dados_xml(1)),
+            ("quebrado.xml", b'<rDE><DE Id="1"><gTimb>'),
+            ("leia-me.xml", b"<nota/>"),
+        )
+        self.assertEqual([a["situacao"] for a in (ok, quebrado, ignorado)], ["ok", "erro", "ignorado"])
+        registro = AnexoProcessado.objects.get()
+        self.assertEqual(
+            (registro.sha256, registro.filename, registro.size_bytes, registro.documento.num_doc),
+            (ok["sha256"], "1.xml", len(dados_xml(1)), "0000001"),
+        )
+
+        # O anexo com erro volta a ser processado no próximo envio
+        (quebrado,) = self.processar(("quebrado.xml", b'<rDE><DE Id="1"><gTimb>'))
+        self.assertEqual(quebrado["situacao"], "erro")
+        self.assertEqual(EmailXmlError.objects.count(), 2)
+
+    def test_mensagem_so_com_duplicados_e_apagada(self):
+        self.processar(("1.xml", dados_xml(1)))
+        mail = ContaImapFalsa(100, [1, 2], xmls={1: dados_xml(1), 2: b'<rDE><DE Id="2">'})
+        with mock.patch("documentos.email_reader.imaplib.IMAP4_SSL", return_value=mail), redirect_stdout(io.StringIO()):
+            resumo = leitor_email_box(self.conta)
+
+        self.assertEqual((resumo["duplicados"], resumo["erros"], resumo["apagados"]), (1, 1, 1))
+        # Só a mensagem com o anexo já processado é apagada; a com erro fica na caixa
+        self.assertEqual([comando[1] for comando in mail.comandos if comando[0] == "STORE"], ["1"])
+        self.assertEqual(Documento.objects.count(), 1)
+
+
+class ExecucoesTest(TestCase):
+    """
+    Registro das leituras (IngestRun / IngestRunAccount): uma linha por conta
+    e tentativa, totais somados ao finalizar e a API somente leitura.
+    """
+
+    def setUp(self):
+        self.conta_a = criar_conta("a@empresa.com.py")
+        self.conta_b = criar_conta("b@empresa.com.py")
+
+    def ler_conta(self, execucao_id, user, erro=None, **contagens):
+        resumo = novo_resumo(user)
+        resumo.update(contagens)
+        resumo["tempos"].update(busca=0.25, gravacao=0.5)
+        try:
+            with registrar_conta_execucao(execucao_id, resumo):
+                if erro:
+                    raise ConnectionError(erro)
+        except ConnectionError:
+            pass
+        return resumo
+
+    def test_linha_por_conta_e_totais(self):
+        execucao_id = iniciar_execucao("sequencial")
+        self.ler_conta(execucao_id, self.conta_a, encontrados=3, processados=3, apagados=2, criados=2, bytes=1000)
+        resumo = self.ler_conta(execucao_id, self.conta_b, erro="LOGIN failed", encontrados=1)
+        # Erro levantado dentro do bloco vai para o resumo e para a linha da conta
+        self.assertEqual(resumo["erro"], "LOGIN failed")
+
+        linhas = {linha.account_id: linha for linha in IngestRunAccount.objects.filter(run_id=execucao_id)}
+        self.assertEqual(
+            (linhas[self.conta_a.pk].messages_deleted, linhas[self.conta_a.pk].documents_created, linhas[self.conta_a.pk].error),
+            (2, 2, ""),
+        )
+        self.assertEqual(linhas[self.conta_b.pk].error, "LOGIN failed")
+        self.assertEqual(linhas[self.conta_a.pk].search_seconds, 0.25)
+        self.assertIsNotNone(linhas[self.conta_b.pk].finished_at)
+
+        finalizar_execucao(execucao_id)
+        execucao = IngestRun.objects.get(pk=execucao_id)
+        self.assertEqual(
+            (execucao.accounts, execucao.accounts_failed, execucao.messages_found, execucao.bytes_downloaded),
+            (2, 1, 4, 1000),
+        )
+        self.assertEqual((execucao.search_seconds, execucao.db_seconds), (0.5, 1.0))
+        self.assertIsNotNone(execucao.finished_at)
+
+    def test_conta_que_falhou_e_depois_leu(self):
+        # Retry: duas linhas da mesma conta; a conta conta uma vez, como falha
+        execucao_id = iniciar_execucao("chord")
+        self.ler_conta(execucao_id, self.conta_a, erro="timeout")
+        self.ler_conta(execucao_id, self.conta_a, processados=5)
+        finalizar_execucao(execucao_id)
+        execucao = IngestRun.objects.get(pk=execucao_id)
+        self.assertEqual((execucao.accounts, execucao.accounts_failed, execucao.messages_processed), (1, 1, 5))
+
+    def test_leitura_avulsa(self):
+        self.ler_conta(None, self.conta_a, processados=1)
+        execucao = IngestRun.objects.get()
+        self.assertEqual((execucao.engine, execucao.accounts, execucao.messages_processed), ("avulsa", 1, 1))
+        self.assertIsNotNone(execucao.finished_at)
+
+    def test_api(self):
+        antiga = IngestRun.objects.create(engine="sequencial", started_at=timezone.now() - timedelta(days=1))
+        execucao_id = iniciar_execucao("asyncio")
+        self.ler_conta(execucao_id, self.conta_a, processados=2)
+        finalizar_execucao(execucao_id)
+
+        cliente = APIClient()
+        lista = reverse("ingest-run-list")
+        detalhe = reverse("ingest-run-detail", args=[execucao_id])
+        for url in (lista, detalhe):
+            with self.subTest(url=url):
+                self.assertEqual(cliente.get(url).status_code, 401)
+
+        cliente.force_authenticate(user=DjangoUser.objects.create_user("operador", password="senha"))
+        resposta = cliente.get(lista)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual([execucao["id"] for execucao in resposta.data["results"]], [execucao_id, antiga.pk])
+        resposta = cliente.get(lista, {"engine": "sequencial"})
+        self.assertEqual([execucao["id"] for execucao in resposta.data["results"]], [antiga.pk])
+
+        resposta = cliente.get(detalhe)
+        self.assertEqual((resposta.data["accounts"], resposta.data["messages_processed"]), (1, 2))
+        self.assertEqual([linha["account"] for linha in resposta.data["account_runs"]], ["a@empresa.com.py"])
+        self.assertEqual(cliente.post(lista, {}).status_code, 405)
+
+
+@override_settings(CACHES=CACHE_LOCAL, EMAIL_INGEST_ENGINE="chord", EMAIL_TASK_RETRY_BACKOFF=30, PROFILE_INGESTAO=False)
+class TarefasLeituraTest(TestCase):
+    """
+    Tasks Celery da leitura de e-mails em modo eager: uma task por conta no
+    chord, retry com backoff, tempo limite e o resumo de todas as contas no
+    callback, mesmo com uma conta falhando.
+    """
+
+    def setUp(self):
+        # Sem task_eager_propagates: no modo eager o retry re-executa a task na hora
+        anterior = {chave: celery_app.conf[chave] for chave in ("task_always_eager", "task_eager_propagates")}
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=False)
+        self.addCleanup(celery_app.conf.update, anterior)
+        self.falhas = {}
+
+    def ler(self, user, max_emails=100, execucao_id=None):
+        # processar_conta_email falso: falha as primeiras self.falhas[username] vezes
+        resumo = novo_resumo(user)
+        with registrar_conta_execucao(execucao_id, resumo):
+            restantes = self.falhas.get(user.username, 0)
+            if restantes:
+                self.falhas[user.username] = restantes - 1
+                raise ConnectionError("LOGIN failed")
+            resumo["processados"] = 2
+        return resumo
+
+    def executar(self, tarefa, *args, **kwargs):
+        with mock.patch("documentos.tasks.processar_conta_email", side_effect=self.ler), \
+                mock.patch.object(tarefa_processar_conta, "retry", wraps=tarefa_processar_conta.retry) as retry, \
+                redirect_stdout(io.StringIO()):
+            resultado = tarefa.apply(args=args, kwargs=kwargs).get()
+        return resultado, [chamada.kwargs["countdown"] for chamada in retry.call_args_list]
+
+    def test_retry_com_backoff(self):
+        conta = criar_conta()
+        self.falhas[conta.username] = 2
+        resumo, esperas = self.executar(tarefa_processar_conta, conta.pk)
+        self.assertEqual(esperas, [30, 60])
+        self.assertEqual((resumo["erro"], resumo["processados"]), (None, 2))
+
+    def test_tentativas_esgotadas_devolvem_o_erro(self):
+        conta = criar_conta()
+        self.falhas[conta.username] = 10
+        resumo, esperas = self.executar(tarefa_processar_conta, conta.pk)
+        self.assertEqual(esperas, [30 * 2 ** n for n in range(tarefa_processar_conta.max_retries)])
+        self.assertEqual(resumo["erro"], "LOGIN failed")
+
+    def test_tempo_limite_sem_retry(self):
+        conta = criar_conta()
+        with mock.patch("documentos.tasks.processar_conta_email", side_effect=SoftTimeLimitExceeded()), \
+                redirect_stdout(io.StringIO()):
+            resumo = tarefa_processar_conta.apply(args=(conta.pk,)).get()
+        self.assertEqual(resumo["erro"], "Tempo limite excedido")
+
+    def test_conta_inativa_ou_apagada(self):
+        conta = criar_conta(active=False)
+        self.assertIsNone(self.executar(tarefa_processar_conta, conta.pk)[0])
+        self.assertIsNone(self.executar(tarefa_processar_conta, 999999)[0])
+
+    def test_chord_resume_todas_as_contas(self):
+        contas = [criar_conta(f"conta{i}@empresa.com.py") for i in range(3)]
+        criar_conta("inativa@empresa.com.py", active=False)
+        self.falhas = {contas[0].username: 10, contas[1].username: 1}
+
+        with mock.patch("documentos.tasks.imprimir_resumo_execucao") as imprimir:
+            self.executar(tarefa_processar_emails)
+
+        # Callback do chord: um resumo por conta ativa, inclusive a que falhou
+        (resumos,), _ = imprimir.call_args
+        self.assertEqual(
+            sorted((r["conta"], r["erro"]) for r in resumos),
+            [(contas[0].username, "LOGIN failed"), (contas[1].username, None), (contas[2].username, None)],
+        )
+        execucao = IngestRun.objects.get()
+        self.assertEqual(execucao.engine, "chord")
+        self.assertEqual((execucao.accounts, execucao.accounts_failed, execucao.messages_processed), (3, 2, 4))
+        self.assertIsNotNone(execucao.finished_at)
+
+
+@override_settings(CACHES=CACHE_LOCAL, PROFILE_TOP=5)
+class PerfilTest(TestCase):
+    """
+    perfilar e a opção --profile dos comandos: grava o .prof e o resumo .txt
+    em PROFILE_DIR, com o número de queries SQL executadas no bloco.
+    """
+
+    def setUp(self):
+        storage_xml_temporario(self)
+        cache.clear()
+        limpar_caches()
+        self.addCleanup(limpar_caches)
+        self.diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.diretorio)
+        self.perfis = os.path.join(self.diretorio, "perfis")
+        configuracao = override_settings(PROFILE_DIR=self.perfis)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.empresa = Company.objects.create(name="Empresa Teste")
+
+    def arquivos(self):
+        return sorted(os.listdir(self.perfis)) if os.path.isdir(self.perfis) else []
+
+    def resumo(self, nome):
+        (txt,) = [arquivo for arquivo in self.arquivos() if arquivo.startswith(nome) and arquivo.endswith(".txt")]
+        (prof,) = [arquivo for arquivo in self.arquivos() if arquivo.startswith(nome) and arquivo.endswith(".prof")]
+        self.assertEqual(txt[:-len(".txt")], prof[:-len(".prof")])
+        with open(os.path.join(self.perfis, txt), encoding="utf-8") as f:
+            # O .prof abre no pstats (e no snakeviz)
+            return f.read(), pstats.Stats(os.path.join(self.perfis, prof))
+
+    def queries(self, texto):
+        return int(re.match(r"[\w-]+: [\d.]+s; (\d+) query\(s\) SQL em [\d.]+s\n", texto).group(1))
+
+    def test_perfilar(self):
+        saida = io.StringIO()
+        with redirect_stdout(saida):
+            with perfilar("bloco"):
+                for _ in range(3):
+                    Company.objects.count()
+                # Aninhado: só o perfil de fora é gravado
+                with perfilar("interno"):
+                    Company.objects.exists()
+
+        texto, _ = self.resumo("bloco")
+        self.assertEqual(self.queries(texto), 4)
+        self.assertIn("cumulative", texto)
+        self.assertIn("4 query(s) SQL", saida.getvalue())
+        self.assertEqual(len(self.arquivos()), 2)
+
+    def test_desligado(self):
+        with perfilar("bloco", ativo=False):
+            Company.objects.count()
+        self.assertEqual(self.arquivos(), [])
+
+    def test_processa_xml(self):
+        caminho = os.path.join(self.diretorio, "lote.xml")
+        with open(caminho, "w", encoding="utf-8") as f:
+            f.write(montar_lote(*(dados_xml(n).decode() for n in (1, 2, 3))))
+
+        with redirect_stdout(io.StringIO()):
+            call_command("processa_xml", caminho, "--company", str(self.empresa.pk), stdout=io.StringIO())
+        self.assertEqual(self.arquivos(), [])
+
+        Documento.objects.all().delete()
+        with CaptureQueriesContext(connection) as capturadas, redirect_stdout(io.StringIO()):
+            call_command("processa_xml", caminho, "--company", str(self.empresa.pk), "--profile", stdout=io.StringIO())
+        self.assertEqual(Documento.objects.count(), 3)
+        # Todas as queries do comando, menos a busca da empresa (fora do perfil)
+        self.assertEqual(self.queries(self.resumo("processa_xml")[0]), len(capturadas) - 1)
+
+    def test_reprocess_xml_erros(self):
+        erros = os.path.join(self.diretorio, "xmls_erros")
+        os.makedirs(erros)
+        for n in (1, 2):
+            with open(os.path.join(erros, f"{n}.xml"), "wb") as f:
+                f.write(dados_xml(n))
+
+        argumentos = ["--dir", erros, "--company", str(self.empresa.pk), "--workers", "1", "--profile"]
+        with CaptureQueriesContext(connection) as capturadas, redirect_stdout(io.StringIO()):
+            call_command("reprocess_xml_erros", *argumentos, stdout=io.StringIO())
+        self.assertEqual(Documento.objects.count(), 2)
+        texto, estatisticas = self.resumo("reprocess_xml_erros")
+        self.assertEqual(self.queries(texto), len(capturadas))
+        # Com --workers 1 o parse roda no processo e entra no perfil
+        self.assertIn("extrair_documentos_nfe", {funcao for _, _, funcao in estatisticas.stats})
+
+
+@override_settings(CACHES=CACHE_LOCAL, XML_PARSE_WORKERS=1)
+class PreencherItensTest(TestCase):
+    """
+    gravar_itens e o backfill preencher_itens_documentos: só os documentos
+    pendentes são relidos, cada um é marcado (itens_extraidos) e uma segunda
+    execução não faz nada.
+    """
+
+    def setUp(self):
+        storage_xml_temporario(self)
+        cache.clear()
+        limpar_caches()
+        self.addCleanup(limpar_caches)
+        self.empresa = Company.objects.create(name="Empresa Teste")
+        with redirect_stdout(io.StringIO()):
+            self.documentos, _ = gravar_documentos(
+                [dados_de(1, itens=ITEM_COMPLETO), dados_de(2), dados_de(3), dados_de(4)], self.empresa,
+            )
+        self.doc = {n: self.documentos[dados_de(n)["cdc"]] for n in (1, 2, 3, 4)}
+
+        # Linhas gravadas antes da extração de itens: sem itens e pendentes
+        DocumentoItem.objects.filter(documento__in=[self.doc[1], self.doc[2], self.doc[4]]).delete()
+        Documento.objects.filter(pk__in=[self.doc[1].pk, self.doc[2].pk]).update(itens_extraidos=False)
+        # 4: já marcado como lido (sem itens), não é relido
+        # Linha antiga com o XML na coluna de texto, quebrado
+        self.quebrado = Documento.objects.create(
+            cdc="9" * 44, company=self.empresa, tipo_documento=self.doc[1].tipo_documento,
+            num_doc="0000009", emissor=self.doc[1].emissor, fecha_emision=timezone.now(),
+            monto_total=Decimal("1"), itens_extraidos=False, documento_xml_texto='<rDE><DE Id="9"><gTimb>',
+        )
+
+    def preencher(self, *argumentos):
+        saida = io.StringIO()
+        call_command("preencher_itens_documentos", "--workers", "1", *argumentos, stdout=saida)
+        return saida.getvalue()
+
+    def situacao(self):
+        return dict(Documento.objects.values_list("pk", "itens_extraidos"))
+
+    def itens(self, documento):
+        return list(DocumentoItem.objects.filter(documento=documento).values_list("numero", "codigo", "total"))
+
+    def test_preenche_os_pendentes(self):
+        saida = self.preencher("--batch-size", "2")
+        self.assertIn("3 documento(s) lido(s): 3 item(ns) gravado(s); 0 sem itens no XML; 1 com erro.", saida)
+        self.assertEqual(self.itens(self.doc[1]), [(1, "A-1", None), (2, "B-2", Decimal("13500"))])
+        self.assertEqual(self.itens(self.doc[2]), [(1, "A-1", None)])
+        self.assertEqual(self.itens(self.doc[4]), [])
+        self.assertEqual(self.situacao(), {
+            self.doc[1].pk: True, self.doc[2].pk: True, self.doc[3].pk: True, self.doc[4].pk: True,
+            self.quebrado.pk: None,
+        })
+
+        # Segunda execução: nada pendente, nenhuma escrita
+        with CaptureQueriesContext(connection) as capturadas:
+            saida = self.preencher()
+        self.assertIn("0 documento(s) lido(s)", saida)
+        self.assertFalse([q for q in capturadas if not q["sql"].startswith("SELECT")])
+        self.assertEqual(DocumentoItem.objects.count(), 4)
+
+        # --repetir-erros relê só o que deu erro
+        self.assertIn("1 documento(s) lido(s): 0 item(ns) gravado(s); 0 sem itens no XML; 1 com erro.", self.preencher("--repetir-erros"))
+        self.assertIsNone(self.situacao()[self.quebrado.pk])
+
+    def test_limite(self):
+        self.preencher("--limit", "1")
+        self.assertEqual(self.itens(self.doc[1])[0][1], "A-1")
+        self.assertEqual(self.situacao()[self.doc[2].pk], False)
+        self.preencher()
+        self.assertEqual(self.itens(self.doc[2]), [(1, "A-1", None)])
+
+    def test_gravar_itens(self):
+        itens = dados_de(1, itens=ITEM_COMPLETO)["itens"]
+        DocumentoItem.objects.all().delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(gravar_itens([(self.doc[1], []), (self.doc[2], [])]), 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(gravar_itens([(self.doc[1], itens), (self.doc[2], itens[:1])]), 3)
+        # Itens já gravados (mesmo documento e número) são ignorados
+        self.assertEqual(gravar_itens([(self.doc[1], itens)]), 2)
+        self.assertEqual(DocumentoItem.objects.count(), 3)
+        item = DocumentoItem.objects.get(documento=self.doc[1], numero=2)
+        self.assertEqual(
+            (item.descricao, item.unidade, item.quantidade, item.preco_unitario, item.desconto, item.taxa_iva),
+            ("Producto 2", "UNI", Decimal("1.5"), Decimal("10000"), Decimal("1000"), 10),
+        )
 
-# Create your tests here.
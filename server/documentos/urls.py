@@ -5,7 +5,9 @@ from documentos.views import (
     DocumentoXMLDownloadView,
     DocumentoPDFView,
     FacturaPDFView,
-    DocumentoExportExcelView
+    DocumentoExportExcelView,
+    IngestRunListView,
+    IngestRunDetailView,
 )
 
 
@@ -15,4 +17,6 @@ urlpatterns = [
     path('documentos/download-excel/', DocumentoExportExcelView.as_view(), name='documento-download-excel'),
     path('documentos/', DocumentoListView.as_view(), name='documento-list'),
     path('tipos-documento/', TipoDocumentoListView.as_view(), name='tipo-documento-list'),
+    path('ingest-runs/', IngestRunListView.as_view(), name='ingest-run-list'),
+    path('ingest-runs/<int:pk>/', IngestRunDetailView.as_view(), name='ingest-run-detail'),
 ]
@@ -1,41 +1,33 @@
 import base64
+import hashlib
 import locale
 import os
 import pytz
 import qrcode
 import traceback
-import xml.etree.ElementTree as ET
 import requests
 import os
 from babel.numbers import format_currency
 from common.models import Departamento, Cidade
 from datetime import datetime, timedelta
 from decimal import Decimal
+from django.db import IntegrityError, connection, transaction
+from documentos.blobs_xml import guardar_xml
+from documentos.cache_referencias import buscar_em_cache, guardar_em_cache, limpar_caches
+from documentos.sifen import extrair_documentos_nfe, iterar_documentos_nfe
 from email import policy
-from documentos.models import TipoDocumento, Documento
+from documentos.models import AnexoProcessado, TipoDocumento, Documento, DocumentoItem
 from emails.models import EmailXmlError, User as EmailAccount
 from emissores.models import Emissor
 from io import BytesIO
 from num2words import num2words
 from PIL import Image
-from typing import Optional
+from typing import Optional, Union
 
 def get_graph_token(ms_tenant_id=None, ms_client_id=None, ms_client_secret=None):
-    """Obtém token de acesso do Microsoft Graph via client credentials."""
-    tenant_id = ms_tenant_id
-    client_id = ms_client_id
-    client_secret = ms_client_secret
-
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        "client_id": client_id,
-        "scope": "https://graph.microsoft.com/.default",
-        "client_secret": client_secret,
-        "grant_type": "client_credentials",
-    }
-    response = requests.post(url, data=data)
-    response.raise_for_status()
-    return response.json()["access_token"]
+    """Obtém token de acesso do Microsoft Graph via client credentials (em cache até expirar)."""
+    from documentos.graph import obter_token_graph
+    return obter_token_graph(ms_tenant_id, ms_client_id, ms_client_secret)
 
 # locale.setlocale(locale.LC_ALL, 'es_PY.UTF-8')
 def simplificar_dict(d):
@@ -49,101 +41,227 @@ def simplificar_dict(d):
         return [simplificar_dict(item) for item in d]
     return d
 
-def processar_nfe_xml(xml_str: str, user):
-    print('Iniciando o processar NFE XML')
-    NS = {'ns': 'http://ekuatia.set.gov.py/sifen/xsd'}
-    root = ET.fromstring(xml_str)
-
-    # helper pra extrair texto com erro amigável
-    def get_text(node, path, required=True, default=None):
-        el = node.find(path, NS)
-        if el is None or el.text is None:
-            if required:
-                raise ValueError(f"Campo obrigatório não encontrado: {path}")
-            return default
-        return el.text.strip()
-
-    # 1) Aponta para o nó DE em qualquer lugar (por causa do rLoteDE/rDE)
-    de = root.find('.//ns:DE', NS)
-    if de is None:
-        raise ValueError("Nó <DE> não encontrado (verifique namespace/caminho).")
-
-    # 2) Blocos principais (sempre RELATIVOS a 'de')
-    gTimb = de.find('ns:gTimb', NS)
-    if gTimb is None:
-        raise ValueError("Bloco <gTimb> não encontrado em <DE>.")
-
-    gDatGralOpe = de.find('ns:gDatGralOpe', NS)
-    if gDatGralOpe is None:
-        raise ValueError("Bloco <gDatGralOpe> não encontrado em <DE>.")
-
-    gEmis = gDatGralOpe.find('ns:gEmis', NS)
-    if gEmis is None:
-        raise ValueError("Bloco <gEmis> não encontrado em <gDatGralOpe>.")
-
-    # 3) Campos principais
-    cdc = de.attrib.get("Id")
-    if not cdc:
-        raise ValueError("Atributo Id não encontrado em <DE>.")
-
-    tipo_doc_code = int(get_text(gTimb, 'ns:iTiDE'))
-    tipo_doc_name = get_text(gTimb, 'ns:dDesTiDE')
-    est = get_text(gTimb, 'ns:dEst')
-    pun_exp = get_text(gTimb, 'ns:dPunExp')
-    num_doc = get_text(gTimb, 'ns:dNumDoc')
-
-    data_emissao_str = get_text(gDatGralOpe, 'ns:dFeEmiDE')
-    fecha_emision = datetime.fromisoformat(data_emissao_str)
-
-    # Totais (dentro de DE)
-    dTotOpe_txt = get_text(de, 'ns:gTotSub/ns:dTotOpe')
-    monto_total = Decimal(dTotOpe_txt)
-
-    # 4) Departamento e cidade do emissor
-    dep_code = get_text(gEmis, 'ns:cDepEmi')
-    dep_name = get_text(gEmis, 'ns:dDesDepEmi')
-    departamento, _ = Departamento.objects.get_or_create(
-        code=dep_code, defaults={'name': dep_name}
-    )
+def processar_nfe_xml(xml_str: Union[str, bytes], user):
+    """
+    Processa um XML de DE (texto, ou bytes do anexo no encoding declarado no
+    prólogo) e grava o Documento da empresa do usuário. Devolve
+    (documento, created). Em um lote (rLoteDE) todos os DE são gravados e o
+    retorno é o do primeiro; para arquivos grandes use processar_arquivo_nfe.
+    Para muitos XMLs use extrair_dados_nfe + gravar_documentos, que resolvem
+    as referências em lote.
+    """
+    lista_dados, erros = extrair_documentos_nfe(xml_str)
+    if erros:
+        posicao, erro = erros[0]
+        raise ValueError(f"DE {posicao}: {erro}") from erro
+    documentos, novos = gravar_documentos(lista_dados, user.company)
+    primeiro = lista_dados[0]['cdc']
+    return documentos[primeiro], primeiro in novos
 
-    city_code = get_text(gEmis, 'ns:cCiuEmi')
-    city_name = get_text(gEmis, 'ns:dDesCiuEmi')
-    cidade, _ = Cidade.objects.get_or_create(
-        code=city_code, defaults={'name': city_name, 'departamento': departamento}
-    )
+def processar_arquivo_nfe(fonte, company, tamanho_lote=500):
+    """
+    Grava todos os DE de um arquivo (rDE ou rLoteDE com milhares de DE) lendo
+    em streaming: os documentos são gravados a cada `tamanho_lote`, então a
+    memória não depende do tamanho do arquivo. `fonte` é um caminho, um
+    arquivo binário aberto ou o conteúdo. DE com erro são contados e pulados.
+    Devolve {'documentos', 'criados', 'erros'}.
+    """
+    resumo = {'documentos': 0, 'criados': 0, 'erros': 0}
 
-    # 5) TipoDocumento
-    tipo_doc, _ = TipoDocumento.objects.get_or_create(
-        code=tipo_doc_code, defaults={'name': tipo_doc_name}
-    )
+    def gravar(lote):
+        _, novos = gravar_documentos(lote, company)
+        resumo['documentos'] += len(lote)
+        resumo['criados'] += len(novos)
 
-    # 6) Emissor
-    ruc = get_text(gEmis, 'ns:dRucEm')
-    nome = get_text(gEmis, 'ns:dNomEmi')
-    nome_fantasia = get_text(gEmis, 'ns:dNomFanEmi', required=False, default=None)
+    lote = []
+    for posicao, dados, erro in iterar_documentos_nfe(fonte):
+        if erro is not None:
+            print(f"❌ DE {posicao}: {erro}")
+            resumo['erros'] += 1
+            continue
+        lote.append(dados)
+        if len(lote) >= tamanho_lote:
+            gravar(lote)
+            lote = []
+    if lote:
+        gravar(lote)
+    return resumo
 
-    emissor, _ = Emissor.objects.get_or_create(
-        code=ruc,
-        defaults={'nome': nome, 'nome_fantasia': nome_fantasia, 'cidade': cidade}
-    )
+def _resolver_referencias(model, valores, montar):
+    """
+    Devolve {code: instância} para os codes de `valores` ({code: dados}),
+    criando em lote os que ainda não existem. Os codes passam primeiro pelo
+    cache em memória (cache_referencias); só os ausentes vão ao banco, com uma
+    query para buscar, um INSERT para os novos e uma query para reler os
+    inseridos (ignore_conflicts não devolve as PKs).
+    """
+    existentes, faltantes = buscar_em_cache(model, valores)
+    if not faltantes:
+        return existentes
 
-    # 7) Documento
-    print("➡️ Processando documento:", cdc)
-    documento, created = Documento.objects.get_or_create(
-        cdc=cdc,
-        defaults={
-            'company': user.company,
-            'tipo_documento': tipo_doc,
-            'est': est,
-            'pun_exp': pun_exp,
-            'num_doc': num_doc,
-            'emissor': emissor,
-            'fecha_emision': fecha_emision,
-            'monto_total': monto_total,
-            'documento_xml': xml_str,
-        }
-    )
-    return documento, created
+    encontrados = list(model.objects.filter(code__in=faltantes))
+    existentes.update({obj.code: obj for obj in encontrados})
+    novos = [code for code in faltantes if code not in existentes]
+    if novos:
+        model.objects.bulk_create(
+            [montar(code, valores[code]) for code in novos],
+            ignore_conflicts=True,
+        )
+        inseridos = list(model.objects.filter(code__in=novos))
+        existentes.update({obj.code: obj for obj in inseridos})
+        encontrados.extend(inseridos)
+
+    # Só entra no cache depois do commit: um rollback não deixa PKs inexistentes
+    transaction.on_commit(lambda: guardar_em_cache(model, encontrados))
+    return existentes
+
+# Campos do cabeçalho do DE gravados como colunas (filtros da listagem)
+CAMPOS_CABECALHO = (
+    'numero_completo', 'timbrado', 'receptor_ruc', 'receptor_nome', 'moneda',
+    'condicion_venta', 'total_iva', 'iva_5', 'iva_10',
+)
+
+def gravar_documentos(lista_dados, company):
+    """
+    Grava em lote os documentos extraídos por extrair_dados_nfe para a empresa.
+
+    Cada tabela de referência (Departamento, Cidade, TipoDocumento, Emissor) é
+    resolvida com uma query para todos os codes distintos, e as que faltam são
+    criadas com bulk_create. Os documentos entram com
+    bulk_create(ignore_conflicts=True) pelo cdc (como no get_or_create, um
+    documento existente não é alterado).
+
+    O XML de cada documento novo vai para o storage antes da transação
+    (guardar_xmls); um rollback deixa só arquivos sem documento, removidos
+    pelo comando limpar_xml_orfaos.
+
+    Devolve ({cdc: Documento}, set de cdcs criados nesta chamada).
+    """
+    por_cdc = {}
+    for dados in lista_dados:
+        por_cdc.setdefault(dados['cdc'], dados)
+    if not por_cdc:
+        return {}, set()
+
+    existentes = set(Documento.objects.filter(cdc__in=list(por_cdc)).values_list('cdc', flat=True))
+    xmls = guardar_xmls({cdc: d for cdc, d in por_cdc.items() if cdc not in existentes})
+    try:
+        return _gravar_documentos(por_cdc, company, xmls)
+    except IntegrityError as e:
+        # Referência em cache apagada por fora (ex.: queryset.delete() em outro
+        # processo): descarta os caches e tenta uma vez direto do banco
+        print(f"⚠️ Referência inválida no cache ({e}); limpando o cache e tentando de novo.")
+        limpar_caches()
+        return _gravar_documentos(por_cdc, company, xmls)
+
+def guardar_xmls(por_cdc):
+    """
+    Grava no storage documentos_xml o XML de cada documento ({cdc: dados}) e
+    devolve {cdc: (sha256, tamanho)}. dados['xml_sha256'], quando presente, é
+    o SHA-256 do anexo, que já é o do próprio XML (ver processar_anexos_lote).
+    """
+    return {
+        cdc: guardar_xml(dados['documento_xml'], dados.get('xml_sha256'))
+        for cdc, dados in por_cdc.items()
+    }
+
+def _gravar_documentos(por_cdc, company, xmls):
+    with transaction.atomic():
+        departamentos = _resolver_referencias(
+            Departamento,
+            {d['departamento']['code']: d['departamento'] for d in por_cdc.values()},
+            lambda code, v: Departamento(code=code, name=v['name']),
+        )
+        cidades = _resolver_referencias(
+            Cidade,
+            {d['cidade']['code']: d for d in por_cdc.values()},
+            lambda code, d: Cidade(
+                code=code,
+                name=d['cidade']['name'],
+                departamento=departamentos[d['departamento']['code']],
+            ),
+        )
+        tipos = _resolver_referencias(
+            TipoDocumento,
+            {d['tipo_documento']['code']: d['tipo_documento'] for d in por_cdc.values()},
+            lambda code, v: TipoDocumento(code=code, name=v['name']),
+        )
+        emissores = _resolver_referencias(
+            Emissor,
+            {d['emissor']['code']: d for d in por_cdc.values()},
+            lambda code, d: Emissor(
+                code=code,
+                nome=d['emissor']['nome'],
+                nome_fantasia=d['emissor']['nome_fantasia'],
+                cidade=cidades[d['cidade']['code']],
+            ),
+        )
+
+        documentos = {doc.cdc: doc for doc in Documento.objects.filter(cdc__in=list(por_cdc)).only('id', 'cdc')}
+        novos = [
+            Documento(
+                cdc=cdc,
+                company=company,
+                tipo_documento=tipos[d['tipo_documento']['code']],
+                est=d['est'],
+                pun_exp=d['pun_exp'],
+                num_doc=d['num_doc'],
+                emissor=emissores[d['emissor']['code']],
+                fecha_emision=d['fecha_emision'],
+                monto_total=d['monto_total'],
+                **{campo: d[campo] for campo in CAMPOS_CABECALHO if campo in d},
+                **_campos_xml(xmls, cdc, d),
+            )
+            for cdc, d in por_cdc.items()
+            if cdc not in documentos
+        ]
+        if novos:
+            print(f"➡️ Gravando {len(novos)} documento(s) novo(s).")
+            try:
+                # Caminho comum: um único INSERT, que já devolve as PKs
+                with transaction.atomic():
+                    Documento.objects.bulk_create(novos)
+            except IntegrityError:
+                # Outro worker gravou algum desses cdcs nesse meio-tempo
+                ja_gravados = set(
+                    Documento.objects.filter(cdc__in=[doc.cdc for doc in novos]).values_list('cdc', flat=True)
+                )
+                novos = [doc for doc in novos if doc.cdc not in ja_gravados]
+                Documento.objects.bulk_create(novos, ignore_conflicts=True)
+                novos = list(Documento.objects.filter(cdc__in=[doc.cdc for doc in novos]).only('id', 'cdc'))
+                documentos.update(
+                    (doc.cdc, doc) for doc in Documento.objects.filter(cdc__in=ja_gravados).only('id', 'cdc')
+                )
+            documentos.update((doc.cdc, doc) for doc in novos)
+            gravar_itens([(doc, por_cdc[doc.cdc].get('itens') or []) for doc in novos])
+
+        # FKs são verificadas só no commit (DEFERRABLE): antecipa a checagem
+        # para que uma referência apagada caia no retry de gravar_documentos
+        connection.check_constraints()
+
+    return documentos, {doc.cdc for doc in novos}
+
+def _campos_xml(xmls, cdc, dados):
+    if cdc not in xmls:
+        # Documento apagado depois da consulta de gravar_documentos (raro)
+        xmls.update(guardar_xmls({cdc: dados}))
+    sha256, tamanho = xmls[cdc]
+    return {'xml_sha256': sha256, 'xml_tamanho': tamanho}
+
+def gravar_itens(documentos_itens):
+    """
+    Grava com um único bulk_create os itens extraídos (dados['itens']) de cada
+    documento; `documentos_itens` é uma lista de (Documento, itens). Itens já
+    gravados (mesmo documento e número) são ignorados.
+    """
+    itens = [
+        DocumentoItem(documento=documento, **item)
+        for documento, lista in documentos_itens
+        for item in lista
+    ]
+    if itens:
+        DocumentoItem.objects.bulk_create(itens, batch_size=1000, ignore_conflicts=True)
+    return len(itens)
 
 def numero_por_extenso(valor, moeda='guarani'):
     try:
@@ -227,6 +345,7 @@ def save_xml_error_simple(
     xml_text: Optional[str],
     err: Exception,
     size_bytes: Optional[int] = None,
+    stacktrace: Optional[str] = None,
 ) -> None:
     decoded_ok = xml_text is not None
     xml_b64 = None
@@ -248,7 +367,7 @@ def save_xml_error_simple(
         xml_text=xml_text if decoded_ok else None,
         xml_base64=xml_b64,
         error_message=str(err),
-        stacktrace=traceback.format_exc(),
+        stacktrace=stacktrace or traceback.format_exc(),
     )
 
 def parse_email_date(date_str):
@@ -267,3 +386,40 @@ def parse_email_date(date_str):
             return datetime.strptime(date_str[:30], "%d %b %Y %H:%M:%S %z")
         except Exception:
             return None
+
+def sha256_anexo(payload_bytes):
+    """
+    Hash SHA-256 (hex) do conteúdo bruto de um anexo.
+    """
+    return hashlib.sha256(payload_bytes or b"").hexdigest()
+
+def anexos_ja_processados(digests):
+    """
+    Devolve, em uma única query, o subconjunto de `digests` que já consta em
+    AnexoProcessado.
+    """
+    digests = set(digests)
+    if not digests:
+        return set()
+    return set(AnexoProcessado.objects.filter(sha256__in=digests).values_list('sha256', flat=True))
+
+def registrar_anexos_processados(registros):
+    """
+    Grava em lote os anexos processados com sucesso. `registros` é uma lista de
+    dicts com sha256, documento, filename e size_bytes; hashes já existentes
+    (ex.: gravados por outro worker) são ignorados.
+    """
+    if not registros:
+        return
+    AnexoProcessado.objects.bulk_create(
+        [
+            AnexoProcessado(
+                sha256=r['sha256'],
+                documento=r.get('documento'),
+                filename=(r.get('filename') or '')[:255],
+                size_bytes=r.get('size_bytes') or 0,
+            )
+            for r in registros
+        ],
+        ignore_conflicts=True,
+    )
@@ -2,19 +2,26 @@ import os
 import openpyxl
 import requests
 import xmltodict
-import xml.etree.ElementTree as ET
 from decouple import config
 from dotenv import load_dotenv
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from django.utils.dateparse import parse_datetime
 from django.db.models import Q
 from django.http import HttpResponse, Http404
-from documentos.models import Documento, TipoDocumento
-from documentos.serializers import DocumentoSerializer, TipoDocumentoSerializer
+from documentos.models import Documento, IngestRun, TipoDocumento
+from documentos.serializers import (
+    DocumentoSerializer,
+    IngestRunDetailSerializer,
+    IngestRunSerializer,
+    TipoDocumentoSerializer,
+)
+from documentos.sifen import XMLParseError, fromstring
 from documentos.generate_pdf import generate_factura_pdf, generate_nota_credito_pdf
 from io import BytesIO
 from rest_framework.filters import OrderingFilter
-from rest_framework.generics import ListAPIView
+from rest_framework.generics import ListAPIView, RetrieveAPIView
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
@@ -32,9 +39,10 @@ class DocumentoListView(ListAPIView):
     ordering = ['-fecha_emision']
 
     def get_queryset(self):
+        # O XML (a maior coluna da tabela) não é usado na listagem nem no Excel
         queryset = Documento.objects.select_related(
             'tipo_documento', 'emissor__cidade__departamento'
-        )
+        ).defer('documento_xml_zlib', 'documento_xml_texto')
 
         # Filtros opcionais via query params
         emissor_id = self.request.GET.get('emissor')
@@ -43,6 +51,12 @@ class DocumentoListView(ListAPIView):
         tipo_documento_id = self.request.GET.get('tipo_documento')
         fecha_inicio = self.request.GET.get('start_date')
         fecha_fim = self.request.GET.get('end_date')
+        numero = self.request.GET.get('numero')
+        timbrado = self.request.GET.get('timbrado')
+        receptor_ruc = self.request.GET.get('receptor_ruc')
+        receptor_nome = self.request.GET.get('receptor_nome')
+        moneda = self.request.GET.get('moneda')
+        condicion_venta = self.request.GET.get('condicion_venta')
 
         if emissor_id:
             queryset = queryset.filter(emissor__id=emissor_id)
@@ -61,6 +75,36 @@ class DocumentoListView(ListAPIView):
                 fecha_emision__range=[fecha_inicio, fecha_fim]
             )
 
+        if numero:
+            # Número completo, como impresso: 001-002-0003334
+            queryset = queryset.filter(numero_completo=numero)
+
+        if timbrado:
+            queryset = queryset.filter(timbrado=timbrado)
+
+        if receptor_ruc:
+            queryset = queryset.filter(receptor_ruc=receptor_ruc)
+
+        if receptor_nome:
+            queryset = queryset.filter(receptor_nome__icontains=receptor_nome)
+
+        if moneda:
+            queryset = queryset.filter(moneda=moneda.upper())
+
+        if condicion_venta and condicion_venta.isdigit():
+            queryset = queryset.filter(condicion_venta=condicion_venta)
+
+        # Faixas de IVA: ?total_iva_min=...&total_iva_max=... (idem iva_5 e iva_10)
+        for campo in ('total_iva', 'iva_5', 'iva_10'):
+            for sufixo, lookup in (('min', 'gte'), ('max', 'lte')):
+                valor = self.request.GET.get(f'{campo}_{sufixo}')
+                if not valor:
+                    continue
+                try:
+                    queryset = queryset.filter(**{f'{campo}__{lookup}': Decimal(valor)})
+                except InvalidOperation:
+                    pass
+
         company_param = (
             self.request.GET.getlist("company") or
             self.request.GET.getlist("company[]")
@@ -151,7 +195,8 @@ class DocumentoXMLDownloadView(APIView):
             raise Http404("Documento não encontrado")
 
         filename = f"{documento.cdc}.xml"
-        response = HttpResponse(documento.documento_xml, content_type='application/xml')
+        # Bytes originais: o encoding é o declarado no prólogo do próprio XML
+        response = HttpResponse(documento.documento_xml_bytes, content_type='application/xml')
         response['Content-Disposition'] = f'attachment; filename="{filename}"'
         return response
 
@@ -223,8 +268,8 @@ class DocumentoPDFView(APIView):
             # Define o namespace padrão para o XML SIFEN do Paraguai.
             # É crucial para que as buscas XPath funcionem corretamente.
             NS = {'sifen': 'http://ekuatia.set.gov.py/sifen/xsd'}
-            xml_root = ET.fromstring(documento.documento_xml)
-        except ET.ParseError:
+            xml_root = fromstring(documento.documento_xml)
+        except XMLParseError:
             # Retorna um erro se o XML for inválido.
             return HttpResponse("Error al leer el XML: Formato inválido.", status=400)
 
@@ -588,3 +633,34 @@ class DocumentoPDFView(APIView):
         response = HttpResponse(buffer, content_type='application/pdf')
         response['Content-Disposition'] = f'attachment; filename="{documento.cdc}.pdf"'
         return response
+
+class IngestRunListView(ListAPIView):
+    """
+    Execuções da leitura de e-mails (somente leitura), das mais recentes para
+    as mais antigas. Filtros opcionais: engine, start_date e end_date.
+    """
+    serializer_class = IngestRunSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = IngestRun.objects.all()
+
+        engine = self.request.GET.get('engine')
+        fecha_inicio = self.request.GET.get('start_date')
+        fecha_fim = self.request.GET.get('end_date')
+
+        if engine:
+            queryset = queryset.filter(engine=engine)
+
+        if fecha_inicio and fecha_fim:
+            queryset = queryset.filter(started_at__date__range=[fecha_inicio, fecha_fim])
+
+        return queryset.order_by('-started_at')
+
+class IngestRunDetailView(RetrieveAPIView):
+    """
+    Uma execução com a leitura de cada conta (contagens e tempo por etapa).
+    """
+    serializer_class = IngestRunDetailSerializer
+    permission_classes = [IsAuthenticated]
+    queryset = IngestRun.objects.prefetch_related('account_runs__account')
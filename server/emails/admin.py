@@ -1,5 +1,5 @@
 from django.contrib import admin
-from emails.models import User, EmailXmlError
+from emails.models import User, EmailXmlError, ImapSyncState
 
 
 @admin.register(User)
@@ -19,3 +19,12 @@ class EmailXmlErrorAdmin(admin.ModelAdmin):
     list_display = ('subject', 'received_from', 'received_at', 'filename', 'decoded_ok', 'created_at')
     search_fields = ('subject', 'received_from', 'filename')
     ordering = ('-created_at',)
+
+@admin.register(ImapSyncState)
+class ImapSyncStateAdmin(admin.ModelAdmin):
+    """
+    Admin interface for the incremental IMAP sync state.
+    """
+    list_display = ('account', 'folder', 'uidvalidity', 'last_uid', 'updated_at')
+    search_fields = ('account__username', 'folder')
+    ordering = ('account__username', 'folder')
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0005_user_created_at_user_office365_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImapSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(max_length=255)),
+                ('uidvalidity', models.BigIntegerField(blank=True, null=True)),
+                ('last_uid', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='imap_sync_states', to='emails.user')),
+            ],
+            options={
+                'unique_together': {('account', 'folder')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0006_imapsyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='office365_delta_link',
+            field=models.TextField(blank=True, default=None, null=True),
+        ),
+    ]
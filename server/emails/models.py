@@ -17,6 +17,7 @@ class User(models.Model):
     office365_client_id = models.CharField(max_length=255, blank=True, null=True, default=None)
     office365_tenant_id = models.CharField(max_length=255, blank=True, null=True, default=None)
     office365_client_secret = models.CharField(max_length=255, blank=True, null=True, default=None)
+    office365_delta_link = models.TextField(blank=True, null=True, default=None)  # estado da delta query da Inbox
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -50,4 +51,21 @@ class EmailXmlError(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
-        return f"[{self.subject or '(sem assunto)'}] {self.filename or '(sem arquivo)'}"
\ No newline at end of file
+        return f"[{self.subject or '(sem assunto)'}] {self.filename or '(sem arquivo)'}"
+
+class ImapSyncState(models.Model):
+    """
+    Estado da sincronização incremental IMAP de uma conta/pasta: o UIDVALIDITY
+    da pasta e o maior UID já processado (watermark).
+    """
+    account = models.ForeignKey('User', on_delete=models.CASCADE, related_name='imap_sync_states')
+    folder = models.CharField(max_length=255)
+    uidvalidity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('account', 'folder')
+
+    def __str__(self):
+        return f"{self.account} [{self.folder}] UIDVALIDITY={self.uidvalidity} UID>{self.last_uid}"